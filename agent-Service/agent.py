@@ -566,6 +566,7 @@
 
 #!/usr/bin/env python3
 import os
+import sys
 import json
 import time
 import uuid
@@ -574,7 +575,7 @@ import threading
 import socket
 import requests
 import psutil
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from confluent_kafka import Producer
 from confluent_kafka.admin import AdminClient, NewTopic
 import socket
@@ -582,15 +583,16 @@ from dotenv import load_dotenv
 import subprocess
 import re
 import random
+import signal
+import shutil
+import hashlib
+import queue
+from abc import ABC, abstractmethod
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 ENV_FILE_PATH = "/exports/applications/.env"  # Update this path as needed
 
-def get_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(('', 0))  # Bind to any available port on localhost
-        return s.getsockname()[1]  # Return the port number assigned by the OS
-
 
 if os.path.exists(ENV_FILE_PATH):
     load_dotenv(ENV_FILE_PATH)
@@ -617,36 +619,65 @@ def random_mac():
     return ''.join(f"{octet:02X}" for octet in mac)
 
 # --- Vagrant Template ---
-def generate_vagrantfile(host_app_path, port_):
+def generate_vagrantfile(host_app_path, port_, backend_port, bundle_path=None, guest_ports=None):
+    # auto_correct stays off: the ports were reserved by the allocator and the
+    # access URL has already been handed to the caller
+    # Only the ports the model declares are forwarded (see model_ports)
+    guest_ports = model_ports(host_app_path) if guest_ports is None else guest_ports
+    forwards = ''.join(f'  config.vm.network "forwarded_port", guest: {guest_ports[role]}, host: {host}\n'
+                       for role, host in (('frontend', port_), ('backend', backend_port)) if role in guest_ports)
+    guest_backend = guest_ports.get('backend', DEFAULT_BACKEND_PORT)
+    guest_frontend = guest_ports.get('frontend', DEFAULT_FRONTEND_PORT)
+    # The registry's dependency bundle sits beside the version and gets its own mount
+    bundle_mount = f'  config.vm.synced_folder "{bundle_path}", "/bundle", mount_options: ["ro"]\n' if bundle_path else ''
     return f'''
 Vagrant.configure("2") do |config|
   config.vm.box = "ubuntu-ml"
-  config.vm.network "forwarded_port", guest: 8051, host: {port_}, auto_correct: true
-
+{forwards}
   config.vm.provider "virtualbox" do |vb|
-    vb.memory = "2048"
-    vb.cpus = 2
+    vb.memory = "{VM_MEMORY_MB}"
+    vb.cpus = {VM_CPUS}
   end
 
-  # Temporarily mount host directory at /vagrant_temp to copy files
-  config.vm.synced_folder "{host_app_path}", "/vagrant_temp", disabled: false
-
+  # Model artifacts are mounted read-only and used in place, never copied
+  config.vm.synced_folder "{host_app_path}", "/model", mount_options: ["ro"]
+  config.vm.synced_folder "{WHEELHOUSE_DIR}", "/wheelhouse", mount_options: ["ro"]
+{bundle_mount}
+  # MLOPS_PHASE lines let the agent time each startup phase from the vagrant output
   config.vm.provision "shell", inline: <<-SHELL
+    echo "MLOPS_PHASE provision"
     echo "Creating /app directory..."
     sudo mkdir -p /app
 
-    echo "Copying files from /vagrant_temp to /app..."
-    sudo cp -r /vagrant_temp/* /app/
-
+    echo "Linking model files from /model into /app..."
+    cd /model
+    find . -type d | while read -r d; do sudo mkdir -p "/app/$d"; done
+    find . -type f | while read -r f; do
+      # Small files are copied so the app may still modify them; weights stay on the mount
+      if [ "$(stat -c %s "$f")" -le {MODEL_COPY_MAX_BYTES} ]; then
+        sudo cp "$f" "/app/$f"
+      else
+        sudo ln -sf "/model/$f" "/app/$f"
+      fi
+    done
+
+    echo "MLOPS_PHASE install"
     echo "Installing Python dependencies..."
     cd /app
     python3 -m venv venv
     venv/bin/activate
-    pip3 install -r requirements.txt
+    if [ -f /bundle/requirements.lock ] && pip3 install --no-index --find-links /bundle/wheels -r /bundle/requirements.lock; then
+      echo "Installed dependencies from the registry bundle"
+    else
+      pip3 install --find-links /wheelhouse -r requirements.txt
+    fi
 
+    echo "MLOPS_PHASE launch"
     echo "Launching app.py and webapp.py..."
-    nohup sudo python3 app.py > app.log 2>&1 &
-    nohup sudo streamlit run webapp.py --server.port 8051 > streamlit.log 2>&1 &
+    nohup sudo env PORT={guest_backend} python3 app.py > app.log 2>&1 &
+    if [ -f webapp.py ]; then
+      nohup sudo streamlit run webapp.py --server.port {guest_frontend} > streamlit.log 2>&1 &
+    fi
 
     echo "Checking network interface enp0s8..."
     ip a | grep enp0s8 || echo "Interface enp0s8 not found"
@@ -711,6 +742,44 @@ METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', '10'))
 APP_MOUNT_PATH = os.getenv('APP_MOUNT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
 MODEL_REGISTRY_URL = os.getenv('MODEL_REGISTRY_URL', f"http://{os.getenv('model_registry_ip', 'localhost')}:8000")
 
+# Provisioning configuration
+DEPLOYMENTS_DIR = Path(os.getenv('DEPLOYMENTS_DIR', './deployments'))
+VM_MEMORY_MB = int(os.getenv('VM_MEMORY_MB', '2048'))
+VM_CPUS = int(os.getenv('VM_CPUS', '2'))
+MODEL_COPY_MAX_BYTES = int(os.getenv('MODEL_COPY_MAX_BYTES', str(1024 * 1024)))  # larger model files are symlinked
+PORT_RANGE_START = int(os.getenv('PORT_RANGE_START', '20000'))
+PORT_RANGE_END = int(os.getenv('PORT_RANGE_END', '20999'))
+MAX_CONCURRENT_PROVISIONS = int(os.getenv('MAX_CONCURRENT_PROVISIONS', '0'))  # 0 = derive from host capacity
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', '3600'))
+INVENTORY_REFRESH_INTERVAL = int(os.getenv('INVENTORY_REFRESH_INTERVAL', '15'))
+INVENTORY_COMMAND_TIMEOUT = int(os.getenv('INVENTORY_COMMAND_TIMEOUT', '60'))
+DEPLOYMENT_JOURNAL_PATH = Path(os.getenv('DEPLOYMENT_JOURNAL_PATH', str(DEPLOYMENTS_DIR / 'journal.jsonl')))
+ANNOUNCE_RETRIES = int(os.getenv('ANNOUNCE_RETRIES', '10'))
+
+# Runtime selection - meta.json may set "runtime": "sandbox" for trusted models
+DEFAULT_RUNTIME = os.getenv('DEFAULT_RUNTIME', 'vagrant')
+ALLOWED_RUNTIMES = [r.strip() for r in os.getenv('ALLOWED_RUNTIMES', 'vagrant,sandbox').split(',') if r.strip()]
+SANDBOX_VENV_DIR = Path(os.getenv('SANDBOX_VENV_DIR', './sandbox-venvs'))
+SANDBOX_CGROUP_ROOT = Path(os.getenv('SANDBOX_CGROUP_ROOT', '/sys/fs/cgroup/mlops-agent'))
+SANDBOX_MEMORY_MB = int(os.getenv('SANDBOX_MEMORY_MB', '2048'))
+SANDBOX_CPUS = float(os.getenv('SANDBOX_CPUS', '2'))
+SANDBOX_PIDS_MAX = int(os.getenv('SANDBOX_PIDS_MAX', '512'))
+SANDBOX_START_TIMEOUT = int(os.getenv('SANDBOX_START_TIMEOUT', '120'))
+READINESS_TIMEOUT = int(os.getenv('READINESS_TIMEOUT', '300'))  # seconds after boot for the apps to answer
+STARTUP_PHASE_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300, 600, 900)
+
+# Local cache of model version directories, so popular models are read from NFS once per agent
+ARTIFACT_CACHE_DIR = Path(os.getenv('ARTIFACT_CACHE_DIR', './artifact-cache'))
+ARTIFACT_CACHE_MAX_BYTES = int(os.getenv('ARTIFACT_CACHE_MAX_BYTES', str(20 * 1024 ** 3)))  # 0 disables the cache
+ARTIFACT_CACHE_REVALIDATE_SECONDS = int(os.getenv('ARTIFACT_CACHE_REVALIDATE_SECONDS', '60'))
+WHEELHOUSE_DIR = Path(os.getenv('WHEELHOUSE_DIR', './wheelhouse')).resolve()  # prefetched wheels, mounted into VMs
+MODEL_BUNDLE_SUFFIX = '.bundle'  # registry-built lock file and wheels beside a model version directory
+DEFAULT_BACKEND_PORT = 5000  # guest ports when meta.json has no "ports" block
+DEFAULT_FRONTEND_PORT = 8501
+PREFETCH_QUEUE_SIZE = int(os.getenv('PREFETCH_QUEUE_SIZE', '16'))
+PREFETCH_MIN_FREE_BYTES = int(os.getenv('PREFETCH_MIN_FREE_BYTES', str(5 * 1024 ** 3)))
+REGISTRY_LOOKUP_CACHE_SIZE = 256  # fetch-model answers kept for If-None-Match revalidation
+
 
 agent_log_file = "/exports/applications/agent-Service/logs/agent-" + LAPTOP_ID + ".log"
 os.makedirs(os.path.dirname(agent_log_file), exist_ok=True)
@@ -753,8 +822,9 @@ def init_kafka_producer():
     return Producer(conf)
 
 class LaptopMetricsCollector:
-    def __init__(self, producer):
+    def __init__(self, producer, usage_tracker=None):
         self.producer = producer
+        self.usage_tracker = usage_tracker
         self.laptop_id = LAPTOP_ID
         self.agent_ip = AGENT_IP
         self.metrics_interval = METRICS_INTERVAL
@@ -818,7 +888,7 @@ class LaptopMetricsCollector:
             # Collect Vagrant VM information if available
             vagrant_vms = []
             try:
-                deployments_dir = Path("./deployments")
+                deployments_dir = DEPLOYMENTS_DIR
                 if deployments_dir.exists():
                     for vm_dir in deployments_dir.iterdir():
                         if vm_dir.is_dir():
@@ -912,6 +982,13 @@ class LaptopMetricsCollector:
             if vagrant_vms:
                 metrics['vagrant_vms'] = vagrant_vms
             
+            # Per-deployment resource usage
+            if self.usage_tracker:
+                try:
+                    metrics['deployments'] = self.usage_tracker.sample()
+                except Exception as e:
+                    logger.error(f"Error collecting deployment usage: {str(e)}", exc_info=True)
+            
             return metrics
         except Exception as e:
             logger.error(f"Error collecting laptop metrics: {str(e)}", exc_info=True)
@@ -953,6 +1030,1615 @@ class LaptopMetricsCollector:
                 logger.error(f"Error in laptop metrics collection loop: {str(e)}", exc_info=True)
                 time.sleep(self.metrics_interval)
 
+class DeploymentJournal:
+    """Append-only JSON-lines log of deployment records, replayed when the agent starts"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def load(self):
+        """Replay the journal into {deployment_id: record}, skipping a torn trailing line"""
+        records = {}
+        if not self.path.exists():
+            return records
+        with open(self.path) as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping corrupt journal line {line_number} in {self.path}")
+                    continue
+                if entry.get('op') == 'put':
+                    records[entry['deployment_id']] = entry['record']
+                elif entry.get('op') == 'delete':
+                    records.pop(entry['deployment_id'], None)
+        return records
+
+    def append(self, op, deployment_id, record=None):
+        entry = {'op': op, 'deployment_id': deployment_id, 'time': time.time()}
+        if record is not None:
+            entry['record'] = record
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self, records):
+        """Rewrite the journal as one put per live record"""
+        with self.lock:
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                for deployment_id, record in records.items():
+                    f.write(json.dumps({'op': 'put', 'deployment_id': deployment_id, 'record': record, 'time': time.time()}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+class DeploymentRecords:
+    """Record of every deployment this agent has provisioned, written through to the journal"""
+
+    def __init__(self, journal=None):
+        self.records = {}  # deployment_id -> record dict
+        self.lock = threading.Lock()
+        self.journal = journal
+
+    def put(self, deployment_id, record):
+        with self.lock:
+            self.records[deployment_id] = dict(record)
+            if self.journal:
+                self.journal.append('put', deployment_id, self.records[deployment_id])
+
+    def update(self, deployment_id, **fields):
+        with self.lock:
+            if deployment_id in self.records:
+                self.records[deployment_id].update(fields)
+                if self.journal:
+                    self.journal.append('put', deployment_id, self.records[deployment_id])
+
+    def remove(self, deployment_id):
+        with self.lock:
+            record = self.records.pop(deployment_id, None)
+            if record is not None and self.journal:
+                self.journal.append('delete', deployment_id)
+            return record
+
+    def load(self, records):
+        """Replace the in-memory state (used once at startup) and compact the journal to match"""
+        with self.lock:
+            self.records = {deployment_id: dict(record) for deployment_id, record in records.items()}
+            if self.journal:
+                self.journal.compact(self.records)
+
+    def get(self, deployment_id):
+        with self.lock:
+            record = self.records.get(deployment_id)
+            return dict(record) if record else None
+
+    def all(self):
+        with self.lock:
+            return {deployment_id: dict(record) for deployment_id, record in self.records.items()}
+
+def normalize_vagrant_state(state):
+    if state == 'running':
+        return 'running'
+    if state in ('poweroff', 'aborted', 'stopped'):
+        return 'stopped'
+    return state or 'unknown'
+
+def parse_global_status(output):
+    """Parse `vagrant global-status --machine-readable` into a list of machine dicts"""
+    machines = []
+    current = None
+    for line in output.splitlines():
+        parts = line.split(',', 4)
+        if len(parts) < 4:
+            continue
+        key, value = parts[2], parts[3]
+        if key == 'machine-id':
+            current = {'machine_id': value}
+            machines.append(current)
+        elif current is not None and key == 'provider-name':
+            current['provider'] = value
+        elif current is not None and key == 'machine-home':
+            current['path'] = value
+        elif current is not None and key == 'state':
+            current['state'] = value
+    return machines
+
+class VagrantInventory:
+    """Keeps the state of every deployment VM in memory, refreshed by one vagrant call per tick"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.vms = {}  # deployment_id -> {'state', 'machine_id', 'path'}
+        self.lock = threading.Lock()
+        self.last_refresh = None
+        self.last_error = None
+        self.refresh_requested = threading.Event()
+
+        self.thread = threading.Thread(target=self.refresh_loop)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Started VM inventory refresher (every {self.interval}s)")
+
+    def refresh(self):
+        """Replace the cached inventory with the current output of `vagrant global-status`"""
+        try:
+            result = subprocess.run(
+                ["vagrant", "global-status", "--prune", "--machine-readable"],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                timeout=INVENTORY_COMMAND_TIMEOUT
+            )
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip() or f"exit status {result.returncode}")
+
+            deployments_root = DEPLOYMENTS_DIR.resolve()
+            vms = {}
+            for machine in parse_global_status(result.stdout):
+                path = Path(machine.get('path', ''))
+                # Only VMs created by this agent live directly under the deployments directory
+                if path.parent != deployments_root:
+                    continue
+                vms[path.name] = {
+                    'state': normalize_vagrant_state(machine.get('state')),
+                    'machine_id': machine.get('machine_id'),
+                    'path': str(path)
+                }
+
+            with self.lock:
+                self.vms = vms
+                self.last_refresh = time.time()
+                self.last_error = None
+        except Exception as e:
+            logger.error(f"Error refreshing VM inventory: {str(e)}")
+            with self.lock:
+                self.last_error = str(e)
+
+    def request_refresh(self):
+        """Wake the refresher early, e.g. after a VM was created or destroyed"""
+        self.refresh_requested.set()
+
+    def snapshot(self):
+        with self.lock:
+            return {deployment_id: dict(vm) for deployment_id, vm in self.vms.items()}, self.last_refresh, self.last_error
+
+    def refresh_loop(self):
+        while True:
+            self.refresh()
+            self.refresh_requested.wait(self.interval)
+            self.refresh_requested.clear()
+
+def get_vm_bridge_ip(folder_path):
+    """Ask a freshly booted VM for its enp0s8 address; done once per deployment"""
+    bridge_ip_cmd = "ip -o -4 addr show | grep enp0s8 | awk '{print $4}' | cut -d'/' -f1"
+    try:
+        result = subprocess.run(
+            ["vagrant", "ssh", "-c", bridge_ip_cmd],
+            cwd=folder_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+            timeout=60
+        )
+        lines = result.stdout.strip().splitlines()
+        return lines[0].strip() if lines else None
+    except Exception as e:
+        logger.warning(f"Could not read VM IP for {folder_path}: {str(e)}")
+        return None
+
+def provisioning_capacity():
+    """Number of VMs this host can boot at once without overcommitting CPU or memory"""
+    if MAX_CONCURRENT_PROVISIONS > 0:
+        return MAX_CONCURRENT_PROVISIONS
+    by_cpu = (psutil.cpu_count(logical=True) or 1) // VM_CPUS
+    by_memory = psutil.virtual_memory().total // (VM_MEMORY_MB * 1024 * 1024)
+    return max(1, min(by_cpu, by_memory))
+
+class PortAllocator:
+    """Hands out host ports from a fixed range so concurrent deployments never collide"""
+
+    def __init__(self, start_port, end_port):
+        self.start_port = start_port
+        self.end_port = end_port
+        self.reserved = {}  # port -> owner (deployment_id)
+        self.lock = threading.Lock()
+        # Rotate through the range so a just-released port is not handed out again straight away
+        self.next_port = start_port
+
+    def _is_bindable(self, port):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            try:
+                s.bind(('', port))
+                return True
+            except OSError:
+                return False
+
+    def reserve(self, owner, count=1):
+        """Reserve `count` free ports for `owner`, returning them as a list"""
+        with self.lock:
+            ports = []
+            span = self.end_port - self.start_port + 1
+            for offset in range(span):
+                port = self.start_port + (self.next_port - self.start_port + offset) % span
+                if port in self.reserved or not self._is_bindable(port):
+                    continue
+                ports.append(port)
+                if len(ports) == count:
+                    break
+
+            if len(ports) < count:
+                raise RuntimeError(f"No available ports in range {self.start_port}-{self.end_port}")
+
+            for port in ports:
+                self.reserved[port] = owner
+            self.next_port = ports[-1] + 1 if ports[-1] < self.end_port else self.start_port
+            logger.info(f"Reserved ports {ports} for {owner}")
+            return ports
+
+    def claim(self, owner, ports):
+        """Mark ports already in use by a recovered deployment as reserved"""
+        with self.lock:
+            for port in ports:
+                if port and self.start_port <= port <= self.end_port:
+                    self.reserved[port] = owner
+
+    def release(self, owner):
+        """Release every port held by `owner`"""
+        with self.lock:
+            ports = [port for port, holder in self.reserved.items() if holder == owner]
+            for port in ports:
+                del self.reserved[port]
+        if ports:
+            logger.info(f"Released ports {ports} held by {owner}")
+        return ports
+
+class JobCancelled(Exception):
+    pass
+
+class ProvisioningJob:
+    """State of a single asynchronous /create-vm request"""
+
+    def __init__(self, deployment_id, model_id, version, host_app_path, host_port, runtime='vagrant', backend_port=None):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.deployment_id = deployment_id
+        self.model_id = model_id
+        self.version = version
+        self.host_app_path = host_app_path
+        # Resolved from the NFS path now, as host_app_path may later point into the artifact cache
+        self.bundle_path = model_bundle_dir(host_app_path)
+        self.host_port = host_port
+        self.backend_port = backend_port
+        self.runtime = runtime
+        self.access_url = f"http://{AGENT_IP}:{host_port}"
+        self.status = 'queued'  # queued -> running -> succeeded | failed | cancelled
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.process = None
+        self.cancel_requested = threading.Event()
+        self.phases = {}  # startup phase -> seconds, filled in by the runtime
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'deployment_id': self.deployment_id,
+            'model_id': self.model_id,
+            'version': self.version,
+            'status': self.status,
+            'runtime': self.runtime,
+            'host_port': self.host_port,
+            'access_url': self.access_url,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'duration': (self.finished_at or time.time()) - self.started_at if self.started_at else None,
+            'phases': self.phases
+        }
+
+class ArtifactCache:
+    """Host-local LRU cache of model version directories read from NFS.
+
+    A version is copied once into ARTIFACT_CACHE_DIR, hashing every file as it
+    streams, and checked against the registry's /manifest for the version when
+    it has one. Concurrent requests for the same version wait on a single fill.
+    Versions in use by a deployment are pinned; the least recently used
+    unpinned versions are evicted to stay under the size cap. Any failure
+    falls back to the NFS path so a deploy never depends on the cache.
+    """
+
+    MANIFEST = ".cache-manifest.json"
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root).resolve()
+        self.max_bytes = max_bytes
+        self.entries = {}  # key -> {'path', 'source', 'bytes', 'signature', 'last_used', 'verified_at'}
+        self.pins = {}  # owner (deployment_id) -> key
+        self.retired = {}  # directory name -> {'entry', 'owners'}: superseded copies still in use
+        self.reserved = 0  # bytes promised to fills in progress
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        """Index versions left by a previous agent process and drop half-written ones"""
+        for path in self.root.iterdir():
+            if path.name.startswith('.'):
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                with open(path / self.MANIFEST) as f:
+                    manifest = json.load(f)
+                self.entries[path.name] = {
+                    'path': path,
+                    'source': manifest['source'],
+                    'bytes': manifest['bytes'],
+                    'signature': manifest['signature'],
+                    'last_used': (path / self.MANIFEST).stat().st_mtime,
+                    'verified_at': 0
+                }
+            except (OSError, ValueError, KeyError):
+                logger.warning(f"Discarding unreadable artifact cache entry {path}")
+                shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Artifact cache at {self.root}: {len(self.entries)} versions, {self.used_bytes()} bytes")
+
+    @staticmethod
+    def key_for(source):
+        source = Path(source)
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', f"{source.parent.name}-{source.name}")
+
+    @staticmethod
+    def source_signature(source):
+        """(relative path, size, mtime) for every file; metadata only, so cheap even over NFS"""
+        signature = []
+        for dirpath, _, filenames in os.walk(source):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                st = os.stat(full_path)
+                signature.append([os.path.relpath(full_path, source), st.st_size, st.st_mtime_ns])
+        return sorted(signature)
+
+    def used_bytes(self):
+        return (sum(entry['bytes'] for entry in self.entries.values())
+                + sum(retired['entry']['bytes'] for retired in self.retired.values()))
+
+    def acquire(self, owner, source):
+        """Return a local copy of `source` pinned for `owner`, filling it if needed; falls back to `source`"""
+        if not self.enabled:
+            return str(source)
+        key = self.key_for(source)
+
+        # One fill per version: later callers block here and then find the entry ready
+        with self._key_lock(key):
+            try:
+                entry = self._validated_entry(key, source)
+                if entry is None:
+                    entry = self._fill(key, source)
+            except Exception as e:
+                logger.error(f"Artifact cache fill for {source} failed, using NFS directly: {str(e)}")
+                return str(source)
+            with self.lock:
+                # Another version's fill may have evicted this one since it was validated
+                if entry is None or self.entries.get(key) is not entry:
+                    return str(source)
+                self.pins[owner] = key
+                entry['last_used'] = time.time()
+            os.utime(entry['path'] / self.MANIFEST)
+            return str(entry['path'])
+
+    def warm(self, source, min_free_bytes=0):
+        """Prefetch `source` without pinning it or evicting anything; True if it ends up cached"""
+        if not self.enabled:
+            return False
+        key = self.key_for(source)
+        with self._key_lock(key):
+            if self._validated_entry(key, source) is not None:
+                return True
+            return self._fill(key, source, evict=False, min_free_bytes=min_free_bytes) is not None
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def pin(self, owner, path):
+        """Re-pin a cached version for a deployment recovered after a restart"""
+        with self.lock:
+            for key, entry in self.entries.items():
+                if str(entry['path']) == str(path):
+                    self.pins[owner] = key
+            for retired in self.retired.values():
+                if str(retired['entry']['path']) == str(path):
+                    retired['owners'].add(owner)
+
+    def release(self, owner):
+        unused = []
+        with self.lock:
+            self.pins.pop(owner, None)
+            for name, retired in list(self.retired.items()):
+                retired['owners'].discard(owner)
+                if not retired['owners']:
+                    unused.append(self.retired.pop(name)['entry'])
+        for entry in unused:
+            logger.info(f"Removing superseded artifact copy {entry['path']}; its last deployment is gone")
+            self._remove_path(entry['path'])
+
+    def _validated_entry(self, key, source):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['verified_at'] < ARTIFACT_CACHE_REVALIDATE_SECONDS:
+            return entry
+        # A version re-uploaded under the same number must not be served stale
+        if entry['source'] != str(source) or entry['signature'] != self.source_signature(source):
+            with self.lock:
+                owners = {owner for owner, pinned in self.pins.items() if pinned == key}
+                if owners:
+                    # Deployments run from this directory; keep it until they let go and fill elsewhere
+                    self.entries.pop(key, None)
+                    for owner in owners:
+                        del self.pins[owner]
+                    self.retired[entry['path'].name] = {'entry': entry, 'owners': owners}
+            if owners:
+                logger.info(f"Cached artifact {key} no longer matches {source}; refetching beside the copy "
+                            f"in use by {sorted(owners)}")
+            else:
+                logger.info(f"Cached artifact {key} no longer matches {source}; refetching")
+                self._evict(key)
+            return None
+        entry['verified_at'] = time.time()
+        return entry
+
+    def _fill(self, key, source, evict=True, min_free_bytes=0):
+        signature = self.source_signature(source)
+        needed = sum(size for _, size, _ in signature)
+        if shutil.disk_usage(self.root).free - needed < min_free_bytes:
+            logger.warning(f"Not caching {source}: it would leave less than {min_free_bytes} bytes free")
+            return None
+        if not self._make_room(needed, evict):
+            logger.warning(f"No room in artifact cache for {source} ({needed} bytes); using NFS directly")
+            return None
+
+        expected = self._registry_manifest(source)
+        staging = self.root / f".partial-{key}-{uuid.uuid4().hex[:8]}"
+        started = time.time()
+        try:
+            files = {}
+            for relative_path, size, _ in signature:
+                # Other writers may be filling the disk too; give up rather than run it dry
+                if min_free_bytes and shutil.disk_usage(self.root).free - size < min_free_bytes:
+                    raise IOError(f"disk space fell below {min_free_bytes} bytes free")
+                target = staging / relative_path
+                target.parent.mkdir(parents=True, exist_ok=True)
+                digest = hashlib.sha256()
+                written = 0
+                with open(Path(source) / relative_path, 'rb') as src, open(target, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                        dst.write(chunk)
+                        written += len(chunk)
+                # Sandboxed deployments link to cached files, so they must not be able to write through
+                os.chmod(target, 0o444)
+                sha256 = digest.hexdigest()
+                if written != size:
+                    raise IOError(f"{relative_path} changed while copying ({written} of {size} bytes)")
+                if relative_path in expected and expected[relative_path] != sha256:
+                    raise IOError(f"{relative_path} does not match the registry manifest")
+                files[relative_path] = {'size': size, 'sha256': sha256}
+
+            manifest = {'source': str(source), 'bytes': needed, 'signature': signature, 'files': files}
+            with open(staging / self.MANIFEST, 'w') as f:
+                json.dump(manifest, f)
+            final_path = self.root / key
+            with self.lock:
+                if final_path.name in self.retired:
+                    # '+' never appears in a key, so this cannot collide with another version
+                    final_path = self.root / f"{key}+{uuid.uuid4().hex[:8]}"
+            shutil.rmtree(final_path, ignore_errors=True)
+            os.rename(staging, final_path)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            with self.lock:
+                self.reserved -= needed
+            raise
+
+        entry = {'path': final_path, 'source': str(source), 'bytes': needed, 'signature': signature,
+                 'last_used': time.time(), 'verified_at': time.time()}
+        with self.lock:
+            self.reserved -= needed
+            self.entries[key] = entry
+        logger.info(f"Cached {source} as {key}: {needed} bytes in {time.time() - started:.1f}s")
+        return entry
+
+    def _registry_manifest(self, source):
+        """{relative path: sha256} recorded by the registry for a version, or {} when it has none"""
+        # Versions live at <NFS root>/<model_id>/v<version>, as the registry lays them out
+        source = Path(source)
+        version = source.name[1:] if source.name.startswith('v') else source.name
+        url = f"{MODEL_REGISTRY_URL}/registry/artifacts/{source.parent.name}/{version}/manifest"
+        try:
+            response = requests.get(url, timeout=10)
+            if not response.ok:
+                logger.info(f"No registry manifest for {source}: {response.status_code}")
+                return {}
+            return {item['path']: item['sha256'] for item in response.json().get('files', [])}
+        except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Could not fetch the registry manifest for {source}: {str(e)}")
+            return {}
+
+    def _make_room(self, needed, evict=True):
+        """Evict least recently used unpinned versions until `needed` bytes fit; reserves them on success"""
+        if needed > self.max_bytes:
+            return False
+        victims = []
+        with self.lock:
+            pinned = set(self.pins.values())
+            candidates = sorted((entry['last_used'], key) for key, entry in self.entries.items()
+                                if evict and key not in pinned)
+            used = self.used_bytes() + self.reserved
+            while used + needed > self.max_bytes and candidates:
+                _, key = candidates.pop(0)
+                used -= self.entries[key]['bytes']
+                victims.append((key, self.entries.pop(key)))
+            if used + needed > self.max_bytes:
+                # Not enough unpinned space: put the candidates back untouched
+                for key, entry in victims:
+                    self.entries[key] = entry
+                return False
+            self.reserved += needed
+        for key, entry in victims:
+            logger.info(f"Evicting {key} from artifact cache ({entry['bytes']} bytes)")
+            self._remove_path(entry['path'])
+        return True
+
+    def _evict(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry:
+            self._remove_path(entry['path'])
+
+    def _remove_path(self, path):
+        # Rename first so a half-deleted directory is never mistaken for a cached version
+        doomed = self.root / f".evict-{path.name}-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(path, doomed)
+        except OSError:
+            return
+        shutil.rmtree(doomed, ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'versions': len(self.entries),
+                'used_bytes': self.used_bytes(),
+                'max_bytes': self.max_bytes,
+                'pinned': len(set(self.pins.values())),
+                'superseded_in_use': len(self.retired)
+            }
+
+def lower_thread_priority():
+    """Drop the calling thread, and anything it spawns, to idle I/O class and the lowest CPU priority"""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not lower CPU priority of thread {tid}: {str(e)}")
+    try:
+        psutil.Process(tid).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError, AttributeError) as e:
+        logger.warning(f"Could not set idle I/O priority on thread {tid}: {str(e)}")
+
+def disk_space_tight(path, min_free_bytes=PREFETCH_MIN_FREE_BYTES):
+    return shutil.disk_usage(path).free < min_free_bytes
+
+class ArtifactPrefetcher:
+    """Warms the artifact cache and dependency caches for versions likely to be deployed here.
+
+    Work is queued and handled by one background thread running at idle I/O and
+    lowest CPU priority, so a prefetch never competes with a deploy. Nothing is
+    evicted to make room, and work is skipped once free disk space drops below
+    PREFETCH_MIN_FREE_BYTES.
+    """
+
+    def __init__(self, artifact_cache, runtimes):
+        self.artifact_cache = artifact_cache
+        self.runtimes = runtimes
+        self.queue = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.counts = {'completed': 0, 'skipped': 0, 'failed': 0}
+        threading.Thread(target=self._loop, daemon=True, name='prefetch').start()
+
+    def submit(self, model_id, version, source):
+        """Queue a version for warming; False if it is already queued or the queue is full"""
+        with self.lock:
+            if source in self.pending:
+                return False
+            try:
+                self.queue.put_nowait((model_id, version, source))
+            except queue.Full:
+                return False
+            self.pending.add(source)
+        logger.info(f"Queued prefetch of model {model_id} version {version}")
+        return True
+
+    def _loop(self):
+        lower_thread_priority()
+        while True:
+            model_id, version, source = self.queue.get()
+            try:
+                outcome = self._prefetch(source)
+            except Exception as e:
+                logger.error(f"Prefetch of model {model_id} version {version} failed: {str(e)}")
+                outcome = 'failed'
+            finally:
+                with self.lock:
+                    self.pending.discard(source)
+            with self.lock:
+                self.counts[outcome] += 1
+            logger.info(f"Prefetch of model {model_id} version {version}: {outcome}")
+
+    def _prefetch(self, source):
+        if disk_space_tight(self.artifact_cache.root):
+            return 'skipped'
+        if self.artifact_cache.enabled and not self.artifact_cache.warm(source, PREFETCH_MIN_FREE_BYTES):
+            # No room without evicting, or the fill would have left too little disk free
+            return 'skipped'
+
+        if disk_space_tight(WHEELHOUSE_DIR):
+            return 'skipped'
+        runtime = self.runtimes.get(read_model_meta(source).get('runtime', DEFAULT_RUNTIME))
+        if runtime:
+            runtime.warm_dependencies(source)
+        return 'completed'
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, queued=len(self.pending))
+
+# url -> (etag, details) of registry fetch-model answers, oldest first
+registry_lookups = {}
+registry_lookup_lock = threading.Lock()
+
+def fetch_model_details(model_id, version=None):
+    """Look a model version (or the latest one) up in the registry; returns (details, error)"""
+    version = str(version) if version is not None else None
+    if version and version != "latest":
+        # Strip 'v' prefix if present
+        version_param = version[1:] if version.startswith('v') else version
+        url = f"{MODEL_REGISTRY_URL}/registry/fetch-model/{model_id}/{version_param}"
+    else:
+        url = f"{MODEL_REGISTRY_URL}/registry/fetch-model/{model_id}"
+
+    # Revalidate the last answer for this URL; an unchanged lookup comes back as a bodyless 304
+    with registry_lookup_lock:
+        cached = registry_lookups.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    registry_response = requests.get(url, headers=headers, timeout=10)
+    if registry_response.status_code == 304 and cached:
+        return cached[1], None
+    if not registry_response.ok:
+        logger.error(f"Failed to get model details: {registry_response.status_code} - {registry_response.text}")
+        return None, f"Model registry error: {registry_response.status_code}"
+    
+    details = registry_response.json()
+    etag = registry_response.headers.get("ETag")
+    if etag:
+        with registry_lookup_lock:
+            registry_lookups[url] = (etag, details)
+            while len(registry_lookups) > REGISTRY_LOOKUP_CACHE_SIZE:
+                registry_lookups.pop(next(iter(registry_lookups)))
+    return details, None
+
+def model_bundle_dir(host_app_path):
+    """Where the registry puts a version's bundle: <model>/v<N>.bundle, next to the NFS version directory"""
+    host_app_path = Path(host_app_path)
+    return host_app_path.with_name(host_app_path.name + MODEL_BUNDLE_SUFFIX)
+
+def bundle_lock_file(bundle_path):
+    """The registry-built requirements.lock in a bundle directory, or None if there is no bundle"""
+    if not bundle_path:
+        return None
+    lock_file = Path(bundle_path) / "requirements.lock"
+    return lock_file if lock_file.exists() else None
+
+def model_ports(host_app_path):
+    """{'backend'|'frontend': guest port} a model serves on.
+
+    meta.json's "ports" block is authoritative; without one, each app file the
+    version ships (app.py, webapp.py) declares its default port.
+    """
+    declared = read_model_meta(host_app_path).get('ports')
+    if not isinstance(declared, dict):
+        declared = {role: port for role, port, app in (('backend', DEFAULT_BACKEND_PORT, 'app.py'),
+                                                        ('frontend', DEFAULT_FRONTEND_PORT, 'webapp.py'))
+                    if (Path(host_app_path) / app).exists()}
+    ports = {}
+    for role in ('backend', 'frontend'):
+        if role not in declared:
+            continue
+        try:
+            ports[role] = int(declared[role])
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring invalid {role} port {declared[role]!r} in {host_app_path}/meta.json")
+    return ports
+
+def read_model_meta(host_app_path):
+    """Load meta.json from a model version directory, or {} if it is missing or unreadable"""
+    meta_path = Path(host_app_path) / "meta.json"
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta if isinstance(meta, dict) else {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read {meta_path}: {str(e)}")
+        return {}
+
+def http_responds(port, host='127.0.0.1'):
+    """True once an HTTP server answers on the port with any status; a listening socket alone is not enough"""
+    try:
+        requests.get(f"http://{host}:{port}/", timeout=2)
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+def wait_for_ready(ports, deadline, job=None, process=None):
+    """Poll until every port answers HTTP; returns the ports still not ready when the deadline passes"""
+    pending = [port for port in ports if port]
+    while pending and time.time() < deadline:
+        if job is not None and job.cancel_requested.is_set():
+            raise JobCancelled()
+        if process is not None and process.poll() is not None:
+            break
+        pending = [port for port in pending if not http_responds(port)]
+        if pending:
+            time.sleep(1)
+    return pending
+
+class StartupHistograms:
+    """Cumulative histograms of deployment startup phase durations, rendered in Prometheus text format"""
+
+    def __init__(self, buckets=STARTUP_PHASE_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # (phase, runtime) -> {'buckets': [...], 'sum': float, 'count': int}
+        self.lock = threading.Lock()
+
+    def observe(self, phase, runtime, seconds):
+        with self.lock:
+            series = self.series.setdefault((phase, runtime), {
+                'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0
+            })
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+
+    def render(self):
+        name = 'agent_deployment_startup_seconds'
+        lines = [
+            f"# HELP {name} Time spent in each deployment startup phase",
+            f"# TYPE {name} histogram"
+        ]
+        with self.lock:
+            for (phase, runtime), series in sorted(self.series.items()):
+                labels = f'phase="{phase}",runtime="{runtime}"'
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{name}_sum{{{labels}}} {series["sum"]:.3f}')
+                lines.append(f'{name}_count{{{labels}}} {series["count"]}')
+        return "\n".join(lines) + "\n"
+
+class DeploymentRuntime(ABC):
+    """Interface implemented by every backend that can host a model deployment"""
+
+    name = None
+    ports_needed = 1
+
+    @abstractmethod
+    def provision(self, job):
+        """Bring the deployment up, blocking until it is started; returns extra record fields"""
+
+    @abstractmethod
+    def interrupt(self, job):
+        """Abort an in-flight provision() for a cancelled job"""
+
+    @abstractmethod
+    def destroy(self, deployment_id, record=None):
+        """Tear down a deployment; the caller removes its directory afterwards"""
+
+    @abstractmethod
+    def state(self, deployment_id, record):
+        """Current state of a deployment this runtime provisioned"""
+
+    def warm_dependencies(self, host_app_path):
+        """Download the model's Python requirements into the wheelhouse ahead of a deploy"""
+        requirements = Path(host_app_path) / "requirements.txt"
+        if not requirements.exists() or not requirements.read_text().strip():
+            return
+        if bundle_lock_file(model_bundle_dir(host_app_path)):
+            # The registry already shipped every wheel with the version
+            return
+        subprocess.run([sys.executable, "-m", "pip", "download", "--quiet", "-r", str(requirements),
+                        "-d", str(WHEELHOUSE_DIR)], check=True)
+
+class VagrantRuntime(DeploymentRuntime):
+    """One VirtualBox VM per deployment, booted with `vagrant up`"""
+
+    name = 'vagrant'
+    ports_needed = 2  # frontend (host_port) + backend, forwarded to the guest ports in meta.json
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def provision(self, job):
+        folder_path = DEPLOYMENTS_DIR / job.deployment_id
+        guest_ports = model_ports(job.host_app_path)
+        (folder_path / "Vagrantfile").write_text(
+            generate_vagrantfile(job.host_app_path, job.host_port, job.backend_port,
+                                 job.bundle_path if bundle_lock_file(job.bundle_path) else None, guest_ports))
+        if job.cancel_requested.is_set():
+            raise JobCancelled()
+
+        # Own session so cancellation can signal vagrant and its children together
+        started = time.time()
+        marks = {}
+        job.process = subprocess.Popen(["vagrant", "up"], cwd=folder_path, start_new_session=True,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in job.process.stdout:
+            logger.debug(f"[{job.deployment_id}] {line.rstrip()}")
+            match = re.search(r'MLOPS_PHASE (\w+)', line)
+            if match:
+                marks.setdefault(match.group(1), time.time())
+        returncode = job.process.wait()
+
+        if job.cancel_requested.is_set():
+            raise JobCancelled()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ["vagrant", "up"])
+
+        self.inventory.request_refresh()
+        # The provisioner only launches the apps; they count as up once every forwarded port answers
+        launched = marks.get('launch', time.time())
+        forwarded = [job.host_port if 'frontend' in guest_ports else None,
+                     job.backend_port if 'backend' in guest_ports else None]
+        not_ready = wait_for_ready(forwarded, time.time() + READINESS_TIMEOUT, job)
+        if not_ready:
+            raise RuntimeError(f"Deployment did not answer on port(s) {not_ready} within {READINESS_TIMEOUT}s of booting")
+        ready = time.time()
+
+        job.phases = {'boot': marks.get('provision', launched) - started, 'app_start': ready - launched}
+        if 'install' in marks:
+            job.phases['install'] = launched - marks['install']
+
+        # Read the address once here so /status never has to ssh into the VM
+        return {'vm_ip': get_vm_bridge_ip(folder_path), 'backend_port': job.backend_port,
+                'guest_frontend_port': guest_ports.get('frontend')}
+
+    def interrupt(self, job):
+        process = job.process
+        if process and process.poll() is None:
+            logger.info(f"Interrupting vagrant for job {job.job_id}")
+            try:
+                os.killpg(process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def destroy(self, deployment_id, record=None):
+        folder_path = DEPLOYMENTS_DIR / deployment_id
+        if (folder_path / "Vagrantfile").exists():
+            subprocess.run(["vagrant", "destroy", "-f"], cwd=folder_path, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.inventory.request_refresh()
+
+    def state(self, deployment_id, record):
+        vms, _, _ = self.inventory.snapshot()
+        return vms.get(deployment_id, {}).get('state', 'unknown')
+
+class SandboxRuntime(DeploymentRuntime):
+    """Runs a trusted model's app.py/webapp.py as a process group on the host.
+
+    The process tree gets its own PID/IPC/UTS namespaces via unshare(1) when the
+    host allows it, cgroup v2 CPU/memory/pids limits when the hierarchy is
+    writable, and a virtualenv shared by every model with the same
+    requirements.txt. Missing kernel features degrade to a plain process group.
+    """
+
+    name = 'sandbox'
+    ports_needed = 2  # frontend (host_port) + backend
+
+    def __init__(self):
+        self.processes = {}  # deployment_id -> Popen
+        self.lock = threading.Lock()
+        self.venv_locks = {}
+        SANDBOX_VENV_DIR.mkdir(parents=True, exist_ok=True)
+        self.unshare_prefix = self._detect_unshare()
+        self.cgroup_root = self._detect_cgroup_root()
+        logger.info(f"Sandbox runtime ready (namespaces: {bool(self.unshare_prefix)}, cgroups: {self.cgroup_root})")
+
+    def _detect_unshare(self):
+        if not shutil.which("unshare"):
+            logger.warning("unshare not found; sandboxed deployments will share the host namespaces")
+            return []
+        # --kill-child: the namespace's init ignores SIGTERM, so let unshare take it down on exit
+        candidates = [["unshare", "--pid", "--fork", "--kill-child", "--mount-proc", "--ipc", "--uts"]]
+        if os.geteuid() != 0:
+            candidates.append(["unshare", "--user", "--map-root-user", "--pid", "--fork", "--kill-child",
+                               "--mount-proc", "--ipc", "--uts"])
+        for prefix in candidates:
+            probe = subprocess.run(prefix + ["true"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if probe.returncode == 0:
+                return prefix
+        logger.warning("unshare is not permitted here; sandboxed deployments will share the host namespaces")
+        return []
+
+    def _detect_cgroup_root(self):
+        if not Path("/sys/fs/cgroup/cgroup.controllers").exists():
+            logger.warning("cgroup v2 hierarchy not mounted; sandbox resource limits disabled")
+            return None
+        try:
+            SANDBOX_CGROUP_ROOT.mkdir(exist_ok=True)
+            (SANDBOX_CGROUP_ROOT / "cgroup.subtree_control").write_text("+cpu +memory +pids")
+        except OSError as e:
+            logger.warning(f"Cannot use cgroup {SANDBOX_CGROUP_ROOT}: {str(e)}; sandbox resource limits disabled")
+            return None
+        try:
+            # Only for usage accounting; the parent may not delegate io
+            (SANDBOX_CGROUP_ROOT / "cgroup.subtree_control").write_text("+io")
+        except OSError as e:
+            logger.info(f"io controller unavailable under {SANDBOX_CGROUP_ROOT}: {str(e)}; sandbox disk I/O not tracked")
+        return SANDBOX_CGROUP_ROOT
+
+    def _create_cgroup(self, deployment_id):
+        if not self.cgroup_root:
+            return None
+        cgroup = self.cgroup_root / deployment_id
+        try:
+            cgroup.mkdir(exist_ok=True)
+            (cgroup / "memory.max").write_text(str(SANDBOX_MEMORY_MB * 1024 * 1024))
+            (cgroup / "cpu.max").write_text(f"{int(SANDBOX_CPUS * 100000)} 100000")
+            (cgroup / "pids.max").write_text(str(SANDBOX_PIDS_MAX))
+            return cgroup
+        except OSError as e:
+            logger.warning(f"Could not set up cgroup for {deployment_id}: {str(e)}")
+            return None
+
+    def _ensure_venv(self, host_app_path, bundle_path):
+        """Create (once) the virtualenv for this model's requirements and return its path"""
+        requirements = Path(host_app_path) / "requirements.txt"
+        content = requirements.read_bytes() if requirements.exists() else b""
+        venv_key = hashlib.sha256(content).hexdigest()[:16]
+        venv_dir = SANDBOX_VENV_DIR.resolve() / venv_key
+
+        with self.lock:
+            venv_lock = self.venv_locks.setdefault(venv_key, threading.Lock())
+        with venv_lock:
+            if (venv_dir / ".ready").exists():
+                return venv_dir
+            logger.info(f"Building sandbox venv {venv_dir}")
+            shutil.rmtree(venv_dir, ignore_errors=True)
+            subprocess.run(["python3", "-m", "venv", str(venv_dir)], check=True)
+            if content.strip() and not self._install_bundle(venv_dir, bundle_path):
+                subprocess.run([str(venv_dir / "bin" / "pip"), "install", "--find-links", str(WHEELHOUSE_DIR),
+                                "-r", str(requirements)], check=True)
+            (venv_dir / ".ready").touch()
+            return venv_dir
+
+    @staticmethod
+    def _install_bundle(venv_dir, bundle_path):
+        """Install from the registry's offline bundle; False if there is none or it does not fit this host"""
+        lock_file = bundle_lock_file(bundle_path)
+        if lock_file is None:
+            return False
+        result = subprocess.run([str(venv_dir / "bin" / "pip"), "install", "--no-index",
+                                 "--find-links", str(lock_file.parent / "wheels"), "-r", str(lock_file)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.warning(f"Bundle install from {bundle_path} failed, resolving online: {result.stderr.strip()[-500:]}")
+            return False
+        return True
+
+    @staticmethod
+    def _stage_app(source, app_dir):
+        """Lay the model files out in app_dir without letting the app write to the shared copies.
+
+        Small files are copied so the app may still modify them, as in the VM
+        provisioner. Larger ones are symlinked only when we could not write to
+        the target anyway (a read-only mount, or a cache file for an agent not
+        running as root); otherwise they are copied.
+        """
+        for dirpath, _, filenames in os.walk(source):
+            target_dir = app_dir / Path(dirpath).relative_to(source)
+            target_dir.mkdir(parents=True, exist_ok=True)
+            for name in filenames:
+                item = Path(dirpath) / name
+                if item.stat().st_size > MODEL_COPY_MAX_BYTES and not os.access(item, os.W_OK):
+                    (target_dir / name).symlink_to(item.resolve())
+                else:
+                    shutil.copyfile(item, target_dir / name)
+
+    def warm_dependencies(self, host_app_path):
+        # Sandboxed deployments share venvs, so building it now takes the install off the deploy path
+        self._ensure_venv(host_app_path, model_bundle_dir(host_app_path))
+
+    def provision(self, job):
+        folder_path = DEPLOYMENTS_DIR / job.deployment_id
+        app_dir = folder_path / "app"
+        app_dir.mkdir(exist_ok=True)
+        self._stage_app(Path(job.host_app_path), app_dir)
+
+        install_started = time.time()
+        venv_dir = self._ensure_venv(job.host_app_path, job.bundle_path)
+        if job.cancel_requested.is_set():
+            raise JobCancelled()
+        launched = time.time()
+
+        python_bin = venv_dir / "bin" / "python"
+        backend = f"{python_bin} app.py > backend.log 2>&1"
+        if (app_dir / "webapp.py").exists():
+            app_port = job.backend_port
+            script = (f"{backend} & exec {python_bin} -m streamlit run webapp.py --server.port={job.host_port} "
+                      f"--server.address=0.0.0.0 --server.headless=true > frontend.log 2>&1")
+        else:
+            # No frontend: app.py itself is what access_url points at
+            app_port = job.host_port
+            script = f"exec {backend}"
+
+        # Only what the model needs; the agent's own settings and credentials stay out of the sandbox
+        env = {
+            'PATH': f"{venv_dir / 'bin'}:/usr/local/bin:/usr/bin:/bin",
+            'HOME': str(folder_path.absolute()),
+            'LANG': os.environ.get('LANG', 'C.UTF-8'),
+            'VIRTUAL_ENV': str(venv_dir),
+            'PORT': str(app_port),
+            'BACKEND_PORT': str(app_port),
+            'FRONTEND_PORT': str(job.host_port),
+        }
+        cgroup = self._create_cgroup(job.deployment_id)
+
+        # The leader waits on stdin until the agent has moved it into the cgroup,
+        # so everything it goes on to start is created inside it
+        process = subprocess.Popen(
+            ["sh", "-c", 'read -r _; exec "$@"', "sh"] + self.unshare_prefix + ["sh", "-c", script],
+            cwd=app_dir, env=env, start_new_session=True, stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        job.process = process
+        with self.lock:
+            self.processes[job.deployment_id] = process
+        if cgroup:
+            try:
+                (cgroup / "cgroup.procs").write_text(str(process.pid))
+            except OSError as e:
+                logger.warning(f"Could not move {job.deployment_id} into {cgroup}: {str(e)}")
+                cgroup = None
+        try:
+            process.stdin.write(b"\n")
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # already gone; the readiness wait reports it
+
+        ports = [job.host_port, app_port if app_port != job.host_port else None]
+        not_ready = wait_for_ready(ports, time.time() + SANDBOX_START_TIMEOUT, job, process)
+        if not_ready:
+            raise RuntimeError(f"Sandbox did not answer on port(s) {not_ready} within {SANDBOX_START_TIMEOUT}s")
+        job.phases = {'install': launched - install_started, 'app_start': time.time() - launched}
+
+        return {'pid': process.pid, 'cgroup': str(cgroup) if cgroup else None, 'backend_port': job.backend_port}
+
+    def interrupt(self, job):
+        process = job.process
+        if process and process.poll() is None:
+            logger.info(f"Killing sandbox for job {job.job_id}")
+            self._kill_group(process.pid)
+
+    def _kill_group(self, pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        for _ in range(20):
+            if not psutil.pid_exists(pid):
+                return
+            time.sleep(0.25)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def destroy(self, deployment_id, record=None):
+        with self.lock:
+            process = self.processes.pop(deployment_id, None)
+        pid = process.pid if process else (record or {}).get('pid')
+        if pid:
+            self._kill_group(pid)
+        if process:
+            process.wait(timeout=10)
+
+        cgroup = (record or {}).get('cgroup') or (self.cgroup_root / deployment_id if self.cgroup_root else None)
+        if cgroup and Path(cgroup).exists():
+            kill_file = Path(cgroup) / "cgroup.kill"
+            try:
+                if kill_file.exists():
+                    kill_file.write_text("1")
+                Path(cgroup).rmdir()
+            except OSError as e:
+                logger.warning(f"Could not remove cgroup {cgroup}: {str(e)}")
+
+    def state(self, deployment_id, record):
+        with self.lock:
+            process = self.processes.get(deployment_id)
+        if process:
+            return 'running' if process.poll() is None else 'stopped'
+        pid = record.get('pid')
+        return 'running' if pid and psutil.pid_exists(pid) else 'stopped'
+
+DEPLOYMENT_USAGE_FIELDS = ['cpu_percent', 'rss_bytes', 'disk_bytes', 'disk_read_bps', 'disk_write_bps', 'net_rx_bps', 'net_tx_bps']
+HYPERVISOR_PROCESS_NAMES = ('VBoxHeadless', 'VirtualBoxVM')
+VM_DISK_EXTENSIONS = ('.vdi', '.vmdk', '.vhd')
+RATE_UNITS = {'B/s': 1, 'kB/s': 1000, 'KB/s': 1024, 'MB/s': 1024 ** 2, 'GB/s': 1024 ** 3}
+
+def read_cgroup_stat(path):
+    """Parse a flat `key value` cgroup file such as cpu.stat into a dict of ints"""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                stats[parts[0]] = int(parts[1])
+    return stats
+
+def read_cgroup_io(path):
+    """Sum rbytes/wbytes across all devices in a cgroup io.stat file; 0/0 when the io controller is off"""
+    read_bytes = write_bytes = 0
+    if not os.path.exists(path):
+        return read_bytes, write_bytes
+    with open(path) as f:
+        for line in f:
+            for field in line.split()[1:]:
+                key, _, value = field.partition('=')
+                if key == 'rbytes':
+                    read_bytes += int(value)
+                elif key == 'wbytes':
+                    write_bytes += int(value)
+    return read_bytes, write_bytes
+
+class DeploymentUsageTracker:
+    """Attributes CPU, memory, disk and network usage on this host to individual deployments.
+
+    Vagrant deployments are matched to their VirtualBox hypervisor process through the
+    machine UUID vagrant stores in .vagrant/machines/default/virtualbox/id; sandbox
+    deployments are read from their cgroup, or their process tree when cgroups are off.
+    """
+
+    def __init__(self, deployment_records, inventory):
+        self.deployment_records = deployment_records
+        self.inventory = inventory
+        self.processes = {}  # pid -> psutil.Process, kept so cpu_percent() has a baseline
+        self.previous = {}  # (deployment_id, counter) -> (timestamp, value)
+        self.vboxmanage = shutil.which("VBoxManage")
+        self.vbox_metrics_enabled = set()  # VM UUIDs with network metrics collection set up
+
+    def _process(self, pid):
+        process = self.processes.get(pid)
+        if process is None or not process.is_running():
+            process = psutil.Process(pid)
+            process.cpu_percent(None)
+            self.processes[pid] = process
+        return process
+
+    def _rate(self, deployment_id, counter, value, now):
+        """Turn a cumulative counter into a per-second rate since the previous sample"""
+        previous = self.previous.get((deployment_id, counter))
+        self.previous[(deployment_id, counter)] = (now, value)
+        if not previous or now <= previous[0] or value < previous[1]:
+            return 0.0
+        return (value - previous[1]) / (now - previous[0])
+
+    def _hypervisors(self):
+        """Map VirtualBox machine UUID -> (pid, vm_name) for every running hypervisor process"""
+        hypervisors = {}
+        for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
+            if proc.info['name'] not in HYPERVISOR_PROCESS_NAMES:
+                continue
+            cmdline = proc.info['cmdline'] or []
+            args = dict(zip(cmdline, cmdline[1:]))
+            vm_uuid = args.get('--startvm')
+            if vm_uuid:
+                hypervisors[vm_uuid] = (proc.info['pid'], args.get('--comment'))
+        return hypervisors
+
+    def _vm_network_rates(self, vm_uuids):
+        """Network rates per VM name from one `VBoxManage metrics query` call"""
+        if not self.vboxmanage or not vm_uuids:
+            return {}
+        try:
+            for vm_uuid in set(vm_uuids) - self.vbox_metrics_enabled:
+                subprocess.run([self.vboxmanage, "metrics", "setup", "--period", str(METRICS_INTERVAL), "--samples", "1",
+                                vm_uuid, "Net/Rate/Rx,Net/Rate/Tx"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+                self.vbox_metrics_enabled.add(vm_uuid)
+
+            result = subprocess.run([self.vboxmanage, "metrics", "query", "*", "Net/Rate/Rx,Net/Rate/Tx"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=10)
+            rates = {}
+            for line in result.stdout.splitlines():
+                parts = line.split()
+                if len(parts) < 4 or not parts[1].startswith('Net/Rate/'):
+                    continue
+                try:
+                    value = float(parts[2]) * RATE_UNITS.get(parts[3], 1)
+                except ValueError:
+                    continue
+                direction = 'rx' if parts[1].endswith('Rx') else 'tx'
+                rates.setdefault(parts[0], {})[direction] = value
+            return rates
+        except Exception as e:
+            logger.debug(f"Could not query VirtualBox network metrics: {str(e)}")
+            return {}
+
+    def _vm_usage(self, deployment_id, path, hypervisors, now):
+        try:
+            vm_uuid = (Path(path) / ".vagrant" / "machines" / "default" / "virtualbox" / "id").read_text().strip()
+        except OSError:
+            return None, None
+        if vm_uuid not in hypervisors:
+            return None, None
+
+        pid, vm_name = hypervisors[vm_uuid]
+        process = self._process(pid)
+        with process.oneshot():
+            cpu_percent = process.cpu_percent(None)
+            rss = process.memory_info().rss
+            io = process.io_counters()
+            disk_bytes = sum(os.path.getsize(f.path) for f in process.open_files()
+                             if f.path.endswith(VM_DISK_EXTENSIONS) and os.path.exists(f.path))
+        return [
+            cpu_percent,
+            rss,
+            disk_bytes,
+            self._rate(deployment_id, 'read', io.read_bytes, now),
+            self._rate(deployment_id, 'write', io.write_bytes, now),
+            None,
+            None
+        ], (vm_uuid, vm_name)
+
+    def _sandbox_usage(self, deployment_id, record, now):
+        cgroup = record.get('cgroup')
+        disk_bytes = sum(f.stat().st_size for f in Path(record.get('path', '.')).rglob('*')
+                         if f.is_file() and not f.is_symlink())
+
+        if cgroup and Path(cgroup).exists():
+            cpu_usec = read_cgroup_stat(Path(cgroup) / "cpu.stat").get('usage_usec', 0)
+            rss = int((Path(cgroup) / "memory.current").read_text())
+            read_bytes, write_bytes = read_cgroup_io(Path(cgroup) / "io.stat")
+            cpu_percent = self._rate(deployment_id, 'cpu_usec', cpu_usec, now) / 1e4
+        else:
+            pid = record.get('pid')
+            if not pid or not psutil.pid_exists(pid):
+                return None
+            root = psutil.Process(pid)
+            cpu_percent = rss = read_bytes = write_bytes = 0
+            for member in [root] + root.children(recursive=True):
+                try:
+                    process = self._process(member.pid)
+                    cpu_percent += process.cpu_percent(None)
+                    rss += process.memory_info().rss
+                    io = process.io_counters()
+                    read_bytes += io.read_bytes
+                    write_bytes += io.write_bytes
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+
+        # Sandboxes share the host network namespace, so their traffic cannot be attributed
+        return [
+            cpu_percent,
+            rss,
+            disk_bytes,
+            self._rate(deployment_id, 'read', read_bytes, now),
+            self._rate(deployment_id, 'write', write_bytes, now),
+            None,
+            None
+        ]
+
+    def sample(self):
+        """One compact sample: {'fields': [...], 'values': {deployment_id: [...]}}"""
+        now = time.time()
+        records = self.deployment_records.all()
+        vms, _, _ = self.inventory.snapshot()
+        hypervisors = None
+        values = {}
+        vm_names = {}
+
+        for deployment_id in set(records) | set(vms):
+            record = records.get(deployment_id, {})
+            try:
+                if record.get('runtime', 'vagrant') == 'vagrant':
+                    if hypervisors is None:
+                        hypervisors = self._hypervisors()
+                    path = vms.get(deployment_id, {}).get('path') or record.get('path')
+                    usage, vm = self._vm_usage(deployment_id, path, hypervisors, now) if path else (None, None)
+                    if vm:
+                        vm_names[vm[1]] = (deployment_id, vm[0])
+                else:
+                    usage = self._sandbox_usage(deployment_id, record, now)
+            except (psutil.Error, OSError, ValueError) as e:
+                logger.debug(f"Could not sample usage for deployment {deployment_id}: {str(e)}")
+                usage = None
+            if usage:
+                values[deployment_id] = usage
+
+        network = self._vm_network_rates([vm_uuid for _, vm_uuid in vm_names.values()])
+        for vm_name, rates in network.items():
+            if vm_name in vm_names:
+                deployment_id = vm_names[vm_name][0]
+                values[deployment_id][5] = rates.get('rx')
+                values[deployment_id][6] = rates.get('tx')
+
+        # Forget baselines of deployments that are gone
+        self.previous = {key: value for key, value in self.previous.items() if key[0] in values}
+        self.processes = {pid: process for pid, process in self.processes.items() if process.is_running()}
+
+        return {
+            'fields': DEPLOYMENT_USAGE_FIELDS,
+            'values': {deployment_id: [round(v, 2) if isinstance(v, float) else v for v in usage]
+                       for deployment_id, usage in values.items()}
+        }
+
+class ProvisioningJobManager:
+    """Provisions accepted deployments through their runtime on a bounded thread pool"""
+
+    def __init__(self, port_allocator, max_workers, deployment_records, runtimes, startup_histograms=None,
+                 artifact_cache=None):
+        self.port_allocator = port_allocator
+        self.startup_histograms = startup_histograms
+        self.artifact_cache = artifact_cache
+        self.deployment_records = deployment_records
+        self.runtimes = runtimes  # runtime name -> DeploymentRuntime
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='provision')
+        self.jobs = {}  # job_id -> ProvisioningJob
+        self.lock = threading.Lock()
+        logger.info(f"Provisioning executor started with {max_workers} worker(s)")
+
+    def submit(self, job):
+        with self.lock:
+            self._prune_finished_jobs()
+            self.jobs[job.job_id] = job
+        job.future = self.executor.submit(self._run, job)
+        logger.info(f"Accepted provisioning job {job.job_id} for deployment {job.deployment_id}")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def find_by_deployment(self, deployment_id):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.deployment_id == deployment_id:
+                    return job
+        return None
+
+    def queue_depth(self):
+        with self.lock:
+            return len([job for job in self.jobs.values() if job.status == 'queued'])
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job, or None if it does not exist"""
+        job = self.get(job_id)
+        if not job or job.finished:
+            return job
+
+        job.cancel_requested.set()
+        if job.future and job.future.cancel():
+            # Never started, so there is no VM to tear down
+            self._finish(job, 'cancelled')
+            self._cleanup(job, destroy=False)
+            return job
+
+        self.runtimes[job.runtime].interrupt(job)
+        return job
+
+    def _prune_finished_jobs(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        logger.info(f"Provisioning job {job.job_id} {status}" + (f": {error}" if error else ""))
+
+    def _cleanup(self, job, destroy=True):
+        if destroy:
+            try:
+                self.runtimes[job.runtime].destroy(job.deployment_id)
+            except Exception as e:
+                logger.error(f"Error tearing down deployment {job.deployment_id}: {str(e)}")
+        shutil.rmtree(DEPLOYMENTS_DIR / job.deployment_id, ignore_errors=True)
+        self.port_allocator.release(job.deployment_id)
+        if self.artifact_cache:
+            self.artifact_cache.release(job.deployment_id)
+
+    def _run(self, job):
+        if job.cancel_requested.is_set():
+            self._finish(job, 'cancelled')
+            self._cleanup(job, destroy=False)
+            return
+        job.status = 'running'
+        job.started_at = time.time()
+        logger.info(f"Provisioning deployment {job.deployment_id} ({job.runtime}) on port {job.host_port}")
+
+        try:
+            folder_path = DEPLOYMENTS_DIR / job.deployment_id
+            folder_path.mkdir(parents=True, exist_ok=True)
+            if job.cancel_requested.is_set():
+                raise JobCancelled()
+
+            if self.artifact_cache:
+                fetch_started = time.time()
+                job.host_app_path = self.artifact_cache.acquire(job.deployment_id, job.host_app_path)
+                job.phases['fetch'] = time.time() - fetch_started
+                if job.cancel_requested.is_set():
+                    raise JobCancelled()
+
+            details = self.runtimes[job.runtime].provision(job)
+
+            record = {
+                'model_id': job.model_id,
+                'version': job.version,
+                'runtime': job.runtime,
+                'host_port': job.host_port,
+                'access_url': job.access_url,
+                'path': str(folder_path.absolute()),
+                'artifact_path': job.host_app_path,
+                'created_at': time.time()
+            }
+            record.update(details or {})
+            self.deployment_records.put(job.deployment_id, record)
+            self._finish(job, 'succeeded')
+            if self.startup_histograms:
+                for phase, seconds in job.phases.items():
+                    self.startup_histograms.observe(phase, job.runtime, seconds)
+                self.startup_histograms.observe('total', job.runtime, job.finished_at - job.started_at)
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+            self._cleanup(job)
+        except Exception as e:
+            logger.error(f"Failed to provision VM for deployment {job.deployment_id}: {str(e)}", exc_info=True)
+            self._finish(job, 'failed', str(e))
+            self._cleanup(job)
+        finally:
+            job.process = None
+
+def parse_forwarded_host_ports(vagrantfile):
+    """Host ports forwarded by a generated Vagrantfile, in declaration order"""
+    try:
+        text = Path(vagrantfile).read_text()
+    except OSError:
+        return []
+    return [int(port) for port in re.findall(r'"forwarded_port".*?host:\s*(\d+)', text)]
+
+def reconcile_deployments(journal, deployment_records, inventory, runtimes, port_allocator):
+    """Check journaled deployments against what is actually running, using one inventory pass"""
+    journaled = journal.load()
+    inventory.refresh()
+    vms, _, inventory_error = inventory.snapshot()
+    if inventory_error:
+        logger.warning(f"VM inventory unavailable ({inventory_error}); keeping all journaled VM deployments")
+
+    reconciled = {}
+    for deployment_id, record in journaled.items():
+        runtime_name = record.get('runtime', 'vagrant')
+        if runtime_name == 'vagrant':
+            state = vms.get(deployment_id, {}).get('state')
+            alive = bool(inventory_error) or state not in (None, 'not_created')
+        elif runtime_name in runtimes:
+            state = runtimes[runtime_name].state(deployment_id, record)
+            alive = state == 'running'
+        else:
+            state, alive = 'unknown', False
+
+        if not alive:
+            logger.warning(f"Dropping journaled deployment {deployment_id}: {runtime_name} reports it as {state}")
+            if runtime_name in runtimes and runtime_name != 'vagrant':
+                try:
+                    runtimes[runtime_name].destroy(deployment_id, record)
+                except Exception as e:
+                    logger.error(f"Error cleaning up deployment {deployment_id}: {str(e)}")
+            shutil.rmtree(DEPLOYMENTS_DIR / deployment_id, ignore_errors=True)
+            continue
+        reconciled[deployment_id] = record
+
+    # VMs created before the journal existed still get a record, with the port read back from their Vagrantfile
+    for deployment_id, vm in vms.items():
+        if deployment_id in reconciled or vm.get('state') == 'not_created':
+            continue
+        ports = parse_forwarded_host_ports(Path(vm['path']) / "Vagrantfile")
+        host_port = ports[0] if ports else None
+        logger.info(f"Recovered unjournaled VM deployment {deployment_id} (port {host_port})")
+        reconciled[deployment_id] = {
+            'runtime': 'vagrant',
+            'host_port': host_port,
+            'backend_port': ports[1] if len(ports) > 1 else None,
+            'access_url': f"http://{AGENT_IP}:{host_port}" if host_port else None,
+            'path': vm['path'],
+            'recovered': True,
+            'created_at': time.time()
+        }
+
+    for deployment_id, record in reconciled.items():
+        port_allocator.claim(deployment_id, [record.get('host_port'), record.get('backend_port')])
+    deployment_records.load(reconciled)
+    logger.info(f"Reconciled {len(reconciled)} deployment(s) from journal ({len(journaled)} journaled)")
+    return reconciled
+
+def discover_controller_url():
+    """Look the controller up in the service registry"""
+    service_registry_url = f"http://{os.getenv('service_registry_ip')}:{os.getenv('service_registry_port')}/service-registry/getServiceInfo"
+    response = requests.get(service_registry_url, params={'name': 'controller'}, timeout=5)
+    response.raise_for_status()
+    result = response.json()['result']
+    return f"http://{result['ip']}:{result['port']}"
+
+def announce_deployments(deployment_records):
+    """Tell the controller which deployments this agent is still running, retrying until it answers"""
+    records = deployment_records.all()
+    payload = {
+        # The controller keys laptops by hostname (see the metrics 'system' block)
+        'laptop_id': socket.gethostname(),
+        'ip': AGENT_IP,
+        'port': AGENT_PORT,
+        'deployments': [
+            {
+                'deployment_id': deployment_id,
+                'model_id': record.get('model_id'),
+                'version': record.get('version'),
+                'runtime': record.get('runtime', 'vagrant'),
+                'access_url': record.get('access_url'),
+                'created_at': record.get('created_at')
+            }
+            for deployment_id, record in records.items()
+        ]
+    }
+
+    delay = 5
+    for attempt in range(1, ANNOUNCE_RETRIES + 1):
+        try:
+            response = requests.post(f"{discover_controller_url()}/controller/announce", json=payload, timeout=10)
+            if response.ok:
+                logger.info(f"Announced {len(records)} deployment(s) to the controller")
+                return True
+            logger.warning(f"Controller rejected deployment announcement: {response.status_code} - {response.text}")
+        except Exception as e:
+            logger.warning(f"Could not announce deployments to the controller (attempt {attempt}): {str(e)}")
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+    logger.error("Giving up announcing deployments to the controller")
+    return False
+
 # --- Flask App Factory ---
 def create_app():
     app = Flask(__name__)
@@ -971,10 +2657,37 @@ def create_app():
     # Initialize Kafka producer
     producer = init_kafka_producer()
     
+    # Ports and provisioning slots are shared by every request
+    port_allocator = PortAllocator(PORT_RANGE_START, PORT_RANGE_END)
+    deployment_journal = DeploymentJournal(DEPLOYMENT_JOURNAL_PATH)
+    deployment_records = DeploymentRecords(deployment_journal)
+    vm_inventory = VagrantInventory(INVENTORY_REFRESH_INTERVAL)
+
     # Initialize and start laptop metrics collector
-    laptop_metrics_collector = LaptopMetricsCollector(producer)
+    usage_tracker = DeploymentUsageTracker(deployment_records, vm_inventory)
+    laptop_metrics_collector = LaptopMetricsCollector(producer, usage_tracker)
     laptop_metrics_collector.start()
 
+    runtimes = {}
+    if 'vagrant' in ALLOWED_RUNTIMES:
+        runtimes['vagrant'] = VagrantRuntime(vm_inventory)
+    if 'sandbox' in ALLOWED_RUNTIMES:
+        runtimes['sandbox'] = SandboxRuntime()
+    startup_histograms = StartupHistograms()
+    artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_MAX_BYTES)
+    WHEELHOUSE_DIR.mkdir(parents=True, exist_ok=True)
+    prefetcher = ArtifactPrefetcher(artifact_cache, runtimes)
+    job_manager = ProvisioningJobManager(port_allocator, provisioning_capacity(), deployment_records, runtimes,
+                                         startup_histograms, artifact_cache)
+
+    # Pick up where a previous agent process left off instead of re-provisioning
+    reconcile_deployments(deployment_journal, deployment_records, vm_inventory, runtimes, port_allocator)
+    for deployment_id, record in deployment_records.all().items():
+        if record.get('artifact_path'):
+            artifact_cache.pin(deployment_id, record['artifact_path'])
+    vm_inventory.start()
+    threading.Thread(target=announce_deployments, args=(deployment_records,), daemon=True).start()
+
     @app.route('/')
     def index():
         return "Flask server with Vagrant is up."
@@ -985,58 +2698,81 @@ def create_app():
         model_id = data['model_id']
         version = data.get('version', None)
 
-        free_port = get_free_port()
-
-        if version and version != "latest":
-            # Strip 'v' prefix if present
-            version_param = version[1:] if version.startswith('v') else version
-            registry_response = requests.get(
-                f"{MODEL_REGISTRY_URL}/registry/fetch-model/{model_id}/{version_param}",
-                timeout=10
-            )
-        else:
-            registry_response = requests.get(
-                f"{MODEL_REGISTRY_URL}/registry/fetch-model/{model_id}",
-                timeout=10
-            )
-        
-        if not registry_response.ok:
-            logger.error(f"Failed to get model details: {registry_response.status_code} - {registry_response.text}")
+        model_details, error = fetch_model_details(model_id, version)
+        if error:
             return {
                 'success': False,
-                'error': f"Model registry error: {registry_response.status_code}"
+                'error': error
             }
-        
-        model_details = registry_response.json()
         host_app_path = model_details.get('path')
 
         if not host_app_path or not os.path.exists(host_app_path):
             return jsonify({"error": "Invalid host_app_path"}), 400
 
-        deploy_id = str(uuid.uuid4())[:8]
-        folder_path = Path(f"./deployments/{deploy_id}")
-        folder_path.mkdir(parents=True, exist_ok=True)
+        runtime_name = read_model_meta(host_app_path).get('runtime', DEFAULT_RUNTIME)
+        if runtime_name not in runtimes:
+            return jsonify({'success': False, 'error': f"Runtime '{runtime_name}' is not available on this agent"}), 400
 
-        adapter = get_bridge_adapter()
-        
-        vagrantfile_content = generate_vagrantfile(host_app_path, free_port)
-        (folder_path / "Vagrantfile").write_text(vagrantfile_content)
+        deploy_id = str(uuid.uuid4())[:8]
 
         try:
-            subprocess.run(["vagrant", "up"], cwd=folder_path, check=True)
-        except subprocess.CalledProcessError as e:
-            return jsonify({"error": "Failed to provision VM", "details": str(e)}), 500
+            ports = port_allocator.reserve(deploy_id, runtimes[runtime_name].ports_needed)
+        except RuntimeError as e:
+            logger.error(f"Cannot accept deployment for model {model_id}: {str(e)}")
+            return jsonify({'success': False, 'error': str(e)}), 503
 
-        # Return the known hardcoded port
+        host_port = ports[0]
+        backend_port = ports[1] if len(ports) > 1 else None
+        job = job_manager.submit(ProvisioningJob(deploy_id, model_id, version, host_app_path, host_port,
+                                                 runtime=runtime_name, backend_port=backend_port))
+
+        # The VM boots in the background; callers poll status_url for the outcome
         return jsonify({
             'success': True,
+            'job_id': job.job_id,
+            'status': job.status,
+            'status_url': f"http://{AGENT_IP}:{AGENT_PORT}/jobs/{job.job_id}",
             "deployment_id": deploy_id,
             "container_id" : deploy_id,
-            "host_port": free_port,
-            "access_url": f"http://{AGENT_IP}:{free_port}",
+            "host_port": host_port,
+            "access_url": job.access_url,
+            'runtime': runtime_name,
             'model_id': model_id,
             'version': version
-        })
+        }), 202
+
+    @app.route('/prefetch', methods=['POST'])
+    def prefetch_model():
+        """Warm local caches for a version the controller expects to be deployed here soon"""
+        data = request.get_json() or {}
+        model_id = data.get('model_id')
+        if not model_id:
+            return jsonify({'success': False, 'error': 'Missing model_id in request'}), 400
+
+        model_details, error = fetch_model_details(model_id, data.get('version'))
+        if error:
+            return jsonify({'success': False, 'error': error}), 502
+        host_app_path = model_details.get('path')
+        if not host_app_path or not os.path.exists(host_app_path):
+            return jsonify({'success': False, 'error': 'Invalid host_app_path'}), 400
+
+        queued = prefetcher.submit(model_id, model_details.get('version'), host_app_path)
+        return jsonify({'success': True, 'queued': queued, 'model_id': model_id,
+                        'version': model_details.get('version')}), 202
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def get_job(job_id):
+        job = job_manager.get(job_id)
+        if not job:
+            return jsonify({'success': False, 'error': f"Job {job_id} not found"}), 404
+        return jsonify(job.to_dict()), 200
+
+    @app.route('/jobs/<job_id>', methods=['DELETE'])
+    def cancel_job(job_id):
+        job = job_manager.cancel(job_id)
+        if not job:
+            return jsonify({'success': False, 'error': f"Job {job_id} not found"}), 404
+        return jsonify(job.to_dict()), 200
 
     @app.route('/stop-vm/<deployment_id>', methods=['POST'])
     def deprovision_vm(deployment_id):
@@ -1044,20 +2780,36 @@ def create_app():
         if not deployment_id:
             return jsonify({'success': False,"error": "Missing deployment_id"}), 400
 
-        folder_path = Path(f"./deployments/{deployment_id}")
+        # A deployment that is still provisioning is stopped by cancelling its job
+        job = job_manager.find_by_deployment(deployment_id)
+        if job and not job.finished:
+            job_manager.cancel(job.job_id)
+            return jsonify({'success': True, 'message': f"Provisioning of {deployment_id} cancelled", 'job': job.to_dict()})
+
+        folder_path = DEPLOYMENTS_DIR / deployment_id
         if not folder_path.exists():
             return jsonify({'success': False,"error": "Deployment not found"}), 404
 
+        # Deployments from before runtimes were recorded are always Vagrant VMs
+        record = deployment_records.get(deployment_id) or {}
+        runtime = runtimes.get(record.get('runtime', 'vagrant'))
+        if not runtime:
+            return jsonify({'success': False, 'error': f"Runtime '{record.get('runtime')}' is not available on this agent"}), 500
+
         try:
-            subprocess.run(["vagrant", "destroy", "-f"], cwd=folder_path, check=True)
+            runtime.destroy(deployment_id, record)
         except subprocess.CalledProcessError as e:
             return jsonify({'success': False,'error': f"Failed to stop VM {deployment_id}"}), 500
 
+        port_allocator.release(deployment_id)
+        artifact_cache.release(deployment_id)
+        deployment_records.remove(deployment_id)
+        vm_inventory.request_refresh()
+
         # Optionally remove the folder (clean-up)
         try:
-            for child in folder_path.glob("*"):
-                child.unlink()
-            folder_path.rmdir()
+            # rmtree unlinks symlinked model files without touching their NFS targets
+            shutil.rmtree(folder_path)
         except Exception as e:
             return jsonify({'success': True,"message": "VM destroyed, but cleanup failed", "details": str(e)}), 200
 
@@ -1072,62 +2824,31 @@ def create_app():
         cpu_percent = psutil.cpu_percent()
         memory = psutil.virtual_memory()
         
-        # Get all vagrant VMs
+        # Answer from the cached inventory and deployment records - no vagrant calls here
+        inventory_vms, inventory_refreshed_at, inventory_error = vm_inventory.snapshot()
+        records = deployment_records.all()
+
         vagrant_vms = []
-        deployments_dir = Path("./deployments")
-        if deployments_dir.exists():
-            for vm_dir in deployments_dir.iterdir():
-                if vm_dir.is_dir():
-                    try:
-                        # Try to get VM status
-                        status_output = subprocess.run(
-                            ["vagrant", "status"], 
-                            cwd=vm_dir, 
-                            stdout=subprocess.PIPE, 
-                            stderr=subprocess.PIPE, 
-                            text=True
-                        )
-                        vm_status = "unknown"
-                        for line in status_output.stdout.splitlines():
-                            if "default" in line:
-                                if "running" in line.lower():
-                                    vm_status = "running"
-                                elif "poweroff" in line.lower() or "stopped" in line.lower():
-                                    vm_status = "stopped"
-                                break
-                        
-                        # Try to get VM IP if running
-                        vm_ip = None
-                        if vm_status == "running":
-                            try:
-                                bridge_ip_cmd = "ip -o -4 addr show | grep enp0s8 | awk '{print $4}' | cut -d'/' -f1"
-                                ip_result = subprocess.run(
-                                    ["vagrant", "ssh", "-c", bridge_ip_cmd],
-                                    cwd=vm_dir,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    text=True,
-                                    check=True
-                                )
-                                vm_ip = ip_result.stdout.strip().splitlines()[0]
-                            except:
-                                pass
-                        
-                        vagrant_vms.append({
-                            'deployment_id': vm_dir.name,
-                            'status': vm_status,
-                            'path': str(vm_dir.absolute()),
-                            'ip': vm_ip,
-                            'url': f"http://{vm_ip}:8051" if vm_ip else None
-                        })
-                    except Exception as e:
-                        logger.error(f"Error getting status for VM {vm_dir.name}: {str(e)}")
-                        vagrant_vms.append({
-                            'deployment_id': vm_dir.name,
-                            'status': 'error',
-                            'path': str(vm_dir.absolute()),
-                            'error': str(e)
-                        })
+        for deployment_id in sorted(set(inventory_vms) | set(records)):
+            vm = inventory_vms.get(deployment_id, {})
+            record = records.get(deployment_id, {})
+            runtime_name = record.get('runtime', 'vagrant')
+            if runtime_name == 'vagrant':
+                vm_status = vm.get('state', 'unknown')
+            else:
+                vm_status = runtimes[runtime_name].state(deployment_id, record) if runtime_name in runtimes else 'unknown'
+            vm_ip = record.get('vm_ip') if vm_status == 'running' else None
+            vagrant_vms.append({
+                'deployment_id': deployment_id,
+                'status': vm_status,
+                'path': vm.get('path') or record.get('path'),
+                'ip': vm_ip,
+                'url': f"http://{vm_ip}:{record['guest_frontend_port']}" if vm_ip and record.get('guest_frontend_port') else None,
+                'access_url': record.get('access_url'),
+                'runtime': runtime_name,
+                'model_id': record.get('model_id'),
+                'version': record.get('version')
+            })
         
         status = {
             'laptop_id': LAPTOP_ID,
@@ -1136,6 +2857,17 @@ def create_app():
             'running_vms': len([vm for vm in vagrant_vms if vm['status'] == 'running']),
             'total_vms': len(vagrant_vms),
             'vms': vagrant_vms,
+            'inventory': {
+                'refreshed_at': inventory_refreshed_at,
+                'age': time.time() - inventory_refreshed_at if inventory_refreshed_at else None,
+                'error': inventory_error
+            },
+            'provisioning': {
+                'capacity': job_manager.max_workers,
+                'queued': job_manager.queue_depth()
+            },
+            'artifact_cache': artifact_cache.stats(),
+            'prefetch': prefetcher.stats(),
             'system': {
                 'cpu_percent': cpu_percent,
                 'memory_percent': memory.percent
@@ -1156,6 +2888,11 @@ def create_app():
             'time': time.time()
         }), 200
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Startup phase histograms in Prometheus text format"""
+        return Response(startup_histograms.render(), mimetype='text/plain; version=0.0.4')
+
     return app
 
 # --- Run Server ---
@@ -3,6 +3,7 @@ import json
 import logging
 import threading
 import time
+from collections import deque
 from typing import Dict, Any
 from flask import Flask, request, jsonify
 from flask_cors import CORS
@@ -41,6 +42,13 @@ DEPLOYMENT_ENDPOINT = os.getenv('DEPLOYMENT_ENDPOINT', '/create-vm')
 HEALTH_CHECK_TIMEOUT = int(os.getenv('HEALTH_CHECK_TIMEOUT', '60'))
 SKIP_CONNECTIVITY_TEST = os.getenv('SKIP_CONNECTIVITY_TEST', 'False').lower() == 'true'
 MAX_METRIC_AGE_SECONDS = int(os.getenv('MAX_METRIC_AGE_SECONDS', '300'))
+DEPLOYMENT_USAGE_HISTORY = int(os.getenv('DEPLOYMENT_USAGE_HISTORY', '30'))  # samples kept per deployment
+PREFETCH_FANOUT = int(os.getenv('PREFETCH_FANOUT', '2'))  # agents warmed per prefetch
+PREFETCH_TRENDING_WINDOW = int(os.getenv('PREFETCH_TRENDING_WINDOW', '3600'))  # seconds
+PREFETCH_TRENDING_DEPLOYS = int(os.getenv('PREFETCH_TRENDING_DEPLOYS', '3'))  # deploys in the window that count as trending
+PREFETCH_MAX_DISK_PERCENT = float(os.getenv('PREFETCH_MAX_DISK_PERCENT', '90'))
+PROVISION_POLL_INTERVAL = int(os.getenv('PROVISION_POLL_INTERVAL', '5'))  # seconds between agent job status checks
+PROVISION_TIMEOUT = int(os.getenv('PROVISION_TIMEOUT', '1200'))  # seconds an accepted deployment may take to come up
 SKIP_CONNECTIVITY_TEST=True
 CONTROLLER_PORT='8090'
 
@@ -59,6 +67,8 @@ class DeploymentController:
         self.deployment_registry = {}  # Basic registry of deployments (no activity tracking)
         self.lock = threading.Lock()  # Lock for thread safety
         self.laptop_health_cache = {}  # Cache health check results for 30 seconds
+        self.deployment_usage = {}  # deployment_id -> recent per-deployment resource samples from agents
+        self.recent_deploys = {}  # model_id -> timestamps of recent deploy requests, for trend-driven prefetch
         
         # Create Kafka topic if it doesn't exist
         self.create_kafka_topic()
@@ -221,6 +231,11 @@ class DeploymentController:
                             'last_updated': time.time()
                         }
                         
+                        # Per-deployment resource usage, if the agent reports it
+                        if metric_data.get('deployments'):
+                            self._record_deployment_usage(laptop_id, metric_data['deployments'],
+                                                          metric_data.get('timestamp', time.time()))
+                        
                         # Log a summary of the metrics received
                         cpu_percent = metric_data.get('cpu', {}).get('percent', 0)
                         memory_percent = metric_data.get('memory', {}).get('percent', 0)
@@ -236,6 +251,38 @@ class DeploymentController:
                 consecutive_errors += 1
                 time.sleep(1)  # Brief pause on error
     
+    def _record_deployment_usage(self, laptop_id, usage, timestamp):
+        """Append one agent sample to each deployment's bounded usage history (caller holds the lock)"""
+        fields = usage.get('fields', [])
+        for deployment_id, values in usage.get('values', {}).items():
+            entry = self.deployment_usage.get(deployment_id)
+            if not entry or entry['fields'] != fields:
+                entry = {'laptop_id': laptop_id, 'fields': fields, 'samples': deque(maxlen=DEPLOYMENT_USAGE_HISTORY)}
+                self.deployment_usage[deployment_id] = entry
+            entry['laptop_id'] = laptop_id
+            entry['samples'].append([timestamp] + list(values))
+        
+        # Drop history for deployments that no longer exist anywhere
+        cutoff = time.time() - MAX_METRIC_AGE_SECONDS
+        for deployment_id in list(self.deployment_usage):
+            samples = self.deployment_usage[deployment_id]['samples']
+            if deployment_id not in self.deployment_registry and samples[-1][0] < cutoff:
+                del self.deployment_usage[deployment_id]
+    
+    def _deployment_resources(self, deployment_id):
+        """Latest usage sample as a dict, plus the compact recent history"""
+        entry = self.deployment_usage.get(deployment_id)
+        if not entry or not entry['samples']:
+            return None, None
+        latest = entry['samples'][-1]
+        resources = dict(zip(entry['fields'], latest[1:]))
+        resources['sampled_at'] = latest[0]
+        history = {
+            'fields': ['timestamp'] + entry['fields'],
+            'samples': list(entry['samples'])
+        }
+        return resources, history
+    
     def _test_connectivity(self, laptop_id, ip, port):
         """Test if the laptop is reachable before selecting it for deployment - with caching"""
         current_time = time.time()
@@ -360,6 +407,48 @@ class DeploymentController:
                 'score': best_score
             }
     
+    def prefetch_model(self, model_id, version, exclude=(), fanout=PREFETCH_FANOUT):
+        """Ask the laptops most likely to get the next deploy of a model to warm their caches for it"""
+        with self.lock:
+            current_time = time.time()
+            candidates = []
+            for laptop_id, metrics in self.laptop_metrics.items():
+                if laptop_id in exclude or current_time - metrics.get('last_updated', 0) >= MAX_METRIC_AGE_SECONDS:
+                    continue
+                # Agents skip prefetches themselves when disk is tight; don't even ask nearly full ones
+                if metrics.get('disk', {}).get('percent', 100) >= PREFETCH_MAX_DISK_PERCENT:
+                    continue
+                # Same score select_laptop uses, so the warmed laptops are the ones it would pick next
+                score = (0.7 * metrics.get('cpu', {}).get('percent', 100)) + (0.3 * metrics.get('memory', {}).get('percent', 100))
+                candidates.append((score, laptop_id, metrics.get('ip'), metrics.get('port')))
+        
+        targets = sorted(candidates)[:fanout]
+        
+        def send(laptop_id, ip, port):
+            try:
+                response = requests.post(f"http://{ip}:{port}/prefetch",
+                                         json={'model_id': model_id, 'version': version}, timeout=10)
+                logger.info(f"Prefetch of model {model_id} version {version} on {laptop_id}: HTTP {response.status_code}")
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Prefetch request to {laptop_id} failed: {str(e)}")
+        
+        for _, laptop_id, ip, port in targets:
+            threading.Thread(target=send, args=(laptop_id, ip, port), daemon=True).start()
+        return [laptop_id for _, laptop_id, _, _ in targets]
+    
+    def _note_deploy(self, model_id, version, laptop_id):
+        """Track deploy frequency and prefetch a model to more laptops once it is trending"""
+        current_time = time.time()
+        with self.lock:
+            history = self.recent_deploys.setdefault(model_id, deque())
+            history.append(current_time)
+            while history and history[0] < current_time - PREFETCH_TRENDING_WINDOW:
+                history.popleft()
+            trending = len(history) >= PREFETCH_TRENDING_DEPLOYS
+        if trending:
+            targets = self.prefetch_model(model_id, version, exclude={laptop_id})
+            logger.info(f"Model {model_id} is trending ({len(history)} deploys); prefetching to {targets}")
+    
     def update_caddy_route(self, deployment_id, internal_url, action="add"):
         """
         Directly update Caddy's configuration to add or remove a route
@@ -453,56 +542,53 @@ class DeploymentController:
                 timeout=660  # Reduced timeout for faster response
             )
             
-            # Process the response
-            if response.status_code == 200:
+            # Process the response (202 means the agent accepted the job and boots the VM in the background)
+            if response.status_code in (200, 202):
                 response_data = response.json()
                 deployment_id = response_data.get('deployment_id', 'unknown')
                 model_access_url = response_data.get('access_url')
+                job_id = response_data.get('job_id')
+                status_url = response_data.get('status_url')
                 public_url = None
+                provisioning = response.status_code == 202
                 
-                logger.info(f"STEP 5: Deployment successful. Model {model_id} deployed with ID {deployment_id}")
-                
-                # Register the deployment
+                # Register the deployment; an accepted job only goes live once the agent reports it succeeded
                 with self.lock:
                     self.deployment_registry[deployment_id] = {
                         'laptop_id': laptop_id,
                         'model_id': model_id,
                         'version': version,
                         'deployment_time': time.time(),
-                        'internal_url': model_access_url
+                        'internal_url': model_access_url,
+                        'job_id': job_id,
+                        'status_url': status_url,
+                        'status': 'provisioning' if provisioning else 'running'
                     }
                 
-                # STEP 6: Create public URL via Caddy if enabled
-                if ENABLE_PUBLIC_URLS and model_access_url:
-                    try:
-                        logger.info(f"STEP 6: Creating public URL for deployment {deployment_id}")
-                        
-                        success, message = self.update_caddy_route(deployment_id, model_access_url, "add")
-                        if success:
-                            public_url = f"{PUBLIC_URL_BASE}/{deployment_id}"
-                            
-                            # Update deployment registry with public URL
-                            with self.lock:
-                                if deployment_id in self.deployment_registry:
-                                    self.deployment_registry[deployment_id]['public_url'] = public_url
-                            
-                            logger.info(f"STEP 6: Public URL created: {public_url}")
-                        else:
-                            logger.warning(f"STEP 6: Failed to create public URL: {message}")
-                    except Exception as e:
-                        logger.error(f"STEP 6: Error creating public URL: {str(e)}")
+                if provisioning:
+                    logger.info(f"STEP 5: Deployment accepted. Model {model_id} provisioning as {deployment_id} (job {job_id})")
+                    threading.Thread(
+                        target=self._watch_provisioning,
+                        args=(deployment_id, model_id, version, laptop_id, status_url),
+                        daemon=True
+                    ).start()
                 else:
-                    logger.info("STEP 6: Public URL creation disabled or no model access URL available")
+                    logger.info(f"STEP 5: Deployment successful. Model {model_id} deployed with ID {deployment_id}")
+                    self._note_deploy(model_id, version, laptop_id)
+                    public_url = self._publish_deployment(deployment_id, model_access_url)
                 
                 end_time = time.time()
-                logger.info(f"Deployment completed. Total time: {end_time - start_time:.2f} seconds")
+                logger.info(f"Deployment request completed. Total time: {end_time - start_time:.2f} seconds")
                 
                 return {
                     'success': True,
                     'laptop_id': laptop_id,
                     'deployment_id': deployment_id,
+                    'status': 'provisioning' if provisioning else 'running',
                     'access_url': model_access_url,
                     'public_url': public_url,
+                    'job_id': job_id,
+                    'status_url': status_url,
                     'deploy_time_seconds': end_time - start_time
                 }
             else:
@@ -525,6 +611,68 @@ class DeploymentController:
                 'error': str(e)
             }
     
+    def _publish_deployment(self, deployment_id, model_access_url):
+        """Create the public URL for a running deployment; returns it, or None"""
+        if not (ENABLE_PUBLIC_URLS and model_access_url):
+            logger.info("STEP 6: Public URL creation disabled or no model access URL available")
+            return None
+        try:
+            logger.info(f"STEP 6: Creating public URL for deployment {deployment_id}")
+            success, message = self.update_caddy_route(deployment_id, model_access_url, "add")
+            if not success:
+                logger.warning(f"STEP 6: Failed to create public URL: {message}")
+                return None
+            public_url = f"{PUBLIC_URL_BASE}/{deployment_id}"
+            with self.lock:
+                if deployment_id in self.deployment_registry:
+                    self.deployment_registry[deployment_id]['public_url'] = public_url
+            logger.info(f"STEP 6: Public URL created: {public_url}")
+            return public_url
+        except Exception as e:
+            logger.error(f"STEP 6: Error creating public URL: {str(e)}")
+            return None
+    
+    def _watch_provisioning(self, deployment_id, model_id, version, laptop_id, status_url):
+        """Follow an accepted agent job; publish the deployment if it succeeds, forget it otherwise"""
+        deadline = time.time() + PROVISION_TIMEOUT
+        status, error = None, None
+        while time.time() < deadline:
+            time.sleep(PROVISION_POLL_INTERVAL)
+            with self.lock:
+                if deployment_id not in self.deployment_registry:
+                    logger.info(f"Deployment {deployment_id} was stopped while provisioning")
+                    return
+            try:
+                response = requests.get(status_url, timeout=10)
+                if response.status_code == 404:
+                    status, error = 'failed', 'agent no longer knows the job'
+                    break
+                job = response.json()
+                status, error = job.get('status'), job.get('error')
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # The agent may be busy or restarting; keep polling until the deadline
+                logger.warning(f"Could not poll job for deployment {deployment_id}: {str(e)}")
+                continue
+            if status in ('succeeded', 'failed', 'cancelled'):
+                break
+        else:
+            status, error = 'failed', f"not up after {PROVISION_TIMEOUT} seconds"
+        
+        if status == 'succeeded':
+            with self.lock:
+                info = self.deployment_registry.get(deployment_id)
+                if info is None:
+                    return
+                info['status'] = 'running'
+                model_access_url = info.get('internal_url')
+            logger.info(f"Deployment {deployment_id} of model {model_id} is running")
+            self._note_deploy(model_id, version, laptop_id)
+            self._publish_deployment(deployment_id, model_access_url)
+        else:
+            with self.lock:
+                self.deployment_registry.pop(deployment_id, None)
+            logger.error(f"Deployment {deployment_id} of model {model_id} {status}: {error}")
+    
     def stop_deployment(self, deployment_id):
         """Stop a deployment by ID and remove its public URL"""
         logger.info(f"STEP 1: Stopping deployment {deployment_id}")
@@ -592,22 +740,60 @@ class DeploymentController:
             logger.error(error_msg, exc_info=True)
             return False, error_msg
     
+    def reconcile_laptop_deployments(self, laptop_id, deployments):
+        """Replace what we know about a laptop's deployments with what its agent reports after a restart"""
+        announced = {d['deployment_id']: d for d in deployments if d.get('deployment_id')}
+        with self.lock:
+            stale = [
+                deployment_id for deployment_id, info in self.deployment_registry.items()
+                if info.get('laptop_id') == laptop_id and deployment_id not in announced
+            ]
+            for deployment_id in stale:
+                del self.deployment_registry[deployment_id]
+            
+            for deployment_id, deployment in announced.items():
+                # Keep fields only the controller knows (public_url, job_id) for deployments it already tracks
+                info = self.deployment_registry.setdefault(deployment_id, {
+                    'deployment_time': deployment.get('created_at') or time.time()
+                })
+                info.update({
+                    'laptop_id': laptop_id,
+                    'model_id': deployment.get('model_id'),
+                    'version': deployment.get('version'),
+                    'internal_url': deployment.get('access_url')
+                })
+        
+        if ENABLE_PUBLIC_URLS:
+            for deployment_id in stale:
+                try:
+                    self.update_caddy_route(deployment_id, "", "remove")
+                except Exception as e:
+                    logger.error(f"Error removing public URL for stale deployment {deployment_id}: {str(e)}")
+        
+        logger.info(f"Laptop {laptop_id} announced {len(announced)} deployments, dropped {len(stale)} stale entries")
+        return len(announced), stale
+    
     def get_deployments(self):
         """Get a list of all deployments"""
         with self.lock:
             current_time = time.time()
-            deployments = {
-                deployment_id: {
+            deployments = {}
+            for deployment_id, info in self.deployment_registry.items():
+                resources, resource_history = self._deployment_resources(deployment_id)
+                deployments[deployment_id] = {
                     'model_id': info.get('model_id', 'unknown'),
                     'version': info.get('version', 'unknown'),
                     'laptop_id': info.get('laptop_id'),
                     'deployment_time': info.get('deployment_time'),
                     'uptime': current_time - info.get('deployment_time', current_time),
                     'internal_url': info.get('internal_url'),
-                    'public_url': info.get('public_url')  # Include public URL in deployments info
+                    'public_url': info.get('public_url'),  # Include public URL in deployments info
+                    'status': info.get('status', 'running'),
+                    'job_id': info.get('job_id'),
+                    'status_url': info.get('status_url'),
+                    'resources': resources,
+                    'resource_history': resource_history
                 }
-                for deployment_id, info in self.deployment_registry.items()
-            }
             return deployments
 
 # Create controller instance
@@ -670,6 +856,44 @@ def stop_deployment():
             'error': message
         }), 500
 
+@app.route('/controller/prefetch', methods=['POST'])
+def prefetch_model():
+    """Endpoint for warming agent caches ahead of deploys (called on registry uploads, or manually)"""
+    data = request.json
+    
+    if not data or 'model_id' not in data:
+        logger.warning("Received prefetch request without model_id")
+        return jsonify({
+            'success': False,
+            'error': 'Missing model_id in request'
+        }), 400
+    
+    fanout = int(data.get('fanout', PREFETCH_FANOUT))
+    targets = controller.prefetch_model(data['model_id'], data.get('version', 'latest'), fanout=fanout)
+    return jsonify({
+        'success': True,
+        'targets': targets
+    }), 202
+
+@app.route('/controller/announce', methods=['POST'])
+def announce_deployments():
+    """Endpoint agents call on startup to re-announce the deployments they are still running"""
+    data = request.json
+    
+    if not data or 'laptop_id' not in data:
+        logger.warning("Received announcement without laptop_id")
+        return jsonify({
+            'success': False,
+            'error': 'Missing laptop_id in request'
+        }), 400
+    
+    count, stale = controller.reconcile_laptop_deployments(data['laptop_id'], data.get('deployments', []))
+    return jsonify({
+        'success': True,
+        'deployment_count': count,
+        'removed': stale
+    }), 200
+
 @app.route('/controller/status', methods=['GET'])
 def get_status():
     """Endpoint for getting controller status"""
@@ -39,6 +39,8 @@ MODEL_REGISTRY_PORT = res_model_registry['result']['port']
 
 controller_url = f"http://{CONTROLLER_IP}:{CONTROLLER_PORT}/controller/deploy"
 registry_url = f"http://{MODEL_REGISTRY_IP}:{MODEL_REGISTRY_PORT}/registry/display-model"
+models_page_url = f"http://{MODEL_REGISTRY_IP}:{MODEL_REGISTRY_PORT}/registry/models"
+MODEL_LIST_PAGE_SIZE = 25
 
 csrf = CSRFProtect(app)
 
@@ -124,7 +126,8 @@ def get_registry_url():
         registry_ip = res_model_registry['result']['ip']
         registry_port = res_model_registry['result']['port']
         return jsonify({
-            'url': f"http://{registry_ip}:{registry_port}/registry/upload-and-validate"
+            'url': f"http://{registry_ip}:{registry_port}/registry/upload-and-validate",
+            'uploads_url': f"http://{registry_ip}:{registry_port}/registry/uploads"
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -211,46 +214,33 @@ def upload():
 @login_required
 def model_list():
     try:
-        conn = sqlite3.connect('../model-registry/model_registry.db')
-        cursor = conn.cursor()
-        
-        query = """
-        SELECT 
-            model_name,
-            version,
-            model_id,
-            user_id
-        FROM models
-        ORDER BY model_name, version DESC
-        """
-        
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        # One page of models, each with its versions grouped by the registry
+        response = requests.get(
+            models_page_url,
+            params={
+                'limit': MODEL_LIST_PAGE_SIZE,
+                'cursor': request.args.get('cursor'),
+                'fields': 'model_id,version'
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+        page = response.json()
         
-        # Group models by model_name
         grouped_models = {}
-        for row in rows:
-            model_name = row[0]
-            if model_name not in grouped_models:
-                grouped_models[model_name] = {
-                    'versions': [],
-                    'user_id': row[3]
-                }
-            grouped_models[model_name]['versions'].append({
-                'version': row[1],
-                'model_id': row[2]
-            })
+        for model in page['models']:
+            grouped_models[model['model_name']] = {
+                'versions': model['versions'],
+                'user_id': model['user_id']
+            }
         
-        return render_template('model_list.html', grouped_models=grouped_models)
+        return render_template('model_list.html', grouped_models=grouped_models,
+                               next_cursor=page['next_cursor'], first_page=not request.args.get('cursor'))
     
-    except sqlite3.Error as e:
-        logging.error(f"Database error: {e}")
+    except requests.RequestException as e:
+        logging.error(f"Registry error: {e}")
         flash('Error fetching models from registry')
-        return render_template('model_list.html', grouped_models={})
-    
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        return render_template('model_list.html', grouped_models={}, next_cursor=None, first_page=True)
 
 # @app.route('/model/edit/<model_name>/<model_id>/<version>', methods=['GET', 'POST'])
 # @login_required
@@ -426,7 +416,7 @@ def edit_model(model_name, model_id, version):
         cursor = conn.cursor()
         cursor.execute("""
             SELECT user_id FROM models 
-            WHERE model_id = ? AND version = ?
+            WHERE model_id = ? AND version = ? AND status != 'deleted'
         """, (model_id, version))
         result = cursor.fetchone()
         
@@ -612,10 +602,12 @@ def edit_model(model_name, model_id, version):
             result = upload_response.json()
             new_version = result['storage']['version']
             
+            # The registry validates in the background and answers 202 with a job to poll
             return jsonify({
                 'success': True,
                 'new_version': new_version,
-                'message': f'Successfully created version {new_version}'
+                'validation_job': result.get('job_id'),
+                'message': f'Version {new_version} submitted for validation'
             })
             
         except Exception as e:
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Registry lookup latency: per-request connections on the bare table vs. registry_db.
+
+Usage: python bench_db.py [versions] [lookups]   (default: 100000 2000)
+
+Both databases hold the same rows (versions spread over models with 10
+versions each and 500 users). "before" opens a fresh sqlite3 connection per
+lookup against the original unindexed schema and runs the queries the registry
+used to; "after" reuses one migrated WAL connection and goes through
+registry_db with the lookup indexes.
+"""
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import registry_db
+
+VERSIONS_PER_MODEL = 10
+USERS = 500
+
+def populate(conn, versions):
+    rows = []
+    for i in range(versions):
+        model = i // VERSIONS_PER_MODEL
+        rows.append((
+            f"model-{model}", f"name-{model}", f"user-{model % USERS}", i % VERSIONS_PER_MODEL + 1,
+            "2025-01-01T00:00:00", "{}", f"/exports/models/model-{model}/v{i % VERSIONS_PER_MODEL + 1}",
+            "validated_stored", '{"is_valid": true}'
+        ))
+    conn.executemany('''
+        INSERT INTO models (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status, validation_result)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+
+def build(path, versions, migrated):
+    conn = registry_db.connect(path) if migrated else sqlite3.connect(path)
+    conn.executescript(registry_db.MIGRATIONS[0][2][0] + ';')
+    populate(conn, versions)
+    if migrated:
+        # Baseline schema first, rows, then the index migrations, as on an upgraded install
+        conn.execute(f'PRAGMA user_version = {registry_db.MIGRATIONS[0][0]}')
+        registry_db.migrate(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+    conn.close()
+
+# name -> (the query the registry ran before registry_db, on the baseline schema; registry_db's lookup)
+LOOKUPS = {
+    "next version": (
+        lambda conn, m, u: conn.execute('SELECT MAX(version) FROM models WHERE model_id = ?', (m,)).fetchone(),
+        lambda conn, m, u: registry_db.get_latest_version(conn, m),
+    ),
+    "fetch latest": (
+        lambda conn, m, u: conn.execute(
+            'SELECT storage_path, model_name, version FROM models WHERE model_id = ? ORDER BY version DESC LIMIT 1', (m,)
+        ).fetchone(),
+        lambda conn, m, u: registry_db.get_model_location(conn, m),
+    ),
+    "fetch version": (
+        lambda conn, m, u: conn.execute(
+            'SELECT storage_path, model_name FROM models WHERE model_id = ? AND version = ?', (m, 3)
+        ).fetchone(),
+        lambda conn, m, u: registry_db.get_model_location(conn, m, 3),
+    ),
+    "user models": (
+        lambda conn, m, u: [dict(row) for row in conn.execute('SELECT * FROM models WHERE user_id = ?', (u,))],
+        lambda conn, m, u: registry_db.list_models(conn, u),
+    ),
+}
+
+def time_lookups(open_conn, lookup, versions, count):
+    models = versions // VERSIONS_PER_MODEL
+    samples = []
+    for _ in range(count):
+        model = random.randrange(models)
+        started = time.perf_counter()
+        conn = open_conn()
+        lookup(conn, f"model-{model}", f"user-{model % USERS}")
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+def main():
+    versions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        before_path = os.path.join(tmp, "before.db")
+        after_path = os.path.join(tmp, "after.db")
+        build(before_path, versions, migrated=False)
+        build(after_path, versions, migrated=True)
+
+        def fresh_connection():
+            conn = sqlite3.connect(before_path)
+            conn.row_factory = sqlite3.Row
+            return conn
+        pooled = registry_db.connect(after_path)
+
+        print(f"{versions} versions, {count} lookups each (ms)")
+        print(f"{'lookup':<14} {'before p50':>11} {'before p99':>11} {'after p50':>10} {'after p99':>10}")
+        for name, (before_lookup, after_lookup) in LOOKUPS.items():
+            # The user listing scans the whole table before the index; keep that run short
+            n = count if name != "user models" else max(count // 10, 1)
+            before = time_lookups(fresh_connection, before_lookup, versions, n)
+            after = time_lookups(lambda: pooled, after_lookup, versions, n)
+            print(f"{name:<14} {before[0]:>11.3f} {before[1]:>11.3f} {after[0]:>10.3f} {after[1]:>10.3f}")
+        pooled.close()
+
+if __name__ == "__main__":
+    main()
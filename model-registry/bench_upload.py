@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Peak memory of receiving an upload: whole-body read vs. the registry's chunked save_upload.
+
+Usage: python bench_upload.py [size_mb ...]   (default: 64 256 1024)
+
+Each upload is a file of random bytes wrapped in the same UploadFile the
+registry endpoints receive. Python allocations are tracked with tracemalloc,
+so the numbers show the memory held per request, not the interpreter baseline.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fastapi import UploadFile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location("model_registry", os.path.join(HERE, "model-registry.py"))
+registry = importlib.util.module_from_spec(spec)
+sys.path.insert(0, HERE)
+spec.loader.exec_module(registry)
+
+async def read_whole(upload, destination):
+    # What the upload endpoints did before: the whole archive in memory at once
+    content = await upload.read()
+    with open(destination, "wb") as f:
+        f.write(content)
+    return len(content), hashlib.sha256(content).hexdigest()
+
+def measure(strategy, source_path, destination):
+    with open(source_path, "rb") as source:
+        upload = UploadFile(file=source, filename="model.zip")
+        tracemalloc.start()
+        started = time.perf_counter()
+        size, sha256 = asyncio.run(strategy(upload, destination))
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return size, sha256, peak, elapsed
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [64, 256, 1024]
+    print(f"{'size':>8} {'strategy':>10} {'peak MiB':>10} {'MiB/s':>8}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size_mb in sizes:
+            source_path = os.path.join(workdir, "upload.bin")
+            with open(source_path, "wb") as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            destination = os.path.join(workdir, "received.zip")
+
+            digests = set()
+            for name, strategy in (("read-all", read_whole), ("chunked", registry.save_upload)):
+                size, sha256, peak, elapsed = measure(strategy, source_path, destination)
+                digests.add(sha256)
+                print(f"{size_mb:>6}MB {name:>10} {peak / 2**20:>10.1f} {size / 2**20 / elapsed:>8.0f}")
+            assert len(digests) == 1, "strategies disagree on the content hash"
+            os.remove(source_path)
+
+if __name__ == "__main__":
+    main()
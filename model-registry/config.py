@@ -1,5 +1,9 @@
 import os
 
 NFS_BASE_DIR = os.path.abspath("/exports/models/")
+BLOB_DIR = os.path.join(NFS_BASE_DIR, ".blobs")  # content-addressed file store shared by all versions
+UPLOAD_SESSION_DIR = os.path.join(NFS_BASE_DIR, ".uploads")  # staging area for resumable uploads
+VALIDATION_STAGING_DIR = os.path.join(NFS_BASE_DIR, ".staging")  # archives waiting for a validation worker
+ARCHIVE_CACHE_DIR = os.path.join(NFS_BASE_DIR, ".archives")  # tar downloads of stored versions, rebuilt on demand
 DB_PATH = os.path.abspath("model_registry.db")
 ENV_PATH = os.path.abspath("/exports/applications/.env")
\ No newline at end of file
@@ -1,22 +1,46 @@
 import os
+import io
+import asyncio
 import uuid
 import shutil
 import zipfile
-import sqlite3
+import tarfile
 import json
 import logging
-import tempfile
+import hashlib
+import sys
+import subprocess
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Path
-from fastapi.responses import JSONResponse
+from email.utils import parsedate_to_datetime
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Path, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, Callable
 import uvicorn
 from dotenv import load_dotenv
 import requests
 import socket
-from config import DB_PATH, NFS_BASE_DIR, ENV_PATH
+import base64
+try:
+    from confluent_kafka import Producer
+    from confluent_kafka.admin import AdminClient, NewTopic
+except ImportError:  # events then stay in process; see RegistryEvents
+    Producer = None
+from config import NFS_BASE_DIR, ENV_PATH, BLOB_DIR, UPLOAD_SESSION_DIR, VALIDATION_STAGING_DIR, ARCHIVE_CACHE_DIR
+from registry_db import (
+    get_db, migrate, get_model_version, get_model_location,
+    list_models, list_model_groups, record_model_files, get_model_files, blob_referenced, delete_models,
+    mark_deleted, get_deleted_versions, count_deleted_versions, storage_path_in_use, get_all_versions,
+    reserve_model_version, update_model_version, fail_interrupted_validations, get_unfinished_bundles,
+    LISTING_FIELDS
+)
 
 # Configure logging
 logging.basicConfig(
@@ -37,30 +61,101 @@ app.add_middleware(
 )
 
 os.makedirs(NFS_BASE_DIR, exist_ok=True)
+os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+os.makedirs(VALIDATION_STAGING_DIR, exist_ok=True)
+os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read from an upload at a time; bounds memory per request
+MAX_TEXT_MEMBER_BYTES = 1024 * 1024  # meta.json, app.py, webapp.py and requirements.txt are checked in memory
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 * 1024  # size of each numbered chunk in a resumable upload
+UPLOAD_SESSION_TTL = 24 * 3600  # seconds an upload session may sit idle before it is discarded
+
+# upload_id -> lock held while a chunk is written or the session is finalized
+upload_session_locks: Dict[str, threading.Lock] = {}
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+LISTING_DEFAULT_LIMIT = 50
+LISTING_MAX_LIMIT = 500
+LISTING_DEFAULT_FIELDS = "model_id,version,status,timestamp"
+FETCH_CACHE_MAX_ENTRIES = 4096  # fetch-model responses kept in memory
+FETCH_CACHE_TTL = 60  # seconds; upper bound on staleness if an invalidation is ever missed
+GC_INTERVAL = 30  # seconds between storage collector passes over deleted versions
+GC_SWEEP_INTERVAL = 3600  # seconds between orphan sweeps
+GC_ORPHAN_MIN_AGE = 3600  # seconds a file must sit untouched before a sweep may treat it as orphaned
+GC_MAX_UNLINKS_PER_SECOND = 200  # keeps collection from saturating NFS
+VALIDATION_WORKERS = min(4, os.cpu_count() or 1)  # processes extracting and validating archives
+VALIDATION_QUEUE_SIZE = 16  # uploads accepted but not yet validated, running jobs included
+VALIDATION_RETRY_AFTER = 30  # seconds a client is told to wait when the queue is full
+VALIDATION_JOB_HISTORY = 1000  # finished jobs kept for /registry/validation-jobs
+
+# Validation runs outside the event loop; the slots bound how many uploads may wait for it.
+# Workers start lazily, after the collector, bundle and Kafka threads are up; forking then could
+# copy a lock some other thread holds, so they come from a clean forkserver instead.
+validation_pool = ProcessPoolExecutor(max_workers=VALIDATION_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+validation_slots = threading.BoundedSemaphore(VALIDATION_QUEUE_SIZE)
+# job_id -> job status, oldest first
+validation_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+validation_jobs_lock = threading.Lock()
+validation_futures: Dict[str, Any] = {}
+# (model_id, version) of direct uploads still being stored; guarded by validation_jobs_lock
+direct_uploads: set = set()
+
+BUNDLE_SUFFIX = ".bundle"  # deploy-ready lock file and wheels, beside each validated version (<model>/v<N>.bundle)
+BUNDLE_WORKERS = 2  # concurrent pip downloads
+BUNDLE_BUILD_TIMEOUT = 900  # seconds allowed for resolving and downloading one version's wheels
+# Target interpreter for the wheels; unset means the registry's own
+BUNDLE_PYTHON_VERSION = os.getenv("BUNDLE_PYTHON_VERSION")
+BUNDLE_PLATFORM = os.getenv("BUNDLE_PLATFORM")
+bundle_pool = ThreadPoolExecutor(max_workers=BUNDLE_WORKERS, thread_name_prefix="bundle")
+ARCHIVE_CACHE_TTL = 7 * 24 * 3600  # seconds a built download archive is kept after it was last rebuilt
+ARCHIVE_WORKERS = 1  # background archive builds; downloads stream meanwhile
+archive_pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix="archive")
+archive_locks: Dict[str, threading.Lock] = {}
+archive_locks_lock = threading.Lock()
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS")  # unset keeps registry events in process
+REGISTRY_EVENTS_TOPIC = os.getenv("REGISTRY_EVENTS_TOPIC", "registry-events")
+EVENT_HISTORY = 1000  # recent events kept for /registry/events
+EVENT_POLL_MAX_WAIT = 30  # seconds a /registry/events request may wait for new events
+EVENT_POLL_INTERVAL = 0.25
+
+def notify_prefetch(model_id: str, version: int):
+    """Best-effort: ask the controller to warm agent caches for a newly stored version"""
+    def _notify():
+        try:
+            lookup = requests.get(
+                f"http://{os.getenv('service_registry_ip')}:{os.getenv('service_registry_port')}/service-registry/getServiceInfo",
+                params={"name": "controller"},
+                timeout=5
+            )
+            controller = lookup.json()["result"]
+            requests.post(
+                f"http://{controller['ip']}:{controller['port']}/controller/prefetch",
+                json={"model_id": model_id, "version": version},
+                timeout=10
+            )
+        except Exception as e:
+            logger.warning(f"Could not request prefetch for {model_id} v{version}: {e}")
+    threading.Thread(target=_notify, daemon=True).start()
 
 def init_db():
+    migrate(get_db())
+
+def recover_interrupted_work():
+    """Settle work the previous registry process left half done; runs once in the serving process"""
     conn = get_db()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS models (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            model_id TEXT,
-            model_name TEXT,
-            user_id TEXT,
-            version INTEGER,
-            timestamp TEXT,
-            metadata TEXT,
-            storage_path TEXT,
-            status TEXT,
-            validation_result TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    # Validation jobs live in memory; any left over from a previous run are gone
+    interrupted = fail_interrupted_validations(conn)
+    if interrupted:
+        logger.warning(f"Marked {interrupted} versions as failed: the registry restarted during their validation")
+    for name in os.listdir(VALIDATION_STAGING_DIR):
+        path = os.path.join(VALIDATION_STAGING_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    # Bundle builds are not persisted either; start again the ones a restart cut short
+    for row in get_unfinished_bundles(conn):
+        schedule_bundle(row["model_id"], row["version"], row["storage_path"])
+
 class ModelMetadata(BaseModel):
     model_id: str
     model_name: str
@@ -75,13 +170,306 @@ class ModelMetadata(BaseModel):
 class ValidationError(Exception):
     pass
 
+async def save_upload(upload: UploadFile, destination: str) -> Tuple[int, str]:
+    """Stream an upload to disk in fixed-size chunks, hashing it on the way; returns (size, sha256)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(destination, "wb") as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+class RegistryEvents:
+    """
+    Publishes version lifecycle events to other services.
+    
+    Types are version.uploaded, version.validated, version.failed and
+    version.deleted. Every event is numbered and kept in a bounded history,
+    which /registry/events serves and in-process subscribers receive. Once
+    connect() is given KAFKA_BOOTSTRAP_SERVERS, events are also produced to
+    REGISTRY_EVENTS_TOPIC, keyed by model_id so one model's events stay in
+    order on one partition. Without Kafka the in-process stream is all there is.
+    """
+    def __init__(self, history: int):
+        self.stream_id = uuid.uuid4().hex  # changes on restart, when sequence numbers start over
+        self.history = deque(maxlen=history)
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.producer = None
+        self.topic = None
+    
+    def connect(self, bootstrap_servers: Optional[str], topic: str):
+        if not bootstrap_servers:
+            logger.info("KAFKA_BOOTSTRAP_SERVERS not set; registry events stay in process")
+            return
+        if Producer is None:
+            logger.warning("confluent_kafka is not installed; registry events stay in process")
+            return
+        try:
+            AdminClient({'bootstrap.servers': bootstrap_servers}).create_topics(
+                [NewTopic(topic, num_partitions=3, replication_factor=1)]
+            )
+        except Exception as e:
+            logger.warning(f"Could not create topic {topic}: {str(e)}")
+        self.producer = Producer({
+            'bootstrap.servers': bootstrap_servers,
+            'client.id': 'model-registry',
+            'linger.ms': 20
+        })
+        self.topic = topic
+        logger.info(f"Publishing registry events to {topic} on {bootstrap_servers}")
+    
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]):
+        self.subscribers.append(callback)
+    
+    def publish(self, event_type: str, model_id: str, version: Optional[int] = None, **details) -> Dict[str, Any]:
+        with self.lock:
+            self.sequence += 1
+            event = {
+                "sequence": self.sequence,
+                "event_id": uuid.uuid4().hex,
+                "type": event_type,
+                "model_id": model_id,
+                "version": version,
+                "timestamp": datetime.utcnow().isoformat(),
+                **details
+            }
+            self.history.append(event)
+        for callback in list(self.subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Registry event subscriber failed on {event_type}: {str(e)}")
+        if self.producer is not None:
+            try:
+                self.producer.produce(self.topic, key=model_id, value=json.dumps(event), on_delivery=self._delivered)
+                self.producer.poll(0)
+            except Exception as e:
+                logger.error(f"Could not queue {event_type} for {model_id} to Kafka: {str(e)}")
+        return event
+    
+    def _delivered(self, err, msg):
+        if err is not None:
+            logger.error(f"Registry event delivery failed: {err}")
+    
+    def since(self, after: int, limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """Events numbered above after, oldest first, and whether some were already dropped from history"""
+        with self.lock:
+            events = [event for event in self.history if event["sequence"] > after]
+            truncated = bool(self.history) and self.history[0]["sequence"] > after + 1
+        return events[:limit], truncated
+    
+    def close(self):
+        if self.producer is not None:
+            self.producer.flush(10)
+
+registry_events = RegistryEvents(EVENT_HISTORY)
+
+class LookupCache:
+    """
+    Bounded LRU of fetch-model responses, with a TTL as a backstop.
+    
+    Writers call invalidate(model_id) after committing. A lookup that read the
+    database before an invalidation is not cached, because put() only accepts
+    values read under the current generation.
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[Tuple[str, Optional[int]], Tuple[float, Dict[str, Any], str]]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key: Tuple[str, Optional[int]]) -> Optional[Tuple[Dict[str, Any], str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+    
+    def put(self, key: Tuple[str, Optional[int]], body: Dict[str, Any], generation: int) -> str:
+        etag = '"' + hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest() + '"'
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.monotonic() + self.ttl, body, etag)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return etag
+    
+    def invalidate(self, model_id: str):
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key[0] == model_id]:
+                del self.entries[key]
+    
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+lookup_cache = LookupCache(FETCH_CACHE_MAX_ENTRIES, FETCH_CACHE_TTL)
+
+def cached_lookup(request: Request, model_id: str, version: Optional[int]):
+    """
+    Serve a fetch-model lookup through lookup_cache, honouring If-None-Match.
+    
+    version None resolves the latest version.
+    """
+    key = (model_id, version)
+    cached = lookup_cache.get(key)
+    if cached is not None:
+        body, etag = cached
+    else:
+        generation = lookup_cache.generation
+        row = get_model_location(get_db(), model_id, version)
+        if not row:
+            raise HTTPException(status_code=404, detail="Model version not found" if version is not None else "Model not found")
+        body = {
+            "path": row["storage_path"],
+            "model_name": row["model_name"],
+            "version": row["version"],
+            "archive_url": f"/registry/artifacts/{model_id}/{row['version']}/archive",
+            "manifest_url": f"/registry/artifacts/{model_id}/{row['version']}/manifest",
+            "bundle": {
+                "status": row["bundle_status"] or "none",
+                "path": bundle_dir(row["storage_path"]) if row["bundle_status"] == "ready" else None
+            }
+        }
+        etag = lookup_cache.put(key, body, generation)
+    
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=body, headers=headers)
+
 def construct_nfs_path(model_id: str, version: int):
     return os.path.join(NFS_BASE_DIR, model_id, f"v{version}")
 
-def get_latest_version(conn, model_id: str):
-    cur = conn.execute('SELECT MAX(version) FROM models WHERE model_id = ?', (model_id,))
-    row = cur.fetchone()
-    return (row[0] or 0) + 1
+# ---- Artifact Downloads ----
+
+def archive_path(model_id: str, version: int) -> str:
+    return os.path.join(ARCHIVE_CACHE_DIR, model_id, f"v{version}.tar")
+
+def cached_archive(model_id: str, version: int, storage_path: str) -> Optional[str]:
+    """Path of the built archive if it is current for the version directory, else None"""
+    path = archive_path(model_id, version)
+    try:
+        if int(os.stat(path).st_mtime) == int(os.stat(storage_path).st_mtime):
+            return path
+    except FileNotFoundError:
+        pass
+    return None
+
+def version_archive(model_id: str, version: int, storage_path: str) -> str:
+    """
+    Path of an uncompressed tar of a version's files, building it if needed.
+    
+    A plain tar keeps byte offsets stable, so downloads can be split into
+    ranges and resumed. The cached archive carries the version directory's
+    mtime; republishing the version changes that mtime, which makes the next
+    build start over. Runs on the archive pool; requests never wait for it.
+    """
+    path = archive_path(model_id, version)
+    with archive_locks_lock:
+        lock = archive_locks.setdefault(path, threading.Lock())
+    with lock:
+        if cached_archive(model_id, version, storage_path):
+            return path
+        source_mtime = int(os.stat(storage_path).st_mtime)
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        scratch = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        started = time.time()
+        try:
+            with open(scratch, "wb") as f:
+                for block in stream_version_archive(storage_path):
+                    f.write(block)
+            os.utime(scratch, (source_mtime, source_mtime))
+            os.replace(scratch, path)
+        except BaseException:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+            raise
+        logger.info(f"Built download archive for {model_id} v{version} in {time.time() - started:.1f}s")
+        return path
+
+def stream_version_archive(storage_path: str):
+    """
+    Yield a version's files as a PAX tar, one piece at a time.
+    
+    Emits what tarfile would write for the same walk, so a download streamed
+    from here and the cached archive built from it are byte-for-byte equal.
+    """
+    # Only used for gettarinfo, which also turns repeated inodes into hardlink entries
+    tar = tarfile.open(fileobj=io.BytesIO(), mode="w", format=tarfile.PAX_FORMAT)
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(storage_path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            full_path = os.path.join(dirpath, name)
+            info = tar.gettarinfo(full_path, arcname=os.path.relpath(full_path, storage_path))
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            written += len(header)
+            yield header
+            if not info.isreg():
+                continue
+            remaining = info.size
+            with open(full_path, "rb") as f:
+                while remaining:
+                    chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise OSError(f"{full_path} shrank while it was being archived")
+                    remaining -= len(chunk)
+                    yield chunk
+            padding = -info.size % tarfile.BLOCKSIZE
+            written += info.size + padding
+            yield tarfile.NUL * padding
+    # End-of-archive marker, then pad to a whole record as tarfile does
+    written += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE)
+
+def schedule_archive(model_id: str, version: int, storage_path: str):
+    def report(future):
+        if future.exception():
+            logger.error(f"Archive build for {model_id} v{version} failed: {future.exception()}")
+    archive_pool.submit(version_archive, model_id, version, storage_path).add_done_callback(report)
+
+def artifact_response(request: Request, path: str, media_type: Optional[str] = None) -> Response:
+    """
+    Serve a stored file, answering If-None-Match / If-Modified-Since with 304.
+    
+    Starlette's FileResponse handles Range and If-Range, and hands the file to
+    the server as a zero-copy pathsend when the server supports it.
+    """
+    response = FileResponse(path, media_type=media_type, filename=os.path.basename(path),
+                            stat_result=os.stat(path), headers={"Cache-Control": "no-cache"})
+    etag = response.headers["etag"]
+    validators = {"ETag": etag, "Last-Modified": response.headers["last-modified"], "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=validators)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+            if int(os.stat(path).st_mtime) <= since.timestamp():
+                return Response(status_code=304, headers=validators)
+        except (TypeError, ValueError):
+            pass  # an unparseable date is ignored, per RFC 9110
+    return response
 
 # ---- Validation Functions ----
 
@@ -170,13 +558,12 @@ def validate_requirements_txt(requirements_content: str) -> Tuple[bool, Dict]:
         logger.error(f"Error validating requirements.txt: {e}")
         return False, {"error": f"Error validating requirements.txt: {str(e)}"}
 
-def validate_model_pth(model_path: str) -> Tuple[bool, Dict]:
+def validate_model_pth(file_size: Optional[int]) -> Tuple[bool, Dict]:
     logger.info("Validating model.pth")
     try:
-        if not os.path.exists(model_path):
+        if file_size is None:
             return False, {"error": "model.pth file not found"}
             
-        file_size = os.path.getsize(model_path)
         if file_size == 0:
             return False, {"error": "model.pth is empty"}
         
@@ -186,60 +573,361 @@ def validate_model_pth(model_path: str) -> Tuple[bool, Dict]:
         logger.error(f"Error validating model.pth: {e}")
         return False, {"error": f"Error validating model.pth: {str(e)}"}
 
-def find_file_in_zip_structure(extract_dir: str, required_files: List[str], optional_files: List[str] = None) -> Dict[str, str]:
+def find_members_in_zip(zip_ref: zipfile.ZipFile, required_files: List[str], optional_files: List[str] = None) -> Dict[str, zipfile.ZipInfo]:
     """
-    Find required and optional files in extracted zip structure.
+    Find required and optional files in a zip from its central directory, without extracting anything.
     
     Args:
-        extract_dir: Directory where zip was extracted
+        zip_ref: Open archive
         required_files: List of files that must be found
         optional_files: List of files that are optional
         
     Returns:
-        Dictionary mapping file names to their full paths
+        Dictionary mapping file names to their zip entries, preferring the shallowest match
     """
-    logger.info(f"Finding files in extracted structure: {extract_dir}")
-    
     optional_files = optional_files or []
-    all_files_to_find = set(required_files + optional_files)
-    
-    # Initialize results dictionary
-    found_files = {}
-    files_to_find = set(all_files_to_find)
-    
-    # First check if files are directly in the root
-    for filename in files_to_find.copy():
-        file_path = os.path.join(extract_dir, filename)
-        if os.path.isfile(file_path):
-            found_files[filename] = file_path
-            files_to_find.remove(filename)
-    
-    # If all files are found, return early
-    if not files_to_find:
-        logger.info("All files found at root level")
-        return found_files
-    
-    # Use recursive search for remaining files
-    for filename in files_to_find.copy():
-        for root, _, files in os.walk(extract_dir):
-            if filename in files:
-                found_files[filename] = os.path.join(root, filename)
-                logger.info(f"Found {filename} at {found_files[filename]}")
-                files_to_find.remove(filename)
-                break
+    wanted = set(required_files + optional_files)
+    
+    found_members = {}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        filename = os.path.basename(info.filename)
+        if filename not in wanted:
+            continue
+        current = found_members.get(filename)
+        if current is None or info.filename.count('/') < current.filename.count('/'):
+            found_members[filename] = info
     
     # Check if any required files are still missing
-    missing_required = [f for f in required_files if f not in found_files]
+    missing_required = [f for f in required_files if f not in found_members]
     if missing_required:
         error_msg = f"Required files not found in the zip: {', '.join(missing_required)}"
         logger.error(error_msg)
         raise FileNotFoundError(error_msg)
     
-    return found_files
+    return found_members
+
+def read_text_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo) -> str:
+    """Decompress a small text member straight into memory"""
+    if info.file_size > MAX_TEXT_MEMBER_BYTES:
+        raise ValidationError(f"{os.path.basename(info.filename)} is larger than {MAX_TEXT_MEMBER_BYTES} bytes")
+    return zip_ref.read(info).decode("utf-8")
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+def store_blob(source, target_path: str) -> Tuple[str, int, bool]:
+    """
+    Stream a file into the blob store and hardlink it at target_path.
+    
+    Content already in the store is not kept twice: the new copy is dropped and
+    the existing blob linked instead. Returns (sha256, size, newly_stored).
+    """
+    tmp_dir = os.path.join(BLOB_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    
+    digest = hashlib.sha256()
+    size = 0
+    with open(tmp_path, "wb") as f:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    sha256 = digest.hexdigest()
+    
+    path = blob_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.lexists(target_path):
+        os.unlink(target_path)
+    newly_stored = False
+    try:
+        while True:
+            try:
+                # Linking (not renaming) fails if the blob exists, so a concurrent upload never clobbers it
+                os.link(tmp_path, path)
+                newly_stored = True
+            except FileExistsError:
+                pass
+            try:
+                os.link(path, target_path)
+                break
+            except FileNotFoundError:
+                # Garbage-collected between the two links; publish our copy instead
+                continue
+    except OSError as e:
+        logger.warning(f"Hardlinks unavailable for {target_path} ({e}); storing a plain copy")
+        shutil.copyfile(tmp_path, target_path)
+    finally:
+        os.unlink(tmp_path)
+    return sha256, size, newly_stored
+
+def collect_blobs(conn, digests) -> int:
+    """Delete blobs that no stored version references any more; returns bytes reclaimed"""
+    reclaimed = 0
+    for sha256 in set(digests):
+        if blob_referenced(conn, sha256):
+            continue
+        path = blob_path(sha256)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        # Still linked from a version directory, e.g. an upload that has not committed yet
+        if st.st_nlink > 1:
+            continue
+        os.unlink(path)
+        reclaimed += st.st_size
+    if reclaimed:
+        logger.info(f"Reclaimed {reclaimed} bytes of unreferenced blobs")
+    return reclaimed
+
+class StorageCollector:
+    """
+    Reclaims NFS space in the background so deletes never wait on the filesystem.
+    
+    The delete endpoints only mark rows. This thread removes those versions'
+    files at a throttled rate, drops their rows and collects blobs nothing
+    references any more. Every GC_SWEEP_INTERVAL it also sweeps for orphans
+    older than GC_ORPHAN_MIN_AGE: version directories with no row, the
+    deployer's temp_extract folders, abandoned staging and stray blobs.
+    """
+    def __init__(self):
+        self.wake = threading.Event()
+        self.sweep_requested = False
+        self.last_sweep_at = 0.0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stats = {"bytes_reclaimed": 0, "versions_purged": 0, "orphans_removed": 0, "last_sweep": None}
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="storage-gc", daemon=True)
+            self.thread.start()
+    
+    def request(self, sweep: bool = False):
+        """Run a pass now rather than at the next interval"""
+        if sweep:
+            self.sweep_requested = True
+        self.wake.set()
+    
+    def _run(self):
+        while True:
+            self.wake.wait(GC_INTERVAL)
+            self.wake.clear()
+            try:
+                self.collect_deleted()
+                if self.sweep_requested or time.time() - self.last_sweep_at >= GC_SWEEP_INTERVAL:
+                    self.sweep_requested = False
+                    self.sweep_orphans()
+            except Exception as e:
+                logger.error(f"Storage collection failed: {str(e)}")
+    
+    def _record(self, **increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+    
+    def _remove(self, path: str) -> int:
+        """Unlink a file or tree at most GC_MAX_UNLINKS_PER_SECOND files a second; returns bytes freed"""
+        freed = 0
+        if os.path.islink(path) or not os.path.isdir(path):
+            targets = [(path, None)]
+        else:
+            targets = []
+            for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+                targets += [(os.path.join(dirpath, name), None) for name in filenames]
+                targets += [(os.path.join(dirpath, name), None) for name in dirnames
+                            if os.path.islink(os.path.join(dirpath, name))]
+                targets.append((dirpath, "dir"))
+        for target, kind in targets:
+            try:
+                if kind == "dir":
+                    os.rmdir(target)
+                    continue
+                st = os.lstat(target)
+                os.unlink(target)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Could not remove {target}: {str(e)}")
+                continue
+            # A version file is a hardlink to its blob; space only comes back with the last link
+            if st.st_nlink == 1:
+                freed += st.st_size
+            time.sleep(1 / GC_MAX_UNLINKS_PER_SECOND)
+        return freed
+    
+    def collect_deleted(self):
+        conn = get_db()
+        while True:
+            # A version deleted mid-validation keeps its row, and so its number, until the job lets go of it
+            with validation_jobs_lock:
+                in_flight = {(job["storage"]["model_id"], job["storage"]["version"])
+                             for job_id, job in validation_jobs.items()
+                             if not job["finished_at"] or job_id in validation_futures} | direct_uploads
+            rows = [row for row in get_deleted_versions(conn) if (row["model_id"], row["version"]) not in in_flight]
+            if not rows:
+                return
+            for row in rows:
+                model_id, version, path = row["model_id"], row["version"], row["storage_path"]
+                freed = 0
+                if path and os.path.exists(path) and not storage_path_in_use(conn, path):
+                    freed += self._remove(path)
+                    if os.path.exists(bundle_dir(path)):
+                        freed += self._remove(bundle_dir(path))
+                    model_dir = os.path.dirname(path)
+                    try:
+                        os.rmdir(model_dir)
+                    except OSError:
+                        pass  # other versions still live there
+                archive = archive_path(model_id, version)
+                if os.path.exists(archive):
+                    freed += self._remove(archive)
+                digests = delete_models(conn, model_id, version)
+                conn.commit()
+                freed += collect_blobs(conn, digests)
+                self._record(bytes_reclaimed=freed, versions_purged=1)
+                logger.info(f"Purged deleted {model_id} v{version}: {freed} bytes reclaimed")
+    
+    def sweep_orphans(self):
+        started = time.time()
+        cutoff = started - GC_ORPHAN_MIN_AGE
+        conn = get_db()
+        # Every path a row owns or will own once its upload publishes
+        owned = set()
+        for row in get_all_versions(conn):
+            owned.add(construct_nfs_path(row["model_id"], row["version"]))
+            if row["storage_path"]:
+                owned.add(row["storage_path"])
+                owned.add(bundle_dir(row["storage_path"]))
+        
+        def old(entry) -> bool:
+            try:
+                return entry.stat(follow_symlinks=False).st_mtime < cutoff
+            except FileNotFoundError:
+                return False
+        
+        freed, removed = 0, 0
+        for model_dir in os.scandir(NFS_BASE_DIR):
+            # .blobs, .uploads and .staging are handled on their own below
+            if model_dir.name.startswith(".") or not model_dir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(model_dir.path):
+                if entry.path in owned or not old(entry):
+                    continue
+                logger.info(f"Removing orphaned {entry.path}")
+                freed += self._remove(entry.path)
+                removed += 1
+            if old(model_dir):
+                try:
+                    os.rmdir(model_dir.path)
+                except OSError:
+                    pass
+        
+        with validation_jobs_lock:
+            active_jobs = set(validation_futures) | {job_id for job_id, job in validation_jobs.items() if not job["finished_at"]}
+        for entry in os.scandir(VALIDATION_STAGING_DIR):
+            if entry.name.split(".")[0] in active_jobs or not old(entry):
+                continue
+            freed += self._remove(entry.path)
+            removed += 1
+        
+        blob_tmp = os.path.join(BLOB_DIR, "tmp")
+        if os.path.isdir(blob_tmp):
+            for entry in os.scandir(blob_tmp):
+                if old(entry):
+                    freed += self._remove(entry.path)
+                    removed += 1
+        
+        # Archives are rebuilt on demand; drop ones for versions that are gone or not fetched in a while
+        for model_dir in os.scandir(ARCHIVE_CACHE_DIR):
+            if not model_dir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(model_dir.path):
+                version = entry.name[1:-len(".tar")] if entry.name.startswith("v") and entry.name.endswith(".tar") else ""
+                live = version.isdigit() and construct_nfs_path(model_dir.name, int(version)) in owned
+                # Archive mtimes mirror their version, so age them by ctime
+                built_at = entry.stat(follow_symlinks=False).st_ctime
+                if (live and built_at >= started - ARCHIVE_CACHE_TTL) or (not live and built_at >= cutoff):
+                    continue
+                freed += self._remove(entry.path)
+                removed += 1
+            try:
+                os.rmdir(model_dir.path)
+            except OSError:
+                pass
+        
+        if os.path.isdir(BLOB_DIR):
+            for prefix in os.scandir(BLOB_DIR):
+                if prefix.name == "tmp" or not prefix.is_dir():
+                    continue
+                for blob in os.scandir(prefix.path):
+                    if not old(blob) or blob.stat().st_nlink > 1 or blob_referenced(conn, blob.name):
+                        continue
+                    freed += self._remove(blob.path)
+                    removed += 1
+        
+        self.last_sweep_at = time.time()
+        self._record(bytes_reclaimed=freed, orphans_removed=removed)
+        with self.lock:
+            self.stats["last_sweep"] = {
+                "finished_at": datetime.utcnow().isoformat(),
+                "duration_seconds": round(self.last_sweep_at - started, 3),
+                "items_removed": removed,
+                "bytes_reclaimed": freed
+            }
+        logger.info(f"Orphan sweep removed {removed} items, reclaimed {freed} bytes")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats)
+
+storage_collector = StorageCollector()
+
+def materialize_from_zip(zip_ref: zipfile.ZipFile, destination: str, flatten: bool = True) -> List[Dict[str, Any]]:
+    """
+    Store every file member through the blob store and link it into destination.
+    
+    Each member is read exactly once. With flatten, files land under their base
+    name; otherwise the archive's directory layout is kept. Returns one
+    {"path", "sha256", "size"} entry per file written.
+    """
+    files = {}
+    new_bytes = 0
+    for file_info in zip_ref.infolist():
+        # Skip directories
+        if file_info.is_dir():
+            continue
+        
+        if flatten:
+            # Extract just the filename without path
+            relative_path = os.path.basename(file_info.filename)
+        else:
+            relative_path = os.path.normpath(file_info.filename.lstrip("/"))
+            if relative_path.startswith(".."):
+                raise ValidationError(f"Unsafe path in archive: {file_info.filename}")
+        
+        # Skip empty filenames (can happen with some zip formats)
+        if not relative_path or relative_path == ".":
+            continue
+        
+        target_path = os.path.join(destination, relative_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with zip_ref.open(file_info) as source:
+            sha256, size, newly_stored = store_blob(source, target_path)
+        if newly_stored:
+            new_bytes += size
+        files[relative_path] = {"path": relative_path, "sha256": sha256, "size": size}
+    
+    total = sum(f["size"] for f in files.values())
+    logger.info(f"Materialized {len(files)} files into {destination}: {new_bytes} new bytes, {total - new_bytes} deduplicated")
+    return list(files.values())
 
 def run_validation(
     model_id: str,
-    model_file_path: str,
+    model_file_size: Optional[int],
     meta_content: str,
     app_content: str,
     requirements_content: str,
@@ -251,7 +939,7 @@ def run_validation(
     meta_result = validate_meta_json(meta_content)
     app_result = validate_app_py(app_content)
     req_result = validate_requirements_txt(requirements_content)
-    model_result = validate_model_pth(model_file_path)
+    model_result = validate_model_pth(model_file_size)
     
     # Only validate webapp.py if it's provided
     if webapp_content is not None:
@@ -301,83 +989,43 @@ def run_validation(
     logger.info(f"Validation completed for model_id: {model_id}, is_valid: {is_valid}")
     return result
 
-@app.post("/registry/upload-and-validate/{model_id}", response_model=Dict)
-async def upload_and_validate_model(
-    model_id: str = Path(...),
-    model_file: UploadFile = File(...),
-    user_id: str = Form(...),
-    model_name: str = Form(...),
-    metadata: str = Form(default="{}")
-):
-    logger.info(f"Received upload and validation request for model_id: {model_id}")
-    logger.info(f"User ID: {user_id}, Model Name: {model_name}, Metadata: {metadata}")
-    
-    # Create temporary directory for validation
-    temp_dir = tempfile.mkdtemp()
-    extract_dir = os.path.join(temp_dir, "extracted")
-    os.makedirs(extract_dir, exist_ok=True)
+def validate_archive(model_id: str, zip_path: str, staging_path: str, user_id: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Check an uploaded archive and, if it is valid, write its files under staging_path.
     
-    # Create connection for database operations
-    conn = get_db()
+    Runs in a validation worker process, so it touches only files, never the
+    database. Returns (validation_result, stored_files).
+    """
+    # Verify it's a valid zip file
+    if not zipfile.is_zipfile(zip_path):
+        raise ValidationError("Uploaded file is not a valid zip file")
     
-    try:
-        # Check if model already exists for this user and get version
-        version = get_latest_version(conn, model_id)
-        
-        # Construct versioned storage path
-        nfs_path = construct_nfs_path(model_id, version)
-        os.makedirs(nfs_path, exist_ok=True)
-        
-        # Save zip file temporarily
-        zip_path = os.path.join(temp_dir, "model.zip")
-        with open(zip_path, "wb") as f:
-            content = await model_file.read()
-            f.write(content)
-        
-        # Verify it's a valid zip file
-        if not zipfile.is_zipfile(zip_path):
-            raise ValidationError("Uploaded file is not a valid zip file")
-        
-        # Extract the zip for validation
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_dir)
-        
-        # Find required and optional files in extracted structure
+    # Everything below works from the zip's central directory: small members are
+    # validated in memory and files are written to NFS once, only if valid
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        # Find required and optional files in the archive
         required_files = ["meta.json", "app.py", "requirements.txt", "model.pth"]
         optional_files = ["webapp.py"]
         
         try:
-            file_paths = find_file_in_zip_structure(extract_dir, required_files, optional_files)
+            members = find_members_in_zip(zip_ref, required_files, optional_files)
         except FileNotFoundError as e:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "request_id": f"val_{model_id}",
-                    "status": "FAILED",
-                    "error": str(e)
-                }
-            )
+            raise ValidationError(str(e))
         
         # Read file contents for validation
-        with open(file_paths["meta.json"], "r", encoding="utf-8") as f:
-            meta_content = f.read()
-
-        with open(file_paths["app.py"], "r", encoding="utf-8") as f:
-            app_content = f.read()
-
-        with open(file_paths["requirements.txt"], "r", encoding="utf-8") as f:
-            requirements_content = f.read()
+        meta_content = read_text_member(zip_ref, members["meta.json"])
+        app_content = read_text_member(zip_ref, members["app.py"])
+        requirements_content = read_text_member(zip_ref, members["requirements.txt"])
         
         # Check if webapp.py exists and read it if it does
         webapp_content = None
-        if "webapp.py" in file_paths:
-            with open(file_paths["webapp.py"], "r", encoding="utf-8") as f:
-                webapp_content = f.read()
+        if "webapp.py" in members:
+            webapp_content = read_text_member(zip_ref, members["webapp.py"])
         
         # Run validation
         validation_result = run_validation(
             model_id=model_id,
-            model_file_path=file_paths["model.pth"],
+            model_file_size=members["model.pth"].file_size,
             meta_content=meta_content,
             app_content=app_content,
             requirements_content=requirements_content,
@@ -386,104 +1034,325 @@ async def upload_and_validate_model(
         )
         
         # Only proceed with storage if validation passed
+        stored_files = []
         if validation_result["is_valid"]:
-            # Extract zip contents to nfs_path
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                for file_info in zip_ref.infolist():
-                    # Skip directories
-                    if file_info.filename.endswith('/'):
-                        continue
-                    
-                    # Extract just the filename without path
-                    filename = os.path.basename(file_info.filename)
-                    
-                    # Skip empty filenames (can happen with some zip formats)
-                    if not filename:
-                        continue
-                    
-                    # Extract the file to the version folder with just its filename
-                    source = zip_ref.open(file_info)
-                    target_path = os.path.join(nfs_path, filename)
-                    
-                    with open(target_path, "wb") as target:
-                        shutil.copyfileobj(source, target)
-                    
-                    logger.info(f"Extracted {filename} to {target_path}")
-            
-            # Store in database with model_name
-            conn.execute('''
-                INSERT INTO models (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status, validation_result)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                model_id,
-                model_name,
-                user_id,
-                version,
-                datetime.utcnow().isoformat(),
-                metadata,
-                nfs_path,
-                "validated_stored",
-                json.dumps(validation_result)
-            ))
-            conn.commit()
-            
-            return {
-                "request_id": f"val_{model_id}",
-                "status": "COMPLETED",
-                "result": validation_result,
-                "storage": {
-                    "model_id": model_id,
-                    "model_name": model_name,
-                    "version": version,
-                    "path": nfs_path
-                }
-            }
+            os.makedirs(staging_path, exist_ok=True)
+            stored_files = materialize_from_zip(zip_ref, staging_path)
+    
+    return validation_result, stored_files
+
+def bundle_dir(storage_path: str) -> str:
+    # Outside the version's own tree, so edits, archives and agent caches never pick it up
+    return storage_path.rstrip(os.sep) + BUNDLE_SUFFIX
+
+def parse_distribution_filename(filename: str) -> Optional[Tuple[str, str]]:
+    """(name, version) of a wheel or sdist file name, or None if it is neither"""
+    if filename.endswith(".whl"):
+        parts = filename[:-len(".whl")].split("-")
+        if len(parts) < 5:
+            return None
+        name, version = parts[0], parts[1]
+    else:
+        for suffix in (".tar.gz", ".zip", ".tar.bz2"):
+            if filename.endswith(suffix):
+                stem = filename[:-len(suffix)]
+                break
         else:
-            # Store failed validation result with model_name
-            conn.execute('''
-                INSERT INTO models (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status, validation_result)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                model_id,
-                model_name,
-                user_id,
-                version,
-                datetime.utcnow().isoformat(),
-                metadata,
-                None,
-                "validation_failed",
-                json.dumps(validation_result)
-            ))
-            conn.commit()
-            
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "request_id": f"val_{model_id}",
-                    "status": "FAILED",
-                    "result": validation_result,
-                }
-            )
+            return None
+        if "-" not in stem:
+            return None
+        name, version = stem.rsplit("-", 1)
+    return name.replace("_", "-").lower(), version
+
+def write_lock_file(wheels_dir: str, lock_path: str) -> int:
+    """Pin every downloaded distribution with its hash; returns how many packages are locked"""
+    hashes: Dict[Tuple[str, str], List[str]] = {}
+    for filename in sorted(os.listdir(wheels_dir)):
+        parsed = parse_distribution_filename(filename)
+        if parsed is None:
+            logger.warning(f"Leaving unrecognised file out of the lock: {filename}")
+            continue
+        digest = hashlib.sha256()
+        with open(os.path.join(wheels_dir, filename), "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        hashes.setdefault(parsed, []).append(digest.hexdigest())
+    
+    with open(lock_path, "w") as f:
+        f.write("# Generated by the model registry from requirements.txt; install with --no-index\n")
+        for (name, version), digests in sorted(hashes.items()):
+            f.write(f"{name}=={version}" + "".join(f" \\\n    --hash=sha256:{d}" for d in digests) + "\n")
+    return len(hashes)
+
+def build_bundle(model_id: str, version: int, storage_path: str):
+    """
+    Resolve a validated version's requirements into a lock file plus the wheels it needs.
     
-    except ValidationError as e:
-        logger.error(f"Validation error: {str(e)}")
-        error_result = {
-            "model_id": model_id,
-            "is_valid": False,
-            "errors": [str(e)]
+    Built beside the version's directory (see bundle_dir), via a scratch
+    directory renamed into place, so readers see either no bundle or a
+    complete one. Runs on the bundle pool; the outcome lands in bundle_status.
+    """
+    conn = get_db()
+    update_model_version(conn, model_id, version, bundle_status="building")
+    conn.commit()
+    lookup_cache.invalidate(model_id)
+    
+    target = bundle_dir(storage_path)
+    scratch = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}-{uuid.uuid4().hex[:8]}")
+    wheels_dir = os.path.join(scratch, "wheels")
+    started = time.time()
+    try:
+        os.makedirs(wheels_dir)
+        requirements = os.path.join(storage_path, "requirements.txt")
+        if os.path.exists(requirements) and open(requirements).read().strip():
+            command = [sys.executable, "-m", "pip", "download", "--quiet", "--disable-pip-version-check",
+                       "-r", requirements, "-d", wheels_dir]
+            if BUNDLE_PYTHON_VERSION or BUNDLE_PLATFORM:
+                # Cross-target downloads only work for binary wheels
+                command.append("--only-binary=:all:")
+                if BUNDLE_PYTHON_VERSION:
+                    command += ["--python-version", BUNDLE_PYTHON_VERSION]
+                if BUNDLE_PLATFORM:
+                    command += ["--platform", BUNDLE_PLATFORM]
+            result = subprocess.run(command, capture_output=True, text=True, timeout=BUNDLE_BUILD_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(f"pip download failed: {result.stderr.strip()[-2000:]}")
+        packages = write_lock_file(wheels_dir, os.path.join(scratch, "requirements.lock"))
+        with open(os.path.join(scratch, "bundle.json"), "w") as f:
+            json.dump({
+                "model_id": model_id,
+                "version": version,
+                "packages": packages,
+                "python_version": BUNDLE_PYTHON_VERSION or f"{sys.version_info.major}.{sys.version_info.minor}",
+                "platform": BUNDLE_PLATFORM,
+                "built_at": datetime.utcnow().isoformat()
+            }, f)
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(scratch, target)
+        status, error = "ready", None
+        logger.info(f"Bundle for {model_id} v{version} ready: {packages} packages in {time.time() - started:.1f}s")
+    except Exception as e:
+        shutil.rmtree(scratch, ignore_errors=True)
+        status, error = "failed", str(e)
+        logger.error(f"Bundle build for {model_id} v{version} failed: {error}")
+    
+    conn = get_db()
+    update_model_version(conn, model_id, version, bundle_status=status, bundle_error=error)
+    conn.commit()
+    lookup_cache.invalidate(model_id)
+    # Agents prefetch once the bundle settles, so warming installs from it rather than from PyPI
+    notify_prefetch(model_id, version)
+
+def schedule_bundle(model_id: str, version: int, storage_path: str):
+    def report(future):
+        if future.exception():
+            logger.error(f"Bundle job for {model_id} v{version} crashed: {future.exception()}")
+    bundle_pool.submit(build_bundle, model_id, version, storage_path).add_done_callback(report)
+
+def acquire_validation_slot():
+    """Claim room in the validation queue or turn the upload away before its body is stored"""
+    if not validation_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail=f"Validation queue is full ({VALIDATION_QUEUE_SIZE} jobs); retry later",
+            headers={"Retry-After": str(VALIDATION_RETRY_AFTER)}
+        )
+
+def staged_archive_path(job_id: str) -> str:
+    return os.path.join(VALIDATION_STAGING_DIR, f"{job_id}.zip")
+
+def staged_version_path(job_id: str) -> str:
+    """Where a job writes a version's files before they are published"""
+    return os.path.join(VALIDATION_STAGING_DIR, job_id)
+
+def publish_version(staging_path: str, nfs_path: str):
+    """Move a fully written version into place with a single rename on the same filesystem"""
+    os.makedirs(os.path.dirname(nfs_path), exist_ok=True)
+    if os.path.lexists(nfs_path):
+        # Only a leftover can be here: the version number was reserved for this upload alone
+        logger.warning(f"Replacing stale directory {nfs_path}")
+        shutil.rmtree(nfs_path)
+    shutil.rmtree(bundle_dir(nfs_path), ignore_errors=True)
+    os.rename(staging_path, nfs_path)
+
+def discard_staging(job_id: str):
+    if os.path.exists(staged_archive_path(job_id)):
+        os.remove(staged_archive_path(job_id))
+    shutil.rmtree(staged_version_path(job_id), ignore_errors=True)
+
+def submit_validation(
+    job_id: str,
+    model_id: str,
+    user_id: str,
+    model_name: str,
+    metadata: str,
+    archive_size: int,
+    archive_sha256: str
+) -> JSONResponse:
+    """
+    Reserve the next version of model_id and queue its staged archive for validation.
+    
+    The caller holds a validation slot and has written the archive to
+    staged_archive_path(job_id); both pass to the job from here on.
+    """
+    version = reserve_model_version(
+        get_db(),
+        model_id=model_id,
+        model_name=model_name,
+        user_id=user_id,
+        timestamp=datetime.utcnow().isoformat(),
+        metadata=metadata
+    )
+    lookup_cache.invalidate(model_id)
+    registry_events.publish("version.uploaded", model_id, version, model_name=model_name, user_id=user_id,
+                            status="validating", archive_sha256=archive_sha256)
+    nfs_path = construct_nfs_path(model_id, version)
+    storage = {
+        "model_id": model_id,
+        "model_name": model_name,
+        "version": version,
+        "path": nfs_path,
+        "archive_size": archive_size,
+        "archive_sha256": archive_sha256
+    }
+    job = {
+        "job_id": job_id,
+        "request_id": f"val_{model_id}",
+        "status": "QUEUED",
+        "submitted_at": datetime.utcnow().isoformat(),
+        "finished_at": None,
+        "result": None,
+        "storage": storage
+    }
+    with validation_jobs_lock:
+        validation_jobs[job_id] = job
+    
+    future = validation_pool.submit(validate_archive, model_id, staged_archive_path(job_id), staged_version_path(job_id), user_id)
+    validation_futures[job_id] = future
+    future.add_done_callback(lambda f: finish_validation_job(job_id, f))
+    logger.info(f"Queued validation job {job_id} for {model_id} v{version}")
+    
+    return JSONResponse(
+        status_code=202,
+        content={
+            "request_id": f"val_{model_id}",
+            "status": "ACCEPTED",
+            "job_id": job_id,
+            "status_url": f"/registry/validation-jobs/{job_id}",
+            "storage": storage
         }
+    )
+
+def finish_validation_job(job_id: str, future):
+    """Record a finished validation in the database; runs on the pool's result thread"""
+    job = validation_jobs[job_id]
+    storage = job["storage"]
+    model_id, version = storage["model_id"], storage["version"]
+    try:
+        try:
+            validation_result, stored_files = future.result()
+        except ValidationError as e:
+            logger.error(f"Validation error: {str(e)}")
+            validation_result, stored_files = {"model_id": model_id, "is_valid": False, "errors": [str(e)]}, []
+        except Exception as e:
+            logger.error(f"Validation job {job_id} crashed: {str(e)}")
+            validation_result, stored_files = {"model_id": model_id, "is_valid": False, "errors": [f"Server error: {str(e)}"]}, []
         
-        return JSONResponse(
-            status_code=400,
-            content={
-                "request_id": f"val_{model_id}",
-                "status": "FAILED",
-                "error": str(e)
-            }
+        conn = get_db()
+        deleted = get_model_version(conn, model_id, version) is None
+        if deleted:
+            validation_result = dict(validation_result, is_valid=False, errors=["Version was deleted during validation"])
+        elif validation_result["is_valid"]:
+            try:
+                publish_version(staged_version_path(job_id), storage["path"])
+            except OSError as e:
+                logger.error(f"Could not publish {model_id} v{version}: {str(e)}")
+                validation_result = dict(validation_result, is_valid=False, errors=[f"Could not store version: {str(e)}"])
+                stored_files = []
+        
+        if not deleted and validation_result["is_valid"]:
+            stored = update_model_version(
+                conn, model_id, version,
+                storage_path=storage["path"],
+                status="validated_stored",
+                validation_result=json.dumps(validation_result),
+                bundle_status="pending"
+            )
+            if stored:
+                record_model_files(conn, model_id, version, stored_files)
+            else:
+                # Deleted between the check above and now; take back what was published
+                shutil.rmtree(storage["path"], ignore_errors=True)
+                deleted = True
+                validation_result = dict(validation_result, is_valid=False, errors=["Version was deleted during validation"])
+        elif not deleted:
+            update_model_version(
+                conn, model_id, version,
+                storage_path=None,
+                status="validation_failed",
+                validation_result=json.dumps(validation_result)
+            )
+        conn.commit()
+        lookup_cache.invalidate(model_id)
+        if deleted:
+            logger.info(f"{model_id} v{version} was deleted while job {job_id} validated it; discarded")
+            storage_collector.request()
+        elif validation_result["is_valid"]:
+            registry_events.publish("version.validated", model_id, version, model_name=storage["model_name"],
+                                    path=storage["path"])
+            schedule_bundle(model_id, version, storage["path"])
+        else:
+            registry_events.publish("version.failed", model_id, version, model_name=storage["model_name"],
+                                    errors=validation_result.get("errors", []))
+        
+        job.update(
+            status="COMPLETED" if validation_result["is_valid"] else "FAILED",
+            result=validation_result,
+            finished_at=datetime.utcnow().isoformat()
         )
+        logger.info(f"Validation job {job_id} finished: {job['status']}")
+    except Exception as e:
+        logger.error(f"Could not record validation job {job_id}: {str(e)}")
+        job.update(status="FAILED", result={"is_valid": False, "errors": [f"Server error: {str(e)}"]},
+                   finished_at=datetime.utcnow().isoformat())
+    finally:
+        validation_futures.pop(job_id, None)
+        discard_staging(job_id)
+        validation_slots.release()
+        with validation_jobs_lock:
+            # Keep the most recent finished jobs around for status queries
+            finished = [jid for jid, j in validation_jobs.items() if j["finished_at"]]
+            for jid in finished[:max(0, len(finished) - VALIDATION_JOB_HISTORY)]:
+                del validation_jobs[jid]
+
+@app.post("/registry/upload-and-validate/{model_id}", response_model=Dict)
+async def upload_and_validate_model(
+    model_id: str = Path(...),
+    model_file: UploadFile = File(...),
+    user_id: str = Form(...),
+    model_name: str = Form(...),
+    metadata: str = Form(default="{}")
+):
+    logger.info(f"Received upload and validation request for model_id: {model_id}")
+    logger.info(f"User ID: {user_id}, Model Name: {model_name}, Metadata: {metadata}")
+    
+    acquire_validation_slot()
+    job_id = uuid.uuid4().hex
+    zip_path = staged_archive_path(job_id)
+    try:
+        # Stage the archive where the validation worker will pick it up
+        archive_size, archive_sha256 = await save_upload(model_file, zip_path)
+        logger.info(f"Received {archive_size} bytes for {model_id} (sha256 {archive_sha256})")
         
+        # Reserving takes SQLite's write lock, which may wait out the busy timeout
+        return await run_in_threadpool(submit_validation, job_id, model_id, user_id, model_name, metadata,
+                                       archive_size, archive_sha256)
+    
     except Exception as e:
         logger.error(f"Server error: {str(e)}")
+        validation_slots.release()
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
         return JSONResponse(
             status_code=500,
             content={
@@ -492,119 +1361,399 @@ async def upload_and_validate_model(
                 "error": f"Server error: {str(e)}"
             }
         )
+
+@app.get("/registry/validation-jobs/{job_id}")
+def get_validation_job(job_id: str):
+    with validation_jobs_lock:
+        job = validation_jobs.get(job_id)
+    if job is None:
+        # Finished jobs are forgotten eventually; fetch-validation keeps the result for good
+        raise HTTPException(status_code=404, detail="Validation job not found")
     
-    finally:
-        # Clean up temporary directory
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        conn.close()
+    status = job["status"]
+    future = validation_futures.get(job_id)
+    if status == "QUEUED" and future is not None and future.running():
+        status = "RUNNING"
+    return dict(job, status=status)
 
-@app.post("/registry/upload-model/{model_id}")
-async def upload_model(
+def upload_session_dir(upload_id: str) -> str:
+    try:
+        if uuid.UUID(hex=upload_id).hex != upload_id:
+            raise ValueError(upload_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return os.path.join(UPLOAD_SESSION_DIR, upload_id)
+
+def load_upload_session(upload_id: str) -> Dict[str, Any]:
+    session_dir = upload_session_dir(upload_id)
+    try:
+        with open(os.path.join(session_dir, "session.json")) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    session["data_path"] = os.path.join(session_dir, "archive.zip")
+    return session
+
+def upload_session_progress(upload_id: str, session: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Report how much of the archive is safely stored.
+    
+    Only whole chunks count: the tail of a chunk cut off mid-request is
+    overwritten when the client resends that chunk.
+    """
+    chunk_size = session["chunk_size"]
+    total_size = session["total_size"]
+    size = min(os.path.getsize(session["data_path"]), total_size)
+    received = size if size == total_size else size - size % chunk_size
+    return {
+        "upload_id": upload_id,
+        "model_id": session["model_id"],
+        "total_size": total_size,
+        "chunk_size": chunk_size,
+        "received_bytes": received,
+        "next_chunk": received // chunk_size,
+        "next_offset": received,
+        "complete": received == total_size
+    }
+
+def expire_upload_sessions():
+    """Remove sessions that have seen no chunk for UPLOAD_SESSION_TTL seconds"""
+    cutoff = datetime.utcnow().timestamp() - UPLOAD_SESSION_TTL
+    for upload_id in os.listdir(UPLOAD_SESSION_DIR):
+        session_dir = os.path.join(UPLOAD_SESSION_DIR, upload_id)
+        data_path = os.path.join(session_dir, "archive.zip")
+        try:
+            last_activity = os.path.getmtime(data_path if os.path.exists(data_path) else session_dir)
+        except FileNotFoundError:
+            continue
+        if last_activity < cutoff:
+            logger.info(f"Expiring abandoned upload session {upload_id}")
+            shutil.rmtree(session_dir, ignore_errors=True)
+            lock = upload_session_locks.get(upload_id)
+            if lock is not None and not lock.locked():
+                upload_session_locks.pop(upload_id, None)
+
+@app.post("/registry/uploads/{model_id}")
+def create_upload_session(
     model_id: str = Path(...),
-    model: UploadFile = File(...),
     user_id: str = Form(...),
-    model_name: str = Form(...),  # Added model_name parameter
+    model_name: str = Form(...),
+    total_size: int = Form(...),
+    sha256: Optional[str] = Form(default=None),
     metadata: str = Form(default="{}")
 ):
-    conn = get_db()
-
-    # 1. Check if model already exists for this user
-    row = conn.execute('''
-        SELECT model_id FROM models 
-        WHERE model_id = ? 
-        ORDER BY version DESC LIMIT 1
-    ''', (model_id,)).fetchone()
+    if total_size <= 0:
+        raise HTTPException(status_code=400, detail="total_size must be positive")
+    expire_upload_sessions()
+    
+    upload_id = uuid.uuid4().hex
+    session_dir = os.path.join(UPLOAD_SESSION_DIR, upload_id)
+    os.makedirs(session_dir)
+    session = {
+        "model_id": model_id,
+        "user_id": user_id,
+        "model_name": model_name,
+        "metadata": metadata,
+        "total_size": total_size,
+        "sha256": sha256.lower() if sha256 else None,
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE,
+        "created_at": datetime.utcnow().isoformat()
+    }
+    open(os.path.join(session_dir, "archive.zip"), "wb").close()
+    with open(os.path.join(session_dir, "session.json"), "w") as f:
+        json.dump(session, f)
+    
+    logger.info(f"Opened upload session {upload_id} for {model_id}: {total_size} bytes")
+    return {
+        "upload_id": upload_id,
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE,
+        "total_size": total_size
+    }
 
-    if row:
-        version = get_latest_version(conn, model_id)
-    else:
-        version = 1
+@app.put("/registry/uploads/{upload_id}/chunks/{chunk_index}")
+async def upload_chunk(request: Request, upload_id: str, chunk_index: int, offset: int = Query(...)):
+    # Async only to stream the body; every file operation runs on the threadpool
+    session = await run_in_threadpool(load_upload_session, upload_id)
+    chunk_size = session["chunk_size"]
+    total_size = session["total_size"]
+    
+    if chunk_index < 0 or offset != chunk_index * chunk_size:
+        raise HTTPException(status_code=400, detail=f"Chunk {chunk_index} must start at offset {chunk_index * chunk_size}")
+    if offset >= total_size:
+        raise HTTPException(status_code=400, detail=f"Offset {offset} is past the end of the archive")
+    progress = await run_in_threadpool(upload_session_progress, upload_id, session)
+    if offset > progress["received_bytes"]:
+        # Chunks may be resent but not skipped, so the staged file never has holes
+        raise HTTPException(status_code=409, detail=progress)
+    
+    lock = upload_session_locks.setdefault(upload_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Another request is writing to this upload session")
+    try:
+        expected = min(chunk_size, total_size - offset)
+        written = 0
+        pending = bytearray()
+        f = await run_in_threadpool(open, session["data_path"], "r+b")
+        try:
+            await run_in_threadpool(f.seek, offset)
+            async for data in request.stream():
+                written += len(data)
+                if written > expected:
+                    raise HTTPException(status_code=413, detail=f"Chunk {chunk_index} is larger than {expected} bytes")
+                pending += data
+                # Hand the disk whole UPLOAD_CHUNK_SIZE pieces rather than one thread hop per network read
+                if len(pending) >= UPLOAD_CHUNK_SIZE:
+                    await run_in_threadpool(f.write, bytes(pending))
+                    pending.clear()
+            if pending:
+                await run_in_threadpool(f.write, bytes(pending))
+        finally:
+            await run_in_threadpool(f.close)
+        if written != expected:
+            raise HTTPException(status_code=400, detail=f"Chunk {chunk_index} has {written} bytes, expected {expected}")
+    finally:
+        lock.release()
+    
+    return await run_in_threadpool(upload_session_progress, upload_id, session)
 
-    # 2. Construct versioned storage path
-    # nfs_main_path = os.path.join(NFS_BASE_DIR, model_id)
-    nfs_path = construct_nfs_path(model_id, version)
-    os.makedirs(nfs_path, exist_ok=True)
-    # os.chmod(nfs_main_path, 0o777)
-    # perms = str(oct(os.stat(nfs_path).st_mode))
-    # logger.info(perms)
+@app.get("/registry/uploads/{upload_id}")
+def get_upload_progress(upload_id: str):
+    return upload_session_progress(upload_id, load_upload_session(upload_id))
 
-    # 3. Save zip file temporarily and extract
-    temp_path = os.path.join(nfs_path, "temp.zip")
+@app.post("/registry/uploads/{upload_id}/finalize", response_model=Dict)
+def finalize_upload(upload_id: str):
+    session = load_upload_session(upload_id)
+    progress = upload_session_progress(upload_id, session)
+    if not progress["complete"]:
+        raise HTTPException(status_code=409, detail=progress)
+    
+    lock = upload_session_locks.setdefault(upload_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Upload session is busy")
     try:
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        model_id = session["model_id"]
+        # Drop any bytes past total_size left behind by an oversized retry
+        os.truncate(session["data_path"], session["total_size"])
         
-        # Save the uploaded file
-        with open(temp_path, "wb") as f:
-            content = await model.read()
-            f.write(content)
+        digest = hashlib.sha256()
+        with open(session["data_path"], "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        archive_sha256 = digest.hexdigest()
+        if session["sha256"] and session["sha256"] != archive_sha256:
+            logger.error(f"Upload session {upload_id} checksum mismatch: {archive_sha256} != {session['sha256']}")
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "request_id": f"val_{model_id}",
+                    "status": "FAILED",
+                    "error": "Uploaded archive does not match the declared sha256"
+                }
+            )
         
-        # Extract the zip file
+        logger.info(f"Finalizing upload session {upload_id}: {session['total_size']} bytes for {model_id} (sha256 {archive_sha256})")
+        acquire_validation_slot()
+        job_id = uuid.uuid4().hex
+        try:
+            os.replace(session["data_path"], staged_archive_path(job_id))
+            result = submit_validation(
+                job_id,
+                model_id,
+                session["user_id"],
+                session["model_name"],
+                session["metadata"],
+                session["total_size"],
+                archive_sha256
+            )
+        except Exception:
+            validation_slots.release()
+            raise
+        shutil.rmtree(upload_session_dir(upload_id), ignore_errors=True)
+        return result
+    finally:
+        lock.release()
+        upload_session_locks.pop(upload_id, None)
+
+@app.delete("/registry/uploads/{upload_id}")
+def abort_upload(upload_id: str):
+    session_dir = upload_session_dir(upload_id)
+    if not os.path.isdir(session_dir):
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    shutil.rmtree(session_dir, ignore_errors=True)
+    upload_session_locks.pop(upload_id, None)
+    return {"message": "Upload session aborted"}
+
+def discard_reserved_version(model_id: str, version: int):
+    """Give back a version number whose direct upload did not complete"""
+    conn = get_db()
+    delete_models(conn, model_id, version)
+    conn.commit()
+
+def store_uploaded_version(job_id: str, model_id: str, version: int, model_name: str, user_id: str,
+                           archive_sha256: str):
+    """Extract a staged direct upload, publish it as model_id v<version> and record it; runs on the threadpool"""
+    conn = get_db()
+    nfs_path = construct_nfs_path(model_id, version)
+    try:
         try:
-            with zipfile.ZipFile(temp_path, 'r') as zip_ref:
-                zip_ref.extractall(nfs_path)
+            with zipfile.ZipFile(staged_archive_path(job_id), 'r') as zip_ref:
+                stored_files = materialize_from_zip(zip_ref, staged_version_path(job_id), flatten=False)
         except zipfile.BadZipFile:
             raise HTTPException(status_code=400, detail="Uploaded file is not a valid zip")
-    finally:
-        # Only remove if the file exists
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-    # 4. Store metadata and model info including model_name
-    conn.execute('''
-        INSERT INTO models (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        model_id,
-        model_name,  # Store model_name
-        user_id,
-        version,
-        datetime.utcnow().isoformat(),
-        metadata,
-        nfs_path,
-        "stored"
-    ))
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        publish_version(staged_version_path(job_id), nfs_path)
+    except Exception:
+        # Give the number back; nothing of this upload stays on disk
+        discard_reserved_version(model_id, version)
+        raise
+    
+    # Store metadata and model info including model_name
+    if not update_model_version(conn, model_id, version, storage_path=nfs_path, status="stored"):
+        # Deleted while it was uploading; take back what was published, as finish_validation_job does
+        conn.commit()
+        shutil.rmtree(nfs_path, ignore_errors=True)
+        with validation_jobs_lock:
+            direct_uploads.discard((model_id, version))
+        storage_collector.request()
+        raise HTTPException(status_code=409, detail="Model version was deleted during upload")
+    record_model_files(conn, model_id, version, stored_files)
     conn.commit()
-    conn.close()
+    lookup_cache.invalidate(model_id)
+    registry_events.publish("version.uploaded", model_id, version, model_name=model_name, user_id=user_id,
+                            status="stored", archive_sha256=archive_sha256, path=nfs_path)
+
+@app.post("/registry/upload-model/{model_id}")
+async def upload_model(
+    model_id: str = Path(...),
+    model: UploadFile = File(...),
+    user_id: str = Form(...),
+    model_name: str = Form(...),  # Added model_name parameter
+    metadata: str = Form(default="{}")
+):
+    # Only receiving the body happens on the event loop; SQLite and extraction run on the threadpool
+    # 1. Reserve the next version for this model (1 if it is new)
+    version = await run_in_threadpool(lambda: reserve_model_version(
+        get_db(),
+        model_id=model_id,
+        model_name=model_name,  # Store model_name
+        user_id=user_id,
+        timestamp=datetime.utcnow().isoformat(),
+        metadata=metadata,
+        status="uploading"
+    ))
 
-    return {"message": "Model uploaded", "model_id": model_id, "model_name": model_name, "version": version}
+    # 2. Save and extract into staging, then publish the version with one rename
+    job_id = uuid.uuid4().hex
+    # Like a validation job, the upload keeps its row, and so its number, until it is done
+    with validation_jobs_lock:
+        direct_uploads.add((model_id, version))
+    try:
+        # Save the uploaded file
+        try:
+            archive_size, archive_sha256 = await save_upload(model, staged_archive_path(job_id))
+        except Exception:
+            await run_in_threadpool(discard_reserved_version, model_id, version)
+            raise
+        logger.info(f"Received {archive_size} bytes for {model_id} (sha256 {archive_sha256})")
+        
+        # 3. Extract, publish and store metadata
+        await run_in_threadpool(store_uploaded_version, job_id, model_id, version, model_name, user_id, archive_sha256)
+    finally:
+        with validation_jobs_lock:
+            direct_uploads.discard((model_id, version))
+        await run_in_threadpool(discard_staging, job_id)
+
+    return {"message": "Model uploaded", "model_id": model_id, "model_name": model_name, "version": version,
+            "archive_size": archive_size, "archive_sha256": archive_sha256}
 
 @app.get("/registry/fetch-model/{model_id}/{version}")
-def fetch_model_version(model_id: str, version: int):
-    conn = get_db()
-    row = conn.execute('''
-        SELECT storage_path, model_name FROM models WHERE model_id = ? AND version = ?
-    ''', (model_id, version)).fetchone()
-    conn.close()
+def fetch_model_version(request: Request, model_id: str, version: int):
+    return cached_lookup(request, model_id, version)
 
-    if not row:
+@app.get("/registry/fetch-model/{model_id}")
+def fetch_latest_model(request: Request, model_id: str):
+    return cached_lookup(request, model_id, None)
+
+@app.get("/registry/artifacts/{model_id}/{version}/archive")
+def download_version_archive(request: Request, model_id: str, version: int):
+    row = get_model_location(get_db(), model_id, version)
+    if not row or not os.path.isdir(row["storage_path"] or ""):
         raise HTTPException(status_code=404, detail="Model version not found")
-    return {"path": row["storage_path"], "model_name": row["model_name"], "version": version}
+    path = cached_archive(model_id, version, row["storage_path"])
+    if path:
+        return artifact_response(request, path, media_type="application/x-tar")
+    # Not built yet: stream this download as it is generated and build the cached copy, which
+    # serves ranges and validators, in the background
+    schedule_archive(model_id, version, row["storage_path"])
+    return StreamingResponse(stream_version_archive(row["storage_path"]), media_type="application/x-tar",
+                             headers={"Content-Disposition": f'attachment; filename="v{version}.tar"',
+                                      "Cache-Control": "no-cache"})
 
-@app.get("/registry/fetch-model/{model_id}")
-def fetch_latest_model(model_id: str):
+@app.get("/registry/artifacts/{model_id}/{version}/manifest")
+def version_manifest(
+    request: Request,
+    model_id: str,
+    version: int,
+    base: Optional[int] = Query(default=None, description="Also report what changed since this version")
+):
+    """
+    Every file of a stored version with its size and SHA-256.
+    
+    With base, the response also says which paths were added, changed or
+    removed relative to that version, so a client holding it can fetch only
+    the difference.
+    """
     conn = get_db()
-    row = conn.execute('''
-        SELECT storage_path, model_name, version FROM models WHERE model_id = ? ORDER BY version DESC LIMIT 1
-    ''', (model_id,)).fetchone()
-    conn.close()
+    if not get_model_location(conn, model_id, version):
+        raise HTTPException(status_code=404, detail="Model version not found")
+    files = get_model_files(conn, model_id, version)
+    if not files:
+        raise HTTPException(status_code=404, detail="No file manifest recorded for this version")
+    body = {
+        "model_id": model_id,
+        "version": version,
+        "files": files,
+        "total_bytes": sum(f["size"] for f in files)
+    }
+    if base is not None:
+        if not get_model_location(conn, model_id, base):
+            raise HTTPException(status_code=404, detail="Base version not found")
+        previous = {f["path"]: f["sha256"] for f in get_model_files(conn, model_id, base)}
+        current = {f["path"]: f["sha256"] for f in files}
+        body["base"] = base
+        body["changes"] = {
+            "added": sorted(path for path in current if path not in previous),
+            "changed": sorted(path for path in current if path in previous and previous[path] != current[path]),
+            "removed": sorted(path for path in previous if path not in current)
+        }
+    
+    # A stored version's files never change, so a hash of the answer is a stable validator
+    etag = '"' + hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=body, headers=headers)
 
-    if not row:
-        raise HTTPException(status_code=404, detail="Model not found")
-    return {"path": row["storage_path"], "model_name": row["model_name"], "version": row["version"]}
+@app.get("/registry/artifacts/{model_id}/{version}/files/{file_path:path}")
+def download_version_file(request: Request, model_id: str, version: int, file_path: str):
+    row = get_model_location(get_db(), model_id, version)
+    if not row or not row["storage_path"]:
+        raise HTTPException(status_code=404, detail="Model version not found")
+    root = os.path.realpath(row["storage_path"])
+    path = os.path.realpath(os.path.join(root, file_path))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return artifact_response(request, path)
 
 @app.get("/registry/fetch-validation/{model_id}/{version}")
 def fetch_validation_result(model_id: str, version: int):
-    conn = get_db()
-    row = conn.execute('''
-        SELECT validation_result, model_name FROM models WHERE model_id = ? AND version = ?
-    ''', (model_id, version)).fetchone()
-    conn.close()
+    row = get_model_version(get_db(), model_id, version)
 
     if not row:
         raise HTTPException(status_code=404, detail="Model version not found")
     
-    result = {"model_name": row["model_name"]}
+    result = {"model_name": row["model_name"], "status": row["status"]}
     
     if row["validation_result"]:
         result.update(json.loads(row["validation_result"]))
@@ -615,60 +1764,124 @@ def fetch_validation_result(model_id: str, version: int):
 
 @app.get("/registry/display-model/{user_id}", response_model=List[Dict])
 def display_user_models(user_id: str):
-    conn = get_db()
-    rows = conn.execute('''
-        SELECT * FROM models WHERE user_id = ?
-    ''', (user_id,)).fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return list_models(get_db(), user_id)
 
 @app.get("/registry/display-model", response_model=List[Dict])
 def display_all_models():
-    conn = get_db()
-    rows = conn.execute('''
-        SELECT * FROM models
-    ''').fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return list_models(get_db())
+
+def encode_cursor(model_name: str) -> str:
+    return base64.urlsafe_b64encode(model_name.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/registry/models")
+def list_models_page(
+    limit: int = Query(default=LISTING_DEFAULT_LIMIT, ge=1, le=LISTING_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: str = LISTING_DEFAULT_FIELDS,
+    user_id: Optional[str] = None,
+    status: Optional[str] = None,
+    name: Optional[str] = None
+):
+    """
+    Page through models grouped by name, newest version first within each.
+    
+    fields picks the columns returned per version; pass the returned
+    next_cursor back as cursor to get the following page.
+    """
+    projection = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in projection if f not in LISTING_FIELDS]
+    if unknown or not projection:
+        raise HTTPException(status_code=400, detail=f"fields must be drawn from: {', '.join(LISTING_FIELDS)}")
+    
+    after = decode_cursor(cursor) if cursor else None
+    groups, has_more = list_model_groups(
+        get_db(), limit, after=after, fields=projection, user_id=user_id, status=status, name=name
+    )
+    return {
+        "models": groups,
+        "next_cursor": encode_cursor(groups[-1]["model_name"]) if has_more else None
+    }
 
 @app.delete("/registry/delete-model/{model_id}/{version}")
 def delete_model_version(model_id: str, version: int):
     conn = get_db()
-    row = conn.execute('SELECT storage_path FROM models WHERE model_id = ? AND version = ?', (model_id, version)).fetchone()
-    if not row:
-        conn.close()
+    if not mark_deleted(conn, model_id, version):
         raise HTTPException(status_code=404, detail="Model version not found")
-
-    path = row["storage_path"]
-    if path and os.path.exists(path):
-        shutil.rmtree(path, ignore_errors=True)
-    
-    conn.execute('DELETE FROM models WHERE model_id = ? AND version = ?', (model_id, version))
     conn.commit()
-    conn.close()
-    return {"message": "Model version deleted"}
+    lookup_cache.invalidate(model_id)
+    registry_events.publish("version.deleted", model_id, version)
+    # Files are removed by the storage collector
+    storage_collector.request()
+    return {"message": "Model version deleted", "reclaim": "scheduled"}
 
 @app.delete("/registry/delete-model/{model_id}")
 def delete_all_versions(model_id: str):
     conn = get_db()
-    rows = conn.execute('SELECT DISTINCT storage_path FROM models WHERE model_id = ?', (model_id,)).fetchall()
-    if not rows:
-        conn.close()
+    if not mark_deleted(conn, model_id):
         raise HTTPException(status_code=404, detail="Model not found")
+    conn.commit()
+    lookup_cache.invalidate(model_id)
+    # version None: every version of the model
+    registry_events.publish("version.deleted", model_id)
+    storage_collector.request()
+    return {"message": "All versions deleted", "reclaim": "scheduled"}
 
-    for row in rows:
-        if row["storage_path"] and os.path.exists(row["storage_path"]):
-            parent_folder = os.path.dirname(row["storage_path"])
-            shutil.rmtree(parent_folder, ignore_errors=True)
+@app.get("/registry/events")
+async def list_events(
+    after: int = Query(default=0, ge=0, description="Sequence number of the last event already seen"),
+    limit: int = Query(default=100, ge=1, le=EVENT_HISTORY),
+    wait: float = Query(default=0, ge=0, le=EVENT_POLL_MAX_WAIT, description="Seconds to hold the request open for new events")
+):
+    """
+    Registry events after a sequence number, for consumers without Kafka.
+    
+    A stream_id different from the one a consumer last saw means the registry
+    restarted and numbering began again; truncated means events between after
+    and the first one returned were dropped from history.
+    """
+    deadline = time.monotonic() + wait
+    events, truncated = registry_events.since(after, limit)
+    while not events and time.monotonic() < deadline:
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+        events, truncated = registry_events.since(after, limit)
+    return {
+        "stream_id": registry_events.stream_id,
+        "events": events,
+        "last_sequence": registry_events.sequence,
+        "truncated": truncated
+    }
 
-    conn.execute('DELETE FROM models WHERE model_id = ?', (model_id,))
-    conn.commit()
-    conn.close()
-    return {"message": "All versions deleted"}
+@app.get("/registry/gc")
+def storage_collection_status():
+    return dict(storage_collector.snapshot(), pending_versions=count_deleted_versions(get_db()))
+
+@app.post("/registry/gc/sweep")
+def request_orphan_sweep():
+    storage_collector.request(sweep=True)
+    return {"message": "Sweep scheduled"}
+
+@app.on_event("startup")
+def start_background_work():
+    init_db()
+    recover_interrupted_work()
+    storage_collector.start()
+    registry_events.connect(KAFKA_BOOTSTRAP_SERVERS, REGISTRY_EVENTS_TOPIC)
+
+@app.on_event("shutdown")
+def stop_validation_pool():
+    validation_pool.shutdown(wait=False, cancel_futures=True)
+    bundle_pool.shutdown(wait=False, cancel_futures=True)
+    registry_events.close()
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "fetch_cache": lookup_cache.stats(), "storage_gc": storage_collector.snapshot()}
 
 
 def get_local_ip():
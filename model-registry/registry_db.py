@@ -0,0 +1,313 @@
+"""Metadata store for the model registry.
+
+Connections are opened once per thread and reused across requests, in WAL
+mode so the frontend's direct reads never block registry writes. The schema
+is versioned with PRAGMA user_version; add new steps to MIGRATIONS, never
+edit ones that have shipped.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import DB_PATH
+
+logger = logging.getLogger("model_registry")
+
+BUSY_TIMEOUT_MS = 5000  # how long a writer waits for another writer before raising "database is locked"
+
+# (version, description, statements); applied in order, each in its own transaction
+MIGRATIONS = [
+    (1, "baseline schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model_id TEXT,
+            model_name TEXT,
+            user_id TEXT,
+            version INTEGER,
+            timestamp TEXT,
+            metadata TEXT,
+            storage_path TEXT,
+            status TEXT,
+            validation_result TEXT
+        )
+        ''',
+        # One row per file of a stored version; the rows referencing a blob are its reference count
+        '''
+        CREATE TABLE IF NOT EXISTS model_files (
+            model_id TEXT,
+            version INTEGER,
+            path TEXT,
+            sha256 TEXT,
+            size INTEGER,
+            PRIMARY KEY (model_id, version, path)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_model_files_sha256 ON model_files (sha256)',
+    ]),
+    (2, "lookup indexes", [
+        # Covers MAX(version) and the fetch-model lookups without touching the table
+        'CREATE INDEX IF NOT EXISTS idx_models_model_version ON models (model_id, version, model_name, storage_path)',
+        'CREATE INDEX IF NOT EXISTS idx_models_user ON models (user_id, model_id, version)',
+        'ANALYZE',
+    ]),
+    (3, "model listing index", [
+        # Lets the paginated listing walk models in name order and stop after one page
+        'CREATE INDEX IF NOT EXISTS idx_models_name ON models (model_name, version, user_id)',
+    ]),
+    (4, "deploy bundle status", [
+        # NULL for versions that predate bundles or never validated
+        'ALTER TABLE models ADD COLUMN bundle_status TEXT',
+        'ALTER TABLE models ADD COLUMN bundle_error TEXT',
+        # Keep fetch-model covered now that it reports the bundle too
+        'DROP INDEX IF EXISTS idx_models_model_version',
+        'CREATE INDEX idx_models_model_version ON models (model_id, version, model_name, storage_path, bundle_status)',
+    ]),
+    (5, "unique version numbers", [
+        # Concurrent uploads could once share a number; move the later rows past the model's
+        # highest version (id keeps them distinct) so the unique index can be built
+        '''
+        UPDATE models
+        SET version = (SELECT MAX(m.version) FROM models m WHERE m.model_id = models.model_id) + id
+        WHERE id NOT IN (SELECT MIN(id) FROM models GROUP BY model_id, version)
+        ''',
+        'CREATE UNIQUE INDEX idx_models_unique_version ON models (model_id, version)',
+    ]),
+    (6, "logical deletes", [
+        'ALTER TABLE models ADD COLUMN deleted_at TEXT',
+        # The storage collector's work queue
+        "CREATE INDEX idx_models_deleted ON models (deleted_at) WHERE status = 'deleted'",
+    ]),
+]
+
+# Columns a listing may project for each version
+LISTING_FIELDS = (
+    "model_id", "model_name", "user_id", "version", "timestamp",
+    "metadata", "storage_path", "status", "validation_result", "bundle_status"
+)
+
+_local = threading.local()
+
+def connect(path: str = DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Durable at checkpoints; a power cut can lose the last commits but never corrupts the file
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+def get_db() -> sqlite3.Connection:
+    """Return this thread's connection, opening it on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+    elif conn.in_transaction:
+        # A previous request on this thread failed before commit; don't inherit its writes
+        conn.rollback()
+    return conn
+
+def close_db():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def migrate(conn: sqlite3.Connection):
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Applying registry schema migration {version}: {description}")
+        try:
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+
+# ---- Queries ----
+
+def get_latest_version(conn, model_id: str) -> int:
+    """Next version number to assign for model_id"""
+    row = conn.execute('SELECT MAX(version) FROM models WHERE model_id = ?', (model_id,)).fetchone()
+    return (row[0] or 0) + 1
+
+def insert_model(conn, model_id: str, model_name: str, user_id: str, version: int, timestamp: str,
+                 metadata: str, storage_path: Optional[str], status: str, validation_result: Optional[str] = None):
+    conn.execute('''
+        INSERT INTO models (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status, validation_result)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (model_id, model_name, user_id, version, timestamp, metadata, storage_path, status, validation_result))
+
+def reserve_model_version(conn, model_id: str, model_name: str, user_id: str, timestamp: str, metadata: str,
+                          status: str = "validating") -> int:
+    """Claim the next version of model_id with a placeholder row; returns the version"""
+    # IMMEDIATE takes the write lock before reading MAX(version), so two uploads never get the same number
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_latest_version(conn, model_id)
+        insert_model(conn, model_id, model_name, user_id, version, timestamp, metadata, None, status)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return version
+
+def update_model_version(conn, model_id: str, version: int, **fields):
+    assignments = ', '.join(f'{column} = ?' for column in fields)
+    # A version deleted while it was being validated or bundled stays deleted
+    cur = conn.execute(f"UPDATE models SET {assignments} WHERE model_id = ? AND version = ? AND status != 'deleted'",
+                       list(fields.values()) + [model_id, version])
+    return cur.rowcount
+
+def fail_interrupted_validations(conn) -> int:
+    cur = conn.execute('''
+        UPDATE models SET status = 'validation_failed', validation_result = ?
+        WHERE status = 'validating'
+    ''', (json.dumps({"is_valid": False, "errors": ["Registry restarted before validation finished"]}),))
+    conn.commit()
+    return cur.rowcount
+
+def get_unfinished_bundles(conn) -> List[sqlite3.Row]:
+    return conn.execute('''
+        SELECT model_id, version, storage_path FROM models WHERE bundle_status IN ('pending', 'building')
+    ''').fetchall()
+
+def get_model_version(conn, model_id: str, version: int) -> Optional[sqlite3.Row]:
+    return conn.execute('''
+        SELECT * FROM models WHERE model_id = ? AND version = ? AND status != 'deleted'
+    ''', (model_id, version)).fetchone()
+
+def get_model_location(conn, model_id: str, version: Optional[int] = None) -> Optional[sqlite3.Row]:
+    """
+    storage_path, model_name, version and bundle_status of one version, or of the latest when version is None.
+    
+    "Latest" is the newest stored version: versions still uploading or validating, and
+    ones that failed, have no storage_path yet and are skipped.
+    """
+    if version is None:
+        return conn.execute('''
+            SELECT storage_path, model_name, version, bundle_status FROM models
+            WHERE model_id = ? AND storage_path IS NOT NULL AND status != 'deleted' ORDER BY version DESC LIMIT 1
+        ''', (model_id,)).fetchone()
+    return conn.execute('''
+        SELECT storage_path, model_name, version, bundle_status FROM models
+        WHERE model_id = ? AND version = ? AND status != 'deleted'
+    ''', (model_id, version)).fetchone()
+
+def list_models(conn, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+    if user_id is None:
+        rows = conn.execute("SELECT * FROM models WHERE status != 'deleted'").fetchall()
+    else:
+        rows = conn.execute("SELECT * FROM models WHERE user_id = ? AND status != 'deleted'", (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+def mark_deleted(conn, model_id: str, version: Optional[int] = None) -> int:
+    """Logically delete one version (or every version) of a model; returns how many rows were marked"""
+    if version is None:
+        where, params = 'model_id = ?', (model_id,)
+    else:
+        where, params = 'model_id = ? AND version = ?', (model_id, version)
+    cur = conn.execute(f'''
+        UPDATE models SET status = 'deleted', deleted_at = ? WHERE {where} AND status != 'deleted'
+    ''', (datetime.utcnow().isoformat(),) + params)
+    return cur.rowcount
+
+def get_deleted_versions(conn, limit: int = 100) -> List[sqlite3.Row]:
+    return conn.execute('''
+        SELECT model_id, version, storage_path FROM models WHERE status = 'deleted' ORDER BY deleted_at LIMIT ?
+    ''', (limit,)).fetchall()
+
+def count_deleted_versions(conn) -> int:
+    return conn.execute("SELECT COUNT(*) FROM models WHERE status = 'deleted'").fetchone()[0]
+
+def storage_path_in_use(conn, storage_path: str) -> bool:
+    """True if a live version still points at storage_path (old rows could share one)"""
+    return conn.execute('''
+        SELECT 1 FROM models WHERE storage_path = ? AND status != 'deleted' LIMIT 1
+    ''', (storage_path,)).fetchone() is not None
+
+def get_all_versions(conn) -> List[sqlite3.Row]:
+    return conn.execute('SELECT model_id, version, storage_path FROM models').fetchall()
+
+def record_model_files(conn, model_id: str, version: int, files: List[Dict[str, Any]]):
+    conn.executemany('''
+        INSERT OR REPLACE INTO model_files (model_id, version, path, sha256, size) VALUES (?, ?, ?, ?, ?)
+    ''', [(model_id, version, f["path"], f["sha256"], f["size"]) for f in files])
+
+def get_model_files(conn, model_id: str, version: int) -> List[Dict[str, Any]]:
+    rows = conn.execute('''
+        SELECT path, size, sha256 FROM model_files WHERE model_id = ? AND version = ? ORDER BY path
+    ''', (model_id, version)).fetchall()
+    return [dict(row) for row in rows]
+
+def blob_referenced(conn, sha256: str) -> bool:
+    return conn.execute('SELECT 1 FROM model_files WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is not None
+
+def delete_models(conn, model_id: str, version: Optional[int] = None) -> List[str]:
+    """Delete one version (or every version) of a model; returns the blob digests it referenced"""
+    if version is None:
+        where, params = 'model_id = ?', (model_id,)
+    else:
+        where, params = 'model_id = ? AND version = ?', (model_id, version)
+    digests = [row["sha256"] for row in conn.execute(f'SELECT sha256 FROM model_files WHERE {where}', params)]
+    conn.execute(f'DELETE FROM models WHERE {where}', params)
+    conn.execute(f'DELETE FROM model_files WHERE {where}', params)
+    return digests
+
+def list_model_groups(conn, limit: int, after: Optional[str] = None, fields: List[str] = ("model_id", "version"),
+                      user_id: Optional[str] = None, status: Optional[str] = None,
+                      name: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    One page of models, in name order, with their versions grouped underneath.
+    
+    A "model" here is what the frontend lists: every version sharing a
+    model_name. after is the last name of the previous page. Returns the page
+    and whether more models follow it.
+    """
+    where, params = ["model_name IS NOT NULL", "status != 'deleted'"], []
+    if user_id is not None:
+        where.append('user_id = ?')
+        params.append(user_id)
+    if status is not None:
+        where.append('status = ?')
+        params.append(status)
+    if name:
+        # Match name literally: % and _ in it are not wildcards
+        where.append("model_name LIKE '%' || ? || '%' ESCAPE '\\'")
+        params.append(name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+    filters = ' AND '.join(where)
+    
+    page_where = filters + (' AND model_name > ?' if after is not None else '')
+    page_params = params + ([after] if after is not None else [])
+    # user_id comes from the row holding MAX(version), i.e. the latest version's owner
+    groups = conn.execute(f'''
+        SELECT model_name, user_id, MAX(version) AS latest_version, COUNT(*) AS version_count
+        FROM models WHERE {page_where}
+        GROUP BY model_name ORDER BY model_name LIMIT ?
+    ''', page_params + [limit + 1]).fetchall()
+    has_more = len(groups) > limit
+    groups = groups[:limit]
+    if not groups:
+        return [], False
+    
+    names = [group["model_name"] for group in groups]
+    columns = ', '.join(['model_name'] + [f for f in fields if f != 'model_name'])
+    versions = {model_name: [] for model_name in names}
+    rows = conn.execute(f'''
+        SELECT {columns} FROM models
+        WHERE {filters} AND model_name IN ({', '.join('?' * len(names))})
+        ORDER BY model_name, version DESC
+    ''', params + names)
+    for row in rows:
+        versions[row["model_name"]].append({f: row[f] for f in fields})
+    
+    return [dict(group, versions=versions[group["model_name"]]) for group in groups], has_more
@@ -15,6 +15,11 @@ from confluent_kafka.admin import AdminClient, NewTopic
 import socket
 from dotenv import load_dotenv
 import subprocess
+import re
+import queue
+import signal
+import shutil
+from collections import deque, OrderedDict
 
 ENV_FILE_PATH = "/exports/applications/.env"  # Update this path as needed
 
@@ -58,6 +63,24 @@ METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', '10'))
 DOCKER_IMAGE = os.getenv('DOCKER_IMAGE', 'yaswanth2503/t1:latest')
 APP_MOUNT_PATH = os.getenv('APP_MOUNT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
 MODEL_REGISTRY_URL = os.getenv('MODEL_REGISTRY_URL', f"http://{os.getenv('model_registry_ip', 'localhost')}:8000")
+REGISTRY_STATE_PATH = os.getenv('REGISTRY_STATE_PATH', os.path.join(APP_MOUNT_PATH, 'registry-state.json'))
+ANNOUNCE_RETRIES = int(os.getenv('ANNOUNCE_RETRIES', '10'))
+READINESS_TIMEOUT = int(os.getenv('READINESS_TIMEOUT', '300'))
+VM_ADDRESSES_FILE = 'vm-addresses.json'  # written by the provisioner into the VM's vagrant directory
+VAGRANT_LOG_TAIL_LINES = int(os.getenv('VAGRANT_LOG_TAIL_LINES', '200'))
+VAGRANT_DEFAULT_PHASE_DEADLINE = int(os.getenv('VAGRANT_DEFAULT_PHASE_DEADLINE', '300'))
+# Seconds each phase may run before the next one has to start
+VAGRANT_PHASE_DEADLINES = {
+    'start': int(os.getenv('VAGRANT_START_DEADLINE', '120')),
+    'import': int(os.getenv('VAGRANT_IMPORT_DEADLINE', '600')),
+    'boot': int(os.getenv('VAGRANT_BOOT_DEADLINE', '300')),
+    'ssh': int(os.getenv('VAGRANT_SSH_DEADLINE', '300')),
+    'ssh_ready': int(os.getenv('VAGRANT_SSH_READY_DEADLINE', '300')),
+    'provision': int(os.getenv('VAGRANT_PROVISION_DEADLINE', '1800')),
+    'services': int(os.getenv('VAGRANT_SERVICES_DEADLINE', '300')),
+    'services_started': int(os.getenv('VAGRANT_SERVICES_STARTED_DEADLINE', '60')),
+}
+VAGRANT_LOGS_KEPT = int(os.getenv('VAGRANT_LOGS_KEPT', '50'))  # deployments whose output tail is kept
 
 agent_log_file = "/exports/applications/agent-Service/logs/agent-" + LAPTOP_ID + ".log"
 os.makedirs(os.path.dirname(agent_log_file), exist_ok=True)
@@ -113,6 +136,92 @@ def init_kafka_producer():
     }
     return Producer(conf)
 
+class VagrantPhaseError(Exception):
+    """A vagrant command failed or overran a phase deadline; carries the output tail for diagnosis"""
+
+    def __init__(self, message, phase, tail):
+        super().__init__(message)
+        self.phase = phase
+        self.tail = tail
+
+class VagrantRunner:
+    """Runs a vagrant command, streaming its output and enforcing a deadline for each startup phase.
+
+    Phases are recognised from vagrant's own progress lines and the provisioner's
+    echo output. Each phase has to give way to the next one within its deadline,
+    otherwise the whole process group is killed. Only the last
+    VAGRANT_LOG_TAIL_LINES lines are kept.
+    """
+
+    # (phase entered, pattern that marks its start), in boot order
+    PHASES = [
+        ('import', re.compile(r'Importing base box|Cloning VM')),
+        ('boot', re.compile(r'Booting VM')),
+        ('ssh', re.compile(r'Waiting for machine to boot')),
+        ('ssh_ready', re.compile(r'Machine booted and ready')),
+        ('provision', re.compile(r'Running provisioner')),
+        ('services', re.compile(r'Starting backend service')),
+        ('services_started', re.compile(r'Both services started')),
+    ]
+
+    def __init__(self, deadlines=None, tail_lines=None):
+        self.deadlines = deadlines or VAGRANT_PHASE_DEADLINES
+        self.tail_lines = tail_lines or VAGRANT_LOG_TAIL_LINES
+
+    def run(self, args, cwd, label=''):
+        """Run `vagrant <args>` in cwd; returns {'phases': {phase: seconds}, 'tail': [...]}"""
+        tail = deque(maxlen=self.tail_lines)
+        lines = queue.Queue()
+        process = subprocess.Popen(
+            ['vagrant'] + args, cwd=cwd, start_new_session=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+        )
+
+        def pump():
+            for line in process.stdout:
+                lines.put(line.rstrip())
+            lines.put(None)
+        threading.Thread(target=pump, daemon=True).start()
+
+        phase, phase_started = 'start', time.time()
+        phases = {}
+        while True:
+            remaining = phase_started + self.deadlines.get(phase, VAGRANT_DEFAULT_PHASE_DEADLINE) - time.time()
+            try:
+                line = lines.get(timeout=max(remaining, 0))
+            except queue.Empty:
+                self._kill(process)
+                raise VagrantPhaseError(
+                    f"vagrant {' '.join(args)} exceeded the {phase} phase deadline", phase, list(tail))
+            if line is None:
+                break
+            tail.append(line)
+            logger.debug(f"[{label}] {line}")
+            for name, pattern in self.PHASES:
+                if name != phase and pattern.search(line):
+                    now = time.time()
+                    phases[phase] = now - phase_started
+                    logger.info(f"[{label}] vagrant phase {phase} -> {name} after {phases[phase]:.1f}s")
+                    phase, phase_started = name, now
+                    break
+
+        returncode = process.wait()
+        phases[phase] = time.time() - phase_started
+        if returncode != 0:
+            raise VagrantPhaseError(
+                f"vagrant {' '.join(args)} exited with status {returncode} during {phase}", phase, list(tail))
+        return {'phases': phases, 'tail': list(tail)}
+
+    def _kill(self, process):
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        except ProcessLookupError:
+            pass
+
 class DeploymentAgent:
     def __init__(self):
         logger.info(f"Initializing deployment agent on laptop: {LAPTOP_ID}")
@@ -130,14 +239,22 @@ class DeploymentAgent:
         # Initialize Kafka producer
         self.producer = init_kafka_producer()
         
-        # Track deployed containers
-        self.container_registry = {}  # deployment_id -> VM info
-        self.lock = threading.Lock()
-        
         # Create app directory if it doesn't exist
         os.makedirs(APP_MOUNT_PATH, exist_ok=True)
         logger.info(f"App mount path: {APP_MOUNT_PATH}")
         
+        # Track deployed containers, picking up VMs a previous agent process left running
+        self.lock = threading.Lock()
+        self.container_registry = self._load_registry()  # deployment_id -> VM info
+        self._reconcile_registry()
+        
+        self.vagrant_runner = VagrantRunner()
+        self.vagrant_logs = OrderedDict()  # deployment_id -> last lines of vagrant output
+
+        self.announce_thread = threading.Thread(target=self._announce_deployments)
+        self.announce_thread.daemon = True
+        self.announce_thread.start()
+        
         # Start metrics collection thread
         self.metrics_thread = threading.Thread(target=self.collect_and_send_metrics)
         self.metrics_thread.daemon = True
@@ -146,6 +263,106 @@ class DeploymentAgent:
         
         logger.info(f"Deployment agent initialized with ID: {LAPTOP_ID}, IP: {AGENT_IP}, Port: {AGENT_PORT}")
     
+    def _load_registry(self):
+        """Read the deployment registry saved by a previous agent process"""
+        try:
+            with open(REGISTRY_STATE_PATH) as f:
+                registry = json.load(f)
+            logger.info(f"Loaded {len(registry)} deployments from {REGISTRY_STATE_PATH}")
+            return registry
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Could not read registry state {REGISTRY_STATE_PATH}: {str(e)}")
+            return {}
+    
+    def _save_registry(self):
+        """Atomically persist the deployment registry (caller holds self.lock)"""
+        tmp_path = REGISTRY_STATE_PATH + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.container_registry, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, REGISTRY_STATE_PATH)
+        except Exception as e:
+            logger.error(f"Could not persist registry state: {str(e)}", exc_info=True)
+    
+    def _reconcile_registry(self):
+        """Drop saved deployments whose VM no longer exists, using a single `vagrant global-status` pass"""
+        try:
+            result = subprocess.run(
+                ['vagrant', 'global-status', '--prune', '--machine-readable'],
+                capture_output=True, text=True, timeout=60, check=True
+            )
+        except Exception as e:
+            logger.warning(f"Could not list Vagrant machines, keeping saved registry as-is: {str(e)}")
+            return
+        
+        # Lines look like: timestamp,,machine-home,/path/to/dir  and  timestamp,,state,running
+        live_dirs = set()
+        machine_home = None
+        for line in result.stdout.splitlines():
+            parts = line.split(',', 3)
+            if len(parts) < 4:
+                continue
+            if parts[2] == 'machine-home':
+                machine_home = os.path.realpath(parts[3])
+            elif parts[2] == 'state' and machine_home:
+                if parts[3] != 'not_created':
+                    live_dirs.add(machine_home)
+                machine_home = None
+        
+        with self.lock:
+            gone = [
+                deployment_id for deployment_id in self.container_registry
+                if os.path.realpath(os.path.join(APP_MOUNT_PATH, deployment_id)) not in live_dirs
+            ]
+            for deployment_id in gone:
+                logger.warning(f"Dropping saved deployment {deployment_id}: its VM no longer exists")
+                del self.container_registry[deployment_id]
+            self._save_registry()
+        logger.info(f"Reconciled registry: {len(self.container_registry)} deployments still running")
+    
+    def _announce_deployments(self):
+        """Tell the controller which deployments survived the restart, retrying until it answers"""
+        with self.lock:
+            deployments = [
+                {
+                    'deployment_id': deployment_id,
+                    'model_id': info.get('model_id'),
+                    'version': info.get('version'),
+                    'access_url': info.get('access_urls', {}).get('frontend'),
+                    'created_at': info.get('started_at')
+                }
+                for deployment_id, info in self.container_registry.items()
+            ]
+        payload = {'laptop_id': socket.gethostname(), 'ip': AGENT_IP, 'port': AGENT_PORT, 'deployments': deployments}
+        
+        delay = 5
+        for attempt in range(1, ANNOUNCE_RETRIES + 1):
+            try:
+                registry_response = requests.get(
+                    f"http://{os.getenv('service_registry_ip')}:{os.getenv('service_registry_port')}/service-registry/getServiceInfo",
+                    params={'name': 'controller'},
+                    timeout=5
+                )
+                controller = registry_response.json()['result']
+                response = requests.post(
+                    f"http://{controller['ip']}:{controller['port']}/controller/announce",
+                    json=payload,
+                    timeout=10
+                )
+                if response.ok:
+                    logger.info(f"Announced {len(deployments)} deployments to the controller")
+                    return
+                logger.warning(f"Controller rejected announcement: {response.status_code} - {response.text}")
+            except Exception as e:
+                logger.warning(f"Could not announce deployments (attempt {attempt}): {str(e)}")
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+        logger.error("Giving up announcing deployments to the controller")
+    
     def collect_metrics(self):
         """Collect system metrics only (no VM activity tracking)"""
         try:
@@ -236,64 +453,25 @@ class DeploymentAgent:
                 logger.error(f"Error in metrics collection thread: {str(e)}", exc_info=True)
                 time.sleep(METRICS_INTERVAL)
 
-    def get_vm_ip(self, vagrant_dir):
-        """Get the public network IP address (192.x.x.x) of the running VM"""
+    def read_vm_addresses(self, vagrant_dir):
+        """Addresses the VM's provisioner wrote to the synced folder, or [] if it has not reported yet"""
         try:
-            # Specifically look for 192.x.x.x addresses on any interface
-            result = subprocess.run(
-                ["vagrant", "ssh", "-c", "ip addr show | grep -E 'inet 192\\.' | head -n 1 | awk '{print $2}' | cut -d'/' -f1"],
-                cwd=vagrant_dir,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True
-            )
-            vm_ip = result.stdout.strip()
-            
-            if not vm_ip:
-                # Try getting all IPs and filter
-                result = subprocess.run(
-                    ["vagrant", "ssh", "-c", "hostname -I"],
-                    cwd=vagrant_dir,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    check=True
-                )
-                all_ips = result.stdout.strip().split()
-                # Filter for 192.x.x.x addresses
-                for ip in all_ips:
-                    if ip.startswith("192."):
-                        vm_ip = ip
-                        break
-            
-            if not vm_ip:
-                # As a last resort, get the interface that's connected to the public network
-                result = subprocess.run(
-                    ["vagrant", "ssh", "-c", "ip route | grep default | awk '{print $5}'"],
-                    cwd=vagrant_dir,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    check=True
-                )
-                default_interface = result.stdout.strip()
-                
-                if default_interface:
-                    result = subprocess.run(
-                        ["vagrant", "ssh", "-c", f"ip addr show {default_interface} | grep 'inet ' | awk '{{print $2}}' | cut -d'/' -f1"],
-                        cwd=vagrant_dir,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True,
-                        check=True
-                    )
-                    vm_ip = result.stdout.strip()
-            
-            return vm_ip
-        except Exception as e:
-            logger.error(f"Failed to retrieve VM IP address: {str(e)}")
-            raise
+            with open(os.path.join(vagrant_dir, VM_ADDRESSES_FILE)) as f:
+                return json.load(f).get('addresses', '').split()
+        except (OSError, ValueError, AttributeError):
+            return []
+
+    @staticmethod
+    def pick_vm_ip(addresses):
+        """The VM's public network address (192.x.x.x) among those it reported, or ''"""
+        for ip in addresses:
+            if ip.startswith("192."):
+                return ip
+        # Otherwise the first address that is not VirtualBox's NAT interface
+        for ip in addresses:
+            if not ip.startswith("10.0.2."):
+                return ip
+        return ''
     
     def deploy_model(self, model_id, version, redeploy=False, previous_deployment_id=None):
         """Deploy a VM for the model using Vagrant and execute the frontend and backend applications"""
@@ -374,6 +552,10 @@ class DeploymentAgent:
                 end
 
                 config.vm.provision "shell", inline: <<-SHELL
+                    # Report this VM's addresses once through the default /vagrant synced folder
+                    printf '{{"addresses": "%s", "reported_at": %s}}' "$(hostname -I)" "$(date +%s)" > /vagrant/{VM_ADDRESSES_FILE}.tmp
+                    mv /vagrant/{VM_ADDRESSES_FILE}.tmp /vagrant/{VM_ADDRESSES_FILE}
+
                     # Create and enable a 2GB swap file
                     if ! swapon --show | grep -q /swapfile; then
                         echo "Creating a 2GB swap file..."
@@ -407,8 +589,12 @@ class DeploymentAgent:
                     nohup python3 app.py > backend.log 2>&1 &
                     echo $! > backend.pid
 
-                    # Wait for backend to start
-                    sleep 5
+                    # Give the backend a bounded head start instead of a fixed sleep; the agent
+                    # checks both forwarded ports afterwards anyway
+                    for i in $(seq 1 30); do
+                        curl -s -o /dev/null http://127.0.0.1:5000/ && break
+                        sleep 1
+                    done
 
                     # Start frontend service (Streamlit)
                     echo "Starting frontend service (webapp.py)..."
@@ -427,9 +613,39 @@ class DeploymentAgent:
             
             # Start the VM
             logger.info(f"Starting VM for deployment {deployment_id}")
-            os.system(f"cd {vagrant_dir} && vagrant up")
+            try:
+                startup = self.vagrant_runner.run(['up'], vagrant_dir, label=deployment_id)
+            except VagrantPhaseError as e:
+                self._remember_vagrant_log(deployment_id, e.tail)
+                logger.error(f"VM startup for {deployment_id} failed in phase {e.phase}; last output:\n" + "\n".join(e.tail[-20:]))
+                self._destroy_failed_vm(deployment_id, vagrant_dir)
+                return {
+                    'success': False,
+                    'error': str(e),
+                    'phase': e.phase,
+                    'log_url': f"http://{AGENT_IP}:{AGENT_PORT}/vagrant-log/{deployment_id}"
+                }
+            self._remember_vagrant_log(deployment_id, startup['tail'])
+            logger.info(f"VM {deployment_id} phase timings: " + ", ".join(f"{k}={v:.1f}s" for k, v in startup['phases'].items()))
+
+            # `vagrant up` returns once the apps are launched, not once they answer
+            not_ready = self._wait_for_ready([backend_port, frontend_port], time.time() + READINESS_TIMEOUT)
+            if not_ready:
+                error = f"VM did not answer on port(s) {not_ready} within {READINESS_TIMEOUT}s"
+                logger.error(f"Readiness check for {deployment_id} failed: {error}; last output:\n" + "\n".join(startup['tail'][-20:]))
+                self._destroy_failed_vm(deployment_id, vagrant_dir)
+                return {
+                    'success': False,
+                    'error': error,
+                    'phase': 'readiness',
+                    'log_url': f"http://{AGENT_IP}:{AGENT_PORT}/vagrant-log/{deployment_id}"
+                }
 
-            logger.info(f"VM created with port forwarding - Backend: {vm_ip}:{backend_port}, Frontend: {vm_ip}:{frontend_port}")
+            # Reported by the provisioner, so the guest address costs nothing to look up
+            vm_addresses = self.read_vm_addresses(vagrant_dir)
+            guest_ip = self.pick_vm_ip(vm_addresses)
+            logger.info(f"VM created with port forwarding - Backend: {vm_ip}:{backend_port}, Frontend: {vm_ip}:{frontend_port}"
+                        + (f" (guest address {guest_ip})" if guest_ip else ""))
 
             # Construct access URLs using the host IP and forwarded ports
             access_urls = {
@@ -449,8 +665,12 @@ class DeploymentAgent:
                     'frontend_port': frontend_port,
                     'started_at': time.time(),
                     'model_path': model_path,
-                    'access_urls': access_urls
+                    'access_urls': access_urls,
+                    'vm_addresses': vm_addresses,
+                    'guest_ip': guest_ip,
+                    'startup_phases': startup['phases']
                 }
+                self._save_registry()
 
                 # If this is a redeploy, clean up the previous VM
                 if redeploy and previous_deployment_id in self.container_registry:
@@ -463,6 +683,7 @@ class DeploymentAgent:
                 'vm_ip': vm_ip,
                 'backend_port': backend_port,
                 'frontend_port': frontend_port,
+                'guest_ip': guest_ip,
                 'access_urls': access_urls,
                 'model_id': model_id,
                 'version': version
@@ -475,6 +696,36 @@ class DeploymentAgent:
                 'error': str(e)
             }
 
+    def _remember_vagrant_log(self, deployment_id, tail):
+        with self.lock:
+            self.vagrant_logs[deployment_id] = tail
+            self.vagrant_logs.move_to_end(deployment_id)
+            while len(self.vagrant_logs) > VAGRANT_LOGS_KEPT:
+                self.vagrant_logs.popitem(last=False)
+
+    def _destroy_failed_vm(self, deployment_id, vagrant_dir):
+        """Tear down whatever a failed `vagrant up` left behind; the log tail stays available"""
+        try:
+            self.vagrant_runner.run(['destroy', '-f'], vagrant_dir, label=deployment_id)
+        except VagrantPhaseError as e:
+            logger.error(f"Could not destroy failed VM {deployment_id}: {str(e)}")
+        shutil.rmtree(vagrant_dir, ignore_errors=True)
+
+    def _wait_for_ready(self, ports, deadline):
+        """Poll the forwarded ports until each answers HTTP; returns the ones still down at the deadline"""
+        pending = list(ports)
+        while pending and time.time() < deadline:
+            still_down = []
+            for port in pending:
+                try:
+                    requests.get(f"http://127.0.0.1:{port}/", timeout=2)
+                except requests.exceptions.RequestException:
+                    still_down.append(port)
+            pending = still_down
+            if pending:
+                time.sleep(1)
+        return pending
+
     def _get_available_port(self, start_port, end_port):
         """Find an available port in the specified range"""
         for port in range(start_port, end_port):
@@ -501,6 +752,7 @@ class DeploymentAgent:
             
             if result:
                 del self.container_registry[deployment_id]
+                self._save_registry()
                 logger.info(f"Removed deployment {deployment_id} from registry")
             
             return result
@@ -589,6 +841,22 @@ def stop_vm(deployment_id):
             'error': f"Failed to stop VM {deployment_id}"
         }), 404
 
+@app.route('/vagrant-log/<deployment_id>', methods=['GET'])
+def get_vagrant_log(deployment_id):
+    """Last lines of vagrant output for a recent deployment, for diagnosing failed starts"""
+    with deployment_agent.lock:
+        tail = deployment_agent.vagrant_logs.get(deployment_id)
+    if tail is None:
+        return jsonify({
+            'success': False,
+            'error': f"No vagrant output kept for {deployment_id}"
+        }), 404
+    return jsonify({
+        'success': True,
+        'deployment_id': deployment_id,
+        'lines': tail
+    }), 200
+
 @app.route('/status', methods=['GET'])
 def get_status():
     """Endpoint for getting agent status"""
@@ -618,6 +886,7 @@ def get_status():
                 'started_at': info.get('started_at'),
                 'uptime': current_time - info.get('started_at', current_time) if info.get('started_at') else None,
                 'host_port': info.get('host_port'),
+                'guest_ip': info.get('guest_ip'),
                 'container_id': container_id,
                 'access_url': f"http://{AGENT_IP}:{info.get('host_port')}"
             }